@@ -0,0 +1,206 @@
+"""Fake Discord objects for the benchmarks: just enough of Interaction, Message,
+Channel and Member for the bot's command and button paths.
+
+Every REST-equivalent call (send, edit, defer, followup, fetch) awaits the
+injected latency and is counted on the shared FakeDiscord hub.
+"""
+import asyncio
+import datetime
+import itertools
+from collections import Counter
+from typing import Dict, List, Optional
+
+import discord
+
+
+class FakeDiscord:
+    """Shared state: ids, channels, counters and latency."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.channels: Dict[int, "FakeChannel"] = {}
+        self._ids = itertools.count(1_200_000_000_000_000_000)
+
+    def next_id(self) -> int:
+        return next(self._ids)
+
+    async def rest(self, name: str):
+        self.calls[name] += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+    def channel(self, channel_id: Optional[int] = None) -> "FakeChannel":
+        channel_id = channel_id or self.next_id()
+        if channel_id not in self.channels:
+            self.channels[channel_id] = FakeChannel(self, channel_id)
+        return self.channels[channel_id]
+
+    def get_channel(self, channel_id: int) -> Optional["FakeChannel"]:
+        return self.channels.get(int(channel_id))
+
+
+class FakeMessage:
+    def __init__(self, hub: FakeDiscord, channel: "FakeChannel", content=None, embed=None, view=None):
+        self.hub = hub
+        self.id = hub.next_id()
+        self.channel = channel
+        self.guild = None
+        self.content = content
+        self.embeds: List[discord.Embed] = [embed] if embed is not None else []
+        self.view = view
+
+    async def edit(self, content=None, embed=None, view=None, **kwargs):
+        await self.hub.rest("message.edit")
+        if content is not None:
+            self.content = content
+        if embed is not None:
+            self.embeds = [embed]
+        if view is not None:
+            self.view = view
+        return self
+
+
+class FakeChannel:
+    def __init__(self, hub: FakeDiscord, channel_id: int):
+        self.hub = hub
+        self.id = channel_id
+        self.messages: Dict[int, FakeMessage] = {}
+
+    def add(self, message: FakeMessage) -> FakeMessage:
+        self.messages[message.id] = message
+        return message
+
+    async def send(self, content=None, embed=None, view=None, **kwargs) -> FakeMessage:
+        await self.hub.rest("channel.send")
+        return self.add(FakeMessage(self.hub, self, content, embed, view))
+
+    async def fetch_message(self, message_id: int) -> FakeMessage:
+        await self.hub.rest("channel.fetch_message")
+        message = self.messages.get(int(message_id))
+        if message is None:
+            raise discord.NotFound(_FakeHTTPResponse(404), "Unknown Message")
+        return message
+
+
+class _FakeHTTPResponse:
+    """Enough of aiohttp.ClientResponse for discord.HTTPException.__init__."""
+
+    def __init__(self, status: int):
+        self.status = status
+        self.reason = "Not Found"
+
+
+class FakePermissions:
+    def __init__(self, administrator: bool = False):
+        self.administrator = administrator
+
+
+class FakeMember:
+    def __init__(self, hub: FakeDiscord, user_id: Optional[int] = None, name: Optional[str] = None, administrator: bool = False):
+        self.hub = hub
+        self.id = user_id or hub.next_id()
+        self.name = name or f"user{self.id % 100000}"
+        self.display_name = self.name
+        self.mention = f"<@{self.id}>"
+        self.bot = False
+        self.guild_permissions = FakePermissions(administrator)
+        self.dm_channel = hub.channel()
+
+    async def send(self, content=None, embed=None, view=None, **kwargs) -> FakeMessage:
+        await self.hub.rest("dm.send")
+        return self.dm_channel.add(FakeMessage(self.hub, self.dm_channel, content, embed, view))
+
+    def __str__(self):
+        return self.name
+
+
+class FakeResponse:
+    """interaction.response: one initial response per interaction."""
+
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction = interaction
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    def _respond(self):
+        if self._done:
+            raise discord.InteractionResponded(self.interaction)
+        self._done = True
+
+    async def send_message(self, content=None, *, embed=None, view=None, ephemeral=False, **kwargs):
+        self._respond()
+        await self.interaction.hub.rest("response.send_message")
+        self.interaction.message_sent = self.interaction.channel.add(
+            FakeMessage(self.interaction.hub, self.interaction.channel, content, embed, view)
+        )
+        self.interaction.replies.append(content)
+
+    async def defer(self, *, ephemeral=False, thinking=False):
+        self._respond()
+        await self.interaction.hub.rest("response.defer")
+
+    async def edit_message(self, content=None, embed=None, view=None, **kwargs):
+        self._respond()
+        await self.interaction.hub.rest("response.edit_message")
+
+    async def send_modal(self, modal):
+        self._respond()
+        await self.interaction.hub.rest("response.send_modal")
+
+
+class FakeFollowup:
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction = interaction
+
+    async def send(self, content=None, *, embed=None, view=None, ephemeral=False, **kwargs) -> FakeMessage:
+        await self.interaction.hub.rest("followup.send")
+        self.interaction.replies.append(content)
+        return FakeMessage(self.interaction.hub, self.interaction.channel, content, embed, view)
+
+
+class FakeInteraction:
+    """Slash command (application_command) or button (component) interaction."""
+
+    def __init__(self, hub: FakeDiscord, user: FakeMember, channel: FakeChannel,
+                 custom_id: Optional[str] = None, command=None, message: Optional[FakeMessage] = None):
+        self.hub = hub
+        self.id = hub.next_id()
+        self.user = user
+        self.channel = channel
+        self.channel_id = channel.id
+        self.guild = None
+        self.guild_id = None
+        self.command = command
+        self.message = message
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        if custom_id is None:
+            self.type = discord.InteractionType.application_command
+            self.data = {"name": getattr(command, "name", "")}
+        else:
+            self.type = discord.InteractionType.component
+            self.data = {"component_type": 2, "custom_id": custom_id}
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.message_sent: Optional[FakeMessage] = None
+        self.replies: List[Optional[str]] = []
+
+    async def original_response(self) -> FakeMessage:
+        await self.hub.rest("original_response")
+        return self.message_sent
+
+    async def edit_original_response(self, content=None, embed=None, view=None, **kwargs):
+        await self.hub.rest("edit_original_response")
+        target = self.message or self.message_sent
+        if target is not None:
+            if embed is not None:
+                target.embeds = [embed]
+            if view is not None:
+                target.view = view
+        return target
+
+    def redelivered(self) -> "FakeInteraction":
+        """A second click on the same button: same custom_id and user, new interaction id."""
+        return FakeInteraction(self.hub, self.user, self.channel, self.data.get("custom_id"), self.command, self.message)
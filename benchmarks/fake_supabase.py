@@ -0,0 +1,366 @@
+"""In-memory stand-in for the supabase-py client used by the benchmarks.
+
+Implements the query-builder subset the bot uses (select/insert/update/upsert/
+delete with eq/neq/lt/lte/gt/gte/in_/is_/or_/order/limit) and the RPCs of the
+migrations (apply_ledger_batch, capture_duel_holds, settle_duel_with_holds,
+claim_interaction_receipt, increment_match_total). Every execute() is one round
+trip: it sleeps for the injected latency (in the calling thread, like the real
+sync client) and is counted per operation and table. Round trips issued from
+the event-loop thread are counted separately — those block the loop for the
+whole latency.
+"""
+import itertools
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Callable, Dict, List, Optional
+
+# Значения по умолчанию, которые в Postgres проставляет схема
+TABLE_DEFAULTS = {
+    "balance_holds": {"status": "held", "settled_at": None},
+    "duel_invites": {"channel_id": None, "message_id": None},
+    "team_invites": {"channel_id": None, "message_id": None},
+    "interaction_receipts": {"result": None, "completed_at": None},
+}
+
+# Хэш-индекс по одной колонке на таблицу: без него стоимость фейка растёт с объёмом данных
+INDEXED = {
+    "users": "user_id", "matches": "id", "duels": "id", "bets": "match_id", "balance_ledger": "idempotency_key",
+    "balance_holds": "ref_id", "duel_invites": "duel_id", "team_invites": "id", "interaction_receipts": "action_key",
+}
+
+
+class FakeResponse:
+    def __init__(self, data: List[dict]):
+        self.data = data
+        self.count = None
+
+
+def _same(a, b) -> bool:
+    # PostgREST сравнивает по тексту: "42" и 42 для bigint-колонки равны
+    return str(a) == str(b)
+
+
+def _ordered(a, b, op: Callable[[float, float], bool]) -> bool:
+    if a is None or b is None:
+        return False
+    try:
+        return op(float(a), float(b))
+    except (TypeError, ValueError):
+        return op(str(a), str(b))
+
+
+class FakeQuery:
+    def __init__(self, db: "FakeSupabase", table: str):
+        self.db = db
+        self.table = table
+        self.op = "select"
+        self.columns: Optional[List[str]] = None
+        self.payload = None
+        self.on_conflict: Optional[str] = None
+        self.ignore_duplicates = False
+        self.filters: List[Callable[[dict], bool]] = []
+        self.equals: Dict[str, object] = {}
+        self.order_by: Optional[tuple] = None
+        self.row_limit: Optional[int] = None
+
+    # ---- операции ----
+    def select(self, *columns, count=None):
+        names = [c.strip() for col in columns for c in col.split(",") if c.strip()]
+        self.columns = None if not names or "*" in names else names
+        return self
+
+    def insert(self, rows):
+        self.op, self.payload = "insert", rows
+        return self
+
+    def upsert(self, rows, on_conflict: str = "", ignore_duplicates: bool = False):
+        self.op, self.payload = "upsert", rows
+        self.on_conflict, self.ignore_duplicates = on_conflict, ignore_duplicates
+        return self
+
+    def update(self, values: dict):
+        self.op, self.payload = "update", dict(values)
+        return self
+
+    def delete(self):
+        self.op = "delete"
+        return self
+
+    # ---- фильтры ----
+    def eq(self, column, value):
+        self.equals[column] = value
+        self.filters.append(lambda row: _same(row.get(column), value))
+        return self
+
+    def neq(self, column, value):
+        self.filters.append(lambda row: not _same(row.get(column), value))
+        return self
+
+    def lt(self, column, value):
+        self.filters.append(lambda row: _ordered(row.get(column), value, lambda a, b: a < b))
+        return self
+
+    def lte(self, column, value):
+        self.filters.append(lambda row: _ordered(row.get(column), value, lambda a, b: a <= b))
+        return self
+
+    def gt(self, column, value):
+        self.filters.append(lambda row: _ordered(row.get(column), value, lambda a, b: a > b))
+        return self
+
+    def gte(self, column, value):
+        self.filters.append(lambda row: _ordered(row.get(column), value, lambda a, b: a >= b))
+        return self
+
+    def in_(self, column, values):
+        wanted = {str(v) for v in values}
+        self.filters.append(lambda row: str(row.get(column)) in wanted)
+        return self
+
+    def is_(self, column, value):
+        if str(value).lower() == "null":
+            self.filters.append(lambda row: row.get(column) is None)
+        else:
+            self.filters.append(lambda row: _same(row.get(column), value))
+        return self
+
+    def or_(self, expression: str):
+        """Only the "col.eq.value,col2.eq.value" form the bot uses."""
+        terms = []
+        for part in expression.split(","):
+            column, op, value = part.split(".", 2)
+            if op != "eq":
+                raise NotImplementedError(f"or_ operator {op}")
+            terms.append((column, value))
+        self.filters.append(lambda row: any(_same(row.get(c), v) for c, v in terms))
+        return self
+
+    def order(self, column, desc: bool = False):
+        self.order_by = (column, desc)
+        return self
+
+    def limit(self, n: int):
+        self.row_limit = n
+        return self
+
+    def execute(self) -> FakeResponse:
+        self.db.round_trip(self.op, self.table)
+        with self.db.lock:
+            return FakeResponse(self._apply())
+
+    # ---- выполнение (под lock базы) ----
+    def _matching(self) -> List[dict]:
+        return [row for row in self.db.candidates(self.table, self.equals) if all(f(row) for f in self.filters)]
+
+    def _apply(self) -> List[dict]:
+        if self.op == "select":
+            rows = self._matching()
+            if self.order_by:
+                column, desc = self.order_by
+                rows.sort(key=lambda r: (r.get(column) is None, r.get(column)), reverse=desc)
+            if self.row_limit is not None:
+                rows = rows[:self.row_limit]
+            return [self._project(row) for row in rows]
+        if self.op == "insert":
+            return [dict(self.db.insert_row(self.table, row)) for row in self._rows()]
+        if self.op == "upsert":
+            return self._upsert()
+        if self.op == "update":
+            rows = self._matching()
+            for row in rows:
+                row.update(self.payload)
+            if INDEXED.get(self.table) in self.payload:
+                self.db.reindex(self.table)
+            return [dict(row) for row in rows]
+        if self.op == "delete":
+            rows = self._matching()
+            ids = {id(row) for row in rows}
+            self.db.tables[self.table] = [row for row in self.db.tables[self.table] if id(row) not in ids]
+            self.db.reindex(self.table)
+            return [dict(row) for row in rows]
+        raise NotImplementedError(self.op)
+
+    def _rows(self) -> List[dict]:
+        return self.payload if isinstance(self.payload, list) else [self.payload]
+
+    def _upsert(self) -> List[dict]:
+        keys = [k.strip() for k in (self.on_conflict or "id").split(",")]
+        result = []
+        for row in self._rows():
+            existing = next(
+                (r for r in self.db.candidates(self.table, {k: row.get(k) for k in keys}) if all(_same(r.get(k), row.get(k)) for k in keys)), None
+            )
+            if existing is None:
+                result.append(dict(self.db.insert_row(self.table, row)))
+            elif not self.ignore_duplicates:
+                existing.update(row)
+                if INDEXED.get(self.table) in row:
+                    self.db.reindex(self.table)
+                result.append(dict(existing))
+        return result
+
+    def _project(self, row: dict) -> dict:
+        if self.columns is None:
+            return dict(row)
+        return {c: row.get(c) for c in self.columns}
+
+
+class FakeRpc:
+    def __init__(self, db: "FakeSupabase", name: str, params: dict):
+        self.db = db
+        self.name = name
+        self.params = params
+
+    def execute(self) -> FakeResponse:
+        handler = getattr(self.db, f"_rpc_{self.name}", None)
+        if handler is None:
+            raise NotImplementedError(f"rpc {self.name}")
+        self.db.round_trip("rpc", self.name)
+        with self.db.lock:
+            return FakeResponse(handler(**self.params))
+
+
+class FakeSupabase:
+    """Tables are lists of dicts; `latency`/`jitter` are seconds added to every round trip."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.tables: Dict[str, List[dict]] = defaultdict(list)
+        self._index: Dict[str, Dict[str, List[dict]]] = defaultdict(lambda: defaultdict(list))
+        self.lock = threading.RLock()
+        self.round_trips: Counter = Counter()      # {"op table": n}
+        self.loop_round_trips: Counter = Counter()  # те же, но выполненные в потоке event loop
+        self.loop_thread_id: Optional[int] = None
+        self._ids: Dict[str, itertools.count] = defaultdict(lambda: itertools.count(1))
+        self._random = random.Random(seed)
+        self._counter_lock = threading.Lock()
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    def rpc(self, name: str, params: Optional[dict] = None) -> FakeRpc:
+        return FakeRpc(self, name, params or {})
+
+    def round_trip(self, op: str, target: str):
+        key = f"{op} {target}"
+        with self._counter_lock:
+            self.round_trips[key] += 1
+            if threading.get_ident() == self.loop_thread_id:
+                self.loop_round_trips[key] += 1
+            delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def insert_row(self, table: str, row: dict) -> dict:
+        """Insert without a round trip (also used to seed data)."""
+        stored = dict(TABLE_DEFAULTS.get(table, {}))
+        stored.update(row)
+        if "id" not in stored:
+            stored["id"] = next(self._ids[table])
+        self.tables[table].append(stored)
+        column = INDEXED.get(table)
+        if column is not None:
+            self._index[table][str(stored.get(column))].append(stored)
+        return stored
+
+    def candidates(self, table: str, equals: dict) -> List[dict]:
+        """Rows that can match the equality filters (the index bucket when one applies)."""
+        column = INDEXED.get(table)
+        if column is not None and column in equals:
+            return list(self._index[table].get(str(equals[column]), ()))
+        return self.tables[table]
+
+    def reindex(self, table: str):
+        column = INDEXED.get(table)
+        if column is None:
+            return
+        index = self._index[table] = defaultdict(list)
+        for row in self.tables[table]:
+            index[str(row.get(column))].append(row)
+
+    def find(self, table: str, **equals) -> List[dict]:
+        """Rows matching all column=value pairs, without a round trip."""
+        return [row for row in self.candidates(table, equals) if all(_same(row.get(k), v) for k, v in equals.items())]
+
+    def _add_balance(self, user_id: str, delta: int) -> int:
+        users = self.find("users", user_id=user_id)
+        if users:
+            users[0]["balance"] = int(users[0]["balance"]) + delta
+            return users[0]["balance"]
+        return self.insert_row("users", {"user_id": user_id, "balance": delta, "last_duel_time": 0})["balance"]
+
+    def _ledger_insert(self, entry: dict) -> bool:
+        """balance_ledger insert ... on conflict (idempotency_key) do nothing."""
+        if self.find("balance_ledger", idempotency_key=entry["idempotency_key"]):
+            return False
+        self.insert_row("balance_ledger", {**entry, "created_at": time.time()})
+        return True
+
+    # ---- RPC из migrations/ ----
+    def _rpc_apply_ledger_batch(self, p_entries: List[dict]) -> List[dict]:
+        inserted = [entry for entry in p_entries if self._ledger_insert(dict(entry))]
+        totals: Dict[str, int] = defaultdict(int)
+        for entry in inserted:
+            totals[entry["user_id"]] += int(entry["delta"])
+        balances = {uid: self._add_balance(uid, delta) for uid, delta in totals.items()}
+        return [
+            {"idempotency_key": e["idempotency_key"], "user_id": e["user_id"], "balance": balances[e["user_id"]]}
+            for e in inserted
+        ]
+
+    def _rpc_capture_duel_holds(self, p_duel_id: int, p_winner_id: str, p_payout: int) -> List[dict]:
+        holders: Dict[str, int] = defaultdict(int)
+        for hold in self.find("balance_holds", ref_type="duel", ref_id=str(p_duel_id), status="held"):
+            hold["status"], hold["settled_at"] = "captured", time.time()
+            holders[hold["user_id"]] += int(hold["amount"])
+        entries = [
+            {"user_id": uid, "delta": -amount, "reason": "duel_stake", "ref_type": "duel", "ref_id": str(p_duel_id),
+             "idempotency_key": f"duel:{p_duel_id}:capture:{uid}"}
+            for uid, amount in holders.items()
+        ]
+        if p_payout > 0 and holders:
+            entries.append({
+                "user_id": p_winner_id, "delta": p_payout, "reason": "duel_payout", "ref_type": "duel",
+                "ref_id": str(p_duel_id), "idempotency_key": f"duel:{p_duel_id}:payout",
+            })
+        totals: Dict[str, int] = defaultdict(int)
+        for entry in entries:
+            if self._ledger_insert(entry):
+                totals[entry["user_id"]] += entry["delta"]
+        balances = {uid: self._add_balance(uid, delta) for uid, delta in totals.items()}
+        return [
+            {"user_id": uid, "held": holders.get(uid, 0), "balance": balances.get(uid)}
+            for uid in set(holders) | set(balances)
+        ]
+
+    def _rpc_settle_duel_with_holds(self, p_duel_id: int, p_winner_side: str, p_winner_id: str, p_payout: int) -> List[dict]:
+        lost = [{"settled": False, "user_id": None, "held": None, "balance": None}]
+        duels = [d for d in self.find("duels", id=p_duel_id) if d.get("status") in ("processing", "result_pending")]
+        if not duels:
+            return lost
+        duels[0]["status"], duels[0]["winner_side"] = "settled", p_winner_side
+        rows = self._rpc_capture_duel_holds(p_duel_id, p_winner_id, p_payout)
+        return [{"settled": True, **row} for row in rows] or [{**lost[0], "settled": True}]
+
+    def _rpc_increment_match_total(self, p_match_id: int, p_team: str, p_amount: int) -> List[dict]:
+        column = {"A": "total_a", "B": "total_b"}[p_team]
+        result = []
+        for match in self.find("matches", id=p_match_id):
+            match[column] = int(match.get(column) or 0) + int(p_amount)
+            result.append({"total_a": int(match.get("total_a") or 0), "total_b": int(match.get("total_b") or 0)})
+        return result
+
+    def _rpc_claim_interaction_receipt(self, p_key: str, p_interaction_id: str, p_stale_seconds: int) -> List[dict]:
+        now = time.time()
+        existing = self.find("interaction_receipts", action_key=p_key)
+        if not existing:
+            self.insert_row("interaction_receipts", {"action_key": p_key, "interaction_id": p_interaction_id, "claimed_at": now})
+            return [{"claimed": True, "result": None}]
+        receipt = existing[0]
+        if receipt.get("completed_at") is None and receipt["claimed_at"] < now - p_stale_seconds:
+            receipt["interaction_id"], receipt["claimed_at"] = p_interaction_id, now
+            return [{"claimed": True, "result": None}]
+        return [{"claimed": False, "result": receipt.get("result")}]
@@ -0,0 +1,386 @@
+"""End-to-end benchmarks of discord_bet_bot_fixed against fake Discord and Supabase.
+
+    python benchmarks/run.py                                  # all flows, default sizes
+    python benchmarks/run.py --bets 10000 --settle-bettors 1000 --db-latency-ms 5
+    python benchmarks/run.py --flows place_bet,settle_bet --json results.json
+
+Flows (the real bot functions, only the clients are fake):
+  place_bet           N place_bet() calls by a pool of users on one open match
+  settle_bet          settle_bet() of matches with M winning bettors each
+  duel_cmd            /duel 1v1 with an opponent (interaction check, callback, completion)
+  duel_accept         "accept" button of each invite, through on_interaction
+  duel_accept_repeat  a second click on the same button (idempotency fast path)
+  settle_a            admin "A won" button on each duel, through on_interaction
+
+For every flow: throughput, p50/p99/max latency, Supabase round trips per call
+(and how many ran on the event-loop thread, blocking it for the whole latency),
+Discord REST calls per call and the worst event-loop lag seen meanwhile.
+Ledger entries buffered by the flow are flushed before its counters are read.
+Needs the bot's dependencies installed (discord.py, supabase, aiohttp, python-dotenv).
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Awaitable, Callable, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_discord import FakeDiscord, FakeInteraction, FakeMember  # noqa: E402
+from fake_supabase import FakeSupabase  # noqa: E402
+
+FLOWS = ("place_bet", "settle_bet", "duel_cmd", "duel_accept", "duel_accept_repeat", "settle_a")
+REQUIRES = {"duel_accept": "duel_cmd", "duel_accept_repeat": "duel_accept", "settle_a": "duel_accept"}
+START_BALANCE = 1_000_000
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+
+class LagProbe:
+    """Worst extra delay of a short fixed-interval sleep on the loop (reset per flow)."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.worst = 0.0
+
+    async def run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.worst = max(self.worst, time.perf_counter() - started - self.interval)
+
+
+class FlowResult:
+    def __init__(self, name: str, latencies: List[float], ok: int, wall: float,
+                 round_trips: Counter, loop_round_trips: Counter, discord_calls: Counter, lag: float):
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.calls = len(latencies)
+        self.ok = ok
+        self.wall = wall
+        self.round_trips = round_trips
+        self.loop_round_trips = loop_round_trips
+        self.discord_calls = discord_calls
+        self.lag = lag
+        self.notes: List[str] = []
+
+    def per_call(self, total: int) -> float:
+        return total / self.calls if self.calls else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "flow": self.name, "calls": self.calls, "ok": self.ok, "wall_s": round(self.wall, 3),
+            "throughput_per_s": round(self.calls / self.wall, 1) if self.wall else None,
+            "p50_ms": round(percentile(self.latencies, 0.5) * 1000, 2),
+            "p99_ms": round(percentile(self.latencies, 0.99) * 1000, 2),
+            "max_ms": round(self.latencies[-1] * 1000, 2) if self.latencies else 0.0,
+            "db_round_trips": dict(self.round_trips), "db_round_trips_on_loop": dict(self.loop_round_trips),
+            "discord_calls": dict(self.discord_calls), "loop_lag_max_ms": round(self.lag * 1000, 1),
+            "notes": self.notes,
+        }
+
+
+class Bench:
+    def __init__(self, args, bot_module):
+        self.args = args
+        self.bot = bot_module
+        self.db = FakeSupabase(args.db_latency_ms / 1000, args.db_jitter_ms / 1000, args.seed)
+        self.hub = FakeDiscord(args.discord_latency_ms / 1000)
+        self.channel = self.hub.channel()
+        self.admin = FakeMember(self.hub, name="admin", administrator=True)
+        self.probe = LagProbe()
+        self.duels: List[dict] = []  # {"id", "creator", "opponent", "invite"}
+        self.accepts: List[FakeInteraction] = []
+
+    # ---------------------- SETUP ----------------------
+    async def setup(self):
+        bot = self.bot
+        self.db.loop_thread_id = threading.get_ident()
+        bot.supabase = self.db
+        bot.bot.get_channel = self.hub.get_channel
+        # Как в on_ready: прогрев реестров, фоновые сбросы буферов
+        await bot.load_open_duels()
+        await bot.load_duel_cooldowns()
+        await bot.load_holds()
+        bot.flush_ledger.start()
+        bot.flush_duel_times.start()
+        if self.args.outbound:
+            bot.outbound.start()
+        self._probe_task = asyncio.create_task(self.probe.run())
+
+    async def teardown(self):
+        self.bot.flush_ledger.cancel()
+        self.bot.flush_duel_times.cancel()
+        self._probe_task.cancel()
+
+    def seed_users(self, count: int) -> List[FakeMember]:
+        members = [FakeMember(self.hub) for _ in range(count)]
+        for member in members:
+            self.db.insert_row("users", {
+                "user_id": str(member.id), "name": member.name, "balance": START_BALANCE, "last_duel_time": 0,
+            })
+        return members
+
+    def seed_match(self, total_a: int = 0, total_b: int = 0) -> int:
+        return self.db.insert_row("matches", {
+            "channel_id": self.channel.id, "team_a": "Radiant", "team_b": "Dire", "burn": self.bot.DEFAULT_BURN,
+            "status": "Открыта", "total_a": total_a, "total_b": total_b, "created_at": int(time.time()),
+            "message_id": None,
+        })["id"]
+
+    # ---------------------- RUNNER ----------------------
+    async def run_flow(self, name: str, calls: List[Callable[[], Awaitable[bool]]], concurrency: int) -> FlowResult:
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies: List[float] = []
+        ok = 0
+        round_trips, loop_round_trips, discord_calls = Counter(self.db.round_trips), Counter(self.db.loop_round_trips), Counter(self.hub.calls)
+        self.probe.worst = 0.0
+
+        async def one(call):
+            nonlocal ok
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    if await call():
+                        ok += 1
+                finally:
+                    latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(call) for call in calls))
+        wall = time.perf_counter() - started
+        await self.bot.flush_ledger_now()
+        return FlowResult(
+            name, latencies, ok, wall,
+            self.db.round_trips - round_trips, self.db.loop_round_trips - loop_round_trips,
+            self.hub.calls - discord_calls, self.probe.worst,
+        )
+
+    # ---------------------- FLOWS ----------------------
+    async def flow_place_bet(self) -> FlowResult:
+        users = self.seed_users(self.args.bet_users)
+        match_id = self.seed_match()
+        place_bet = self.bot.place_bet
+
+        def call(i: int):
+            async def run():
+                ok, _ = await place_bet(match_id, users[i % len(users)].id, "AB"[i % 2], 10)
+                return ok
+            return run
+
+        result = await self.run_flow("place_bet", [call(i) for i in range(self.args.bets)], self.args.concurrency)
+        # total_a/total_b должны сойтись с суммой ставок при любой параллельности
+        match = self.db.find("matches", id=match_id)[0]
+        for team, column in (("A", "total_a"), ("B", "total_b")):
+            staked = sum(int(b["amount"]) for b in self.db.find("bets", match_id=match_id, team=team))
+            if staked != int(match[column]):
+                result.notes.append(f"{column}={match[column]} but bets on {team} sum to {staked}")
+        return result
+
+    async def flow_settle_bet(self) -> FlowResult:
+        amount = 10
+        matches = []
+        for _ in range(self.args.settle_matches):
+            bettors = self.seed_users(self.args.settle_bettors)
+            match_id = self.seed_match(total_a=amount * len(bettors), total_b=amount * len(bettors))
+            for member in bettors:
+                self.db.insert_row("bets", {
+                    "match_id": match_id, "user_id": str(member.id), "team": "A", "amount": amount, "created_at": int(time.time()),
+                })
+            matches.append(match_id)
+        settle_bet = self.bot.settle_bet
+
+        def call(match_id: int):
+            async def run():
+                ok, _ = await settle_bet(match_id, "A")
+                return ok
+            return run
+
+        # Расчёт — действие админа, матчи закрываются по одному
+        result = await self.run_flow("settle_bet", [call(m) for m in matches], 1)
+        paid = sum(1 for row in self.db.tables["balance_ledger"] if row.get("reason") == "bet_payout")
+        expected = self.args.settle_bettors * len(matches)
+        if paid != expected:
+            result.notes.append(f"{paid} payouts in the ledger, expected {expected}")
+        return result
+
+    async def flow_duel_cmd(self) -> FlowResult:
+        users = self.seed_users(self.args.duels * 2)
+        bot = self.bot
+        command = bot.duel_cmd
+
+        def call(creator: FakeMember, opponent: FakeMember):
+            async def run():
+                interaction = FakeInteraction(self.hub, creator, self.channel, command=command)
+                await bot.trace_interaction_check(interaction)
+                await command.callback(interaction, "1v1", 100, opponent)
+                await bot.on_app_command_completion(interaction, command)
+                duel_id = bot._open_duel_by_user.get(creator.id)
+                if duel_id is None:
+                    return False
+                invite = list(opponent.dm_channel.messages.values())[-1] if opponent.dm_channel.messages else None
+                self.duels.append({"id": duel_id, "creator": creator, "opponent": opponent, "invite": invite})
+                return True
+            return run
+
+        pairs = [(users[2 * i], users[2 * i + 1]) for i in range(self.args.duels)]
+        return await self.run_flow("duel_cmd", [call(c, o) for c, o in pairs], self.args.concurrency)
+
+    async def _press(self, interaction: FakeInteraction, duel_id: int, status: str) -> bool:
+        await self.bot.on_interaction(interaction)
+        return self.db.find("duels", id=duel_id)[0]["status"] == status
+
+    async def flow_duel_accept(self) -> FlowResult:
+        def call(duel: dict):
+            async def run():
+                opponent = duel["opponent"]
+                interaction = FakeInteraction(
+                    self.hub, opponent, opponent.dm_channel, f"duel_accept:{duel['id']}:{opponent.id}", message=duel["invite"],
+                )
+                self.accepts.append(interaction)
+                return await self._press(interaction, duel["id"], "active")
+            return run
+
+        return await self.run_flow("duel_accept", [call(d) for d in self.duels], self.args.concurrency)
+
+    async def flow_duel_accept_repeat(self) -> FlowResult:
+        def call(interaction: FakeInteraction):
+            async def run():
+                repeat = interaction.redelivered()
+                await self.bot.on_interaction(repeat)
+                return bool(repeat.replies)
+            return run
+
+        return await self.run_flow("duel_accept_repeat", [call(i) for i in list(self.accepts)], self.args.concurrency)
+
+    async def flow_settle_a(self) -> FlowResult:
+        # Скриншот результата загружен: дуэли ждут решения админа
+        active = [d for d in self.duels if self.db.find("duels", id=d["id"])[0]["status"] == "active"]
+        for duel in active:
+            self.db.find("duels", id=duel["id"])[0]["status"] = "result_pending"
+
+        def call(duel: dict):
+            async def run():
+                row = self.db.find("duels", id=duel["id"])[0]
+                message = self.channel.messages.get(int(row["message_id"])) if row.get("message_id") else None
+                interaction = FakeInteraction(self.hub, self.admin, self.channel, f"settle_a:{duel['id']}", message=message)
+                return await self._press(interaction, duel["id"], "settled")
+            return run
+
+        return await self.run_flow("settle_a", [call(d) for d in active], self.args.concurrency)
+
+
+# ---------------------- REPORT ----------------------
+def print_report(results: List[FlowResult], top: int):
+    header = f"{'flow':<20}{'calls':>7}{'ok':>7}{'wall s':>9}{'ops/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}{'db rt/call':>12}{'on loop':>9}{'discord/call':>14}{'lag max ms':>12}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        d = r.as_dict()
+        print(
+            f"{r.name:<20}{r.calls:>7}{r.ok:>7}{r.wall:>9.2f}{d['throughput_per_s'] or 0:>9.1f}{d['p50_ms']:>9.1f}{d['p99_ms']:>9.1f}{d['max_ms']:>9.1f}"
+            f"{r.per_call(sum(r.round_trips.values())):>12.2f}{r.per_call(sum(r.loop_round_trips.values())):>9.2f}"
+            f"{r.per_call(sum(r.discord_calls.values())):>14.2f}{d['loop_lag_max_ms']:>12.1f}"
+        )
+    for r in results:
+        print(f"\n{r.name}:")
+        for key, count in r.round_trips.most_common(top):
+            blocking = r.loop_round_trips.get(key, 0)
+            suffix = f"  ({blocking} on loop thread)" if blocking else ""
+            print(f"  db       {key:<40}{count:>8}  {r.per_call(count):7.2f}/call{suffix}")
+        for key, count in r.discord_calls.most_common(top):
+            print(f"  discord  {key:<40}{count:>8}  {r.per_call(count):7.2f}/call")
+        for note in r.notes:
+            print(f"  ! {note}")
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Бенчмарк бота на фейковых Discord и Supabase")
+    parser.add_argument("--flows", default=",".join(FLOWS), help=f"через запятую из: {', '.join(FLOWS)}")
+    parser.add_argument("--bets", type=int, default=10000)
+    parser.add_argument("--bet-users", type=int, default=2000, help="пользователей, между которыми делятся ставки")
+    parser.add_argument("--settle-matches", type=int, default=3)
+    parser.add_argument("--settle-bettors", type=int, default=1000, help="победивших ставок в каждом матче")
+    parser.add_argument("--duels", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных вызовов (кроме settle_bet)")
+    parser.add_argument("--db-latency-ms", type=float, default=2.0)
+    parser.add_argument("--db-jitter-ms", type=float, default=1.0)
+    parser.add_argument("--discord-latency-ms", type=float, default=20.0)
+    parser.add_argument("--outbound", action="store_true", help="запустить OutboundScheduler с лимитами маршрутов")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--top", type=int, default=8, help="строк в разбивке по запросам")
+    parser.add_argument("--json", help="записать результаты в файл")
+    args = parser.parse_args(argv)
+    selected = [f.strip() for f in args.flows.split(",") if f.strip()]
+    unknown = set(selected) - set(FLOWS)
+    if unknown:
+        parser.error(f"неизвестные flows: {', '.join(sorted(unknown))}")
+    needed = set(selected)
+    for flow in selected:
+        while flow in REQUIRES:
+            flow = REQUIRES[flow]
+            needed.add(flow)
+    args.flows = [f for f in FLOWS if f in needed]
+    return args
+
+
+def load_bot(work_dir: str):
+    """Import the bot with its files in work_dir and a placeholder Supabase URL (the client is replaced)."""
+    defaults = {
+        "SUPABASE_URL": "https://bench.supabase.co",
+        "SUPABASE_KEY": "bench.bench.bench",
+        "LOG_FILE": os.path.join(work_dir, "bot.log"),
+        "EVENTS_FILE": os.path.join(work_dir, "events.jsonl"),
+        "TRACE_DIR": os.path.join(work_dir, "traces"),
+        "PROFILE_DIR": os.path.join(work_dir, "profiles"),
+        "ARCHIVE_DIR": os.path.join(work_dir, "archive"),
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+    bot_module = importlib.import_module("discord_bet_bot_fixed")
+    # Вывод бота в консоль забил бы отчёт; запись в LOG_FILE (и её стоимость) остаётся
+    listener = bot_module.log_listener
+    listener.handlers = tuple(h for h in listener.handlers if type(h) is not logging.StreamHandler)
+    return bot_module
+
+
+async def main_async(args, bot_module) -> List[FlowResult]:
+    bench = Bench(args, bot_module)
+    await bench.setup()
+    results = []
+    try:
+        for flow in args.flows:
+            print(f"running {flow}...", file=sys.stderr)
+            results.append(await getattr(bench, f"flow_{flow}")())
+    finally:
+        await bench.teardown()
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    work_dir = tempfile.mkdtemp(prefix="bot-bench-")
+    bot_module = load_bot(work_dir)
+    results = asyncio.run(main_async(args, bot_module))
+    print_report(results, args.top)
+    print(f"\nlogs and events: {work_dir}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": {k: v for k, v in vars(args).items() if k != "json"}, "flows": [r.as_dict() for r in results]}, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,25 +1,10 @@
-import os
-import threading
-from flask import Flask
-
-app = Flask(__name__)
-
-@app.route("/")
-def home():
-    return "Bot is running! 🚀"
-
-def run_flask():
-    port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port, use_reloader=False)
-
-# Запускаем Flask в фоне
-threading.Thread(target=run_flask, daemon=True).start()
-
 import discord
 from discord.ext import commands
 import os
 from dotenv import load_dotenv
 import asyncio
+import metrics
+import memstats
 
 load_dotenv()
 
@@ -29,13 +14,31 @@ intents.members = True
 intents.voice_states = True
 intents.message_content = True  # Исправляет предупреждение в логах
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+bot = commands.Bot(command_prefix="!", intents=intents, http_trace=metrics.http_trace("discord"))
 
 CREATE_LOBBY_ID = int(os.getenv("CREATE_LOBBY_CHANNEL_ID"))
 LOBBY_CATEGORY_ID = int(os.getenv("LOBBY_CATEGORY_ID"))
 ANNOUNCE_CHANNEL_ID = int(os.getenv("ANNOUNCEMENT_CHANNEL_ID"))
 
 lobby_messages = {}  # {voice_channel_id: message_id}
+lobby_states = {}  # {voice_channel_id: (name, players)} — последнее отправленное состояние
+
+# --- МЕТРИКИ (/metrics на порту METRICS_PORT или PORT) ---
+METRICS_PORT = int(os.getenv("METRICS_PORT") or os.getenv("PORT") or 5000)
+LOBBY_EVENTS = metrics.Counter("bot_lobby_events_total", "Lobby lifecycle events", ("event",))
+LOBBY_UPDATE_SECONDS = metrics.Histogram("bot_lobby_update_seconds", "Time to refresh a lobby announcement", ("result",))
+metrics.Gauge("bot_lobbies", "Lobbies with an announcement message", fn=lambda: len(lobby_messages))
+metrics.Gauge(
+    "bot_cache_entries", "Entries in in-memory caches", ("cache",),
+    fn=lambda: {("lobby_messages",): len(lobby_messages), ("lobby_states",): len(lobby_states)},
+)
+metrics.Gauge("bot_asyncio_tasks", "Pending asyncio tasks by coroutine", ("coro",), fn=lambda: {(name,): n for name, n in memstats.task_counts().items()})
+metrics.Gauge("bot_process_rss_bytes", "Resident set size of the bot process", fn=lambda: memstats.rss_bytes() or 0)
+loop_monitor = metrics.LoopMonitor(
+    threshold=int(os.getenv("LOOP_LAG_THRESHOLD_MS", "250")) / 1000,
+    project_root=os.path.dirname(os.path.abspath(__file__)),
+)
+metrics_started = False
 
 class JoinView(discord.ui.View):
     def __init__(self, lobby_id):
@@ -60,9 +63,16 @@ async def update_message(channel: discord.VoiceChannel):
     if not channel.guild.get_channel(channel.id):
         return
 
+    names = tuple(m.display_name for m in channel.members)
+    state = (channel.name, names)
+    # Ничего видимого не изменилось — не тратим запрос на правку
+    if channel.id in lobby_messages and lobby_states.get(channel.id) == state:
+        LOBBY_EVENTS.inc(event="update_skipped")
+        return
+
     free = 5 - len(channel.members)
     color = discord.Color.green() if free > 0 else discord.Color.red()
-    players = "\n".join(f"• {m.display_name}" for m in channel.members) or "Никого нет"
+    players = "\n".join(f"• {name}" for name in names) or "Никого нет"
     status = f"Свободно: {free}/5" if free > 0 else "Заполнено"
 
     embed = discord.Embed(title=f"{channel.name}", color=color)
@@ -72,11 +82,13 @@ async def update_message(channel: discord.VoiceChannel):
     view = JoinView(channel.id) if free > 0 else None
     announce = bot.get_channel(ANNOUNCE_CHANNEL_ID)
 
+    started = asyncio.get_running_loop().time()
+    result = "error"
     try:
         if channel.id in lobby_messages:
             try:
-                msg = await announce.fetch_message(lobby_messages[channel.id])
-                await msg.edit(embed=embed, view=view)
+                # Частичное сообщение: правим без предварительного fetch
+                await announce.get_partial_message(lobby_messages[channel.id]).edit(embed=embed, view=view)
             except discord.NotFound:
                 # Если сообщение удалено ручками, отправляем новое
                 msg = await announce.send(embed=embed, view=view)
@@ -84,8 +96,12 @@ async def update_message(channel: discord.VoiceChannel):
         else:
             msg = await announce.send(embed=embed, view=view)
             lobby_messages[channel.id] = msg.id
+        lobby_states[channel.id] = state
+        result = "ok"
     except Exception as e:
         print(f"Ошибка обновления сообщения: {e}")
+    finally:
+        LOBBY_UPDATE_SECONDS.observe(asyncio.get_running_loop().time() - started, result=result)
 
 @bot.event
 async def on_interaction(interaction: discord.Interaction):
@@ -105,6 +121,7 @@ async def on_interaction(interaction: discord.Interaction):
         return await interaction.response.send_message("Лобби уже заполнено!", ephemeral=True)
 
     await interaction.response.defer(ephemeral=True)
+    LOBBY_EVENTS.inc(event="join_button")
 
     try:
         if interaction.user.voice:
@@ -136,6 +153,7 @@ async def on_voice_state_update(member, before, after):
                 name=f"Лобби #{num}",
                 user_limit=5
             )
+            LOBBY_EVENTS.inc(event="created")
             await join_lobby(member, lobby)
             await update_message(lobby)
         except Exception as e:
@@ -152,8 +170,7 @@ async def on_voice_state_update(member, before, after):
             if before.channel.id in lobby_messages:
                 try:
                     msg_id = lobby_messages[before.channel.id]
-                    msg = await bot.get_channel(ANNOUNCE_CHANNEL_ID).fetch_message(msg_id)
-                    await msg.delete()
+                    await bot.get_channel(ANNOUNCE_CHANNEL_ID).get_partial_message(msg_id).delete()
                 except discord.NotFound:
                     pass # Сообщение уже удалено
                 except Exception as e:
@@ -161,10 +178,12 @@ async def on_voice_state_update(member, before, after):
                 finally:
                     if before.channel.id in lobby_messages:
                         del lobby_messages[before.channel.id]
+                    lobby_states.pop(before.channel.id, None)
             
             # Удаляем сам канал (с защитой от ошибки 404)
             try:
                 await before.channel.delete()
+                LOBBY_EVENTS.inc(event="deleted")
             except discord.NotFound:
                 pass # Канал уже удален (например, другим событием)
             except Exception as e:
@@ -177,7 +196,13 @@ async def on_voice_state_update(member, before, after):
 
 @bot.event
 async def on_ready():
+    global metrics_started
     print(f"Бот {bot.user} запущен и работает!")
+    # on_ready повторяется при переподключениях — сервер метрик поднимаем один раз
+    if not metrics_started:
+        metrics_started = True
+        loop_monitor.start()
+        await metrics.start_metrics_server("0.0.0.0", METRICS_PORT, "Bot is running! 🚀")
     category = bot.get_channel(LOBBY_CATEGORY_ID)
     if category:
         for ch in category.voice_channels:
@@ -1,51 +1,140 @@
-import os
-import threading
-from flask import Flask
-
-app = Flask(__name__)
-
-@app.route("/")
-def home():
-    return "Bot is running!"
-
-def run_flask():
-    port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port)
-
-threading.Thread(target=run_flask).start()
-
 import os
 import time
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, Dict, Set, Callable, Awaitable, NamedTuple
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands
 from supabase import create_client, Client
 import logging
+import logging.handlers
+import queue
+import atexit
+import tracemalloc
 import asyncio
 from dotenv import load_dotenv
-from functools import wraps
+from functools import wraps, lru_cache
+from collections import OrderedDict
 from discord.ui import View, Button, Modal, TextInput
 import random
+import itertools
+import gzip
+import copy
+import json
+import uuid
 import aiohttp
 import re
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger(__name__)
-
+import metrics
+import tracing
+import profiler
+import memstats
 # Explicitly load .env file from the script's directory
+# (до чтения настроек логирования: LOG_* и EVENTS_* тоже могут быть в .env)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 dotenv_path = os.path.join(BASE_DIR, '.env')
+dotenv_loaded = os.path.exists(dotenv_path) and load_dotenv(dotenv_path)
+
+# Set up logging
+# Обработчики пишут на диск в отдельном потоке QueueListener; event loop только кладёт запись в очередь
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")  # "bot.router=DEBUG,discord=WARNING"
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+LOG_SAMPLED = [name for name in os.getenv("LOG_SAMPLED", "bot.router,bot.render,bot.balance").split(",") if name]
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.05"))
+
+
+class SamplingFilter(logging.Filter):
+    """Let through only a fraction of DEBUG records from high-frequency subsystems."""
+
+    def __init__(self, prefixes: List[str], rate: float):
+        super().__init__()
+        self.prefixes = tuple(prefixes)
+        self.rate = rate
 
-if os.path.exists(dotenv_path):
-    load_dotenv(dotenv_path)
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or not record.name.startswith(self.prefixes):
+            return True
+        return random.random() < self.rate
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+    )
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLED, LOG_DEBUG_SAMPLE_RATE))
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    for item in LOG_LEVELS.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # stop() дописывает всё, что осталось в очереди
+    return listener
+
+
+log_listener = setup_logging()
+logger = logging.getLogger("bot")
+# Подсистемы с частыми записями: уровень и выборка настраиваются через LOG_LEVELS / LOG_SAMPLED
+router_log = logging.getLogger("bot.router")
+render_log = logging.getLogger("bot.render")
+balance_log = logging.getLogger("bot.balance")
+
+# ---------------------- EVENT LOG ----------------------
+# Денежные движения и переходы статусов — JSON-строками в отдельный файл (см. events_cli.py)
+EVENTS_FILE = os.getenv("EVENTS_FILE", "events.jsonl")
+EVENTS_MAX_BYTES = int(os.getenv("EVENTS_MAX_BYTES", str(50 * 1024 * 1024)))
+EVENTS_BACKUP_COUNT = int(os.getenv("EVENTS_BACKUP_COUNT", "10"))
+
+
+class JsonEventFormatter(logging.Formatter):
+    """One JSON object per line; serialised in the listener thread, not on the event loop."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {"ts": round(record.created, 3), "event": record.getMessage()}
+        payload.update(getattr(record, "fields", {}))
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+def setup_event_log() -> logging.Logger:
+    handler = logging.handlers.RotatingFileHandler(
+        EVENTS_FILE, maxBytes=EVENTS_MAX_BYTES, backupCount=EVENTS_BACKUP_COUNT, encoding="utf-8"
+    )
+    handler.setFormatter(JsonEventFormatter())
+    event_queue = queue.SimpleQueue()
+    events = logging.getLogger("bot.events")
+    events.propagate = False  # события не дублируются в bot.log
+    events.setLevel(logging.INFO)
+    events.handlers[:] = [logging.handlers.QueueHandler(event_queue)]
+    listener = logging.handlers.QueueListener(event_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return events
+
+
+events_log = setup_event_log()
+
+
+def emit_event(event: str, **fields):
+    """Append a structured event (ids, amounts, latency_ms) to the event log."""
+    events_log.info(event, extra={"fields": fields})
+
+
+def elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
+
+if dotenv_loaded:
     logger.info(f".env loaded from {dotenv_path}")
 else:
     logger.warning(f".env file not found at {dotenv_path}. Relying on environment variables.")
@@ -56,6 +145,7 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 DEFAULT_BURN = float(os.getenv("DEFAULT_BURN", "0.25"))
 TEAM_ANNOUNCEMENT_CHANNEL = os.getenv("TEAM_ANNOUNCEMENT_CHANNEL")
+ROLE_RECONCILE_ON_STARTUP = os.getenv("ROLE_RECONCILE_ON_STARTUP", "1") == "1"
 
 # Добавь проверки без exit — пусть бот запустится, но выдаст ошибку в логах
 if not DISCORD_BOT_TOKEN:
@@ -71,8 +161,111 @@ supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 INTENTS = discord.Intents.default()
 INTENTS.message_content = False
 INTENTS.members = True
-bot = commands.Bot(command_prefix="!", intents=INTENTS)
-balance_lock = asyncio.Lock()
+bot = commands.Bot(
+    command_prefix="!", intents=INTENTS,
+    http_trace=tracing.add_http_spans(metrics.http_trace("discord"), "discord"),
+)
+balance_lock = tracing.TracedLock("balance")
+
+# ---------------------- METRICS ----------------------
+# /metrics отдаётся aiohttp-сервером в том же event loop (порт METRICS_PORT или PORT)
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT") or os.getenv("PORT") or 5000)
+
+SLASH_COMMANDS = metrics.Counter("bot_slash_commands_total", "Slash command invocations", ("command", "status"))
+SLASH_SECONDS = metrics.Histogram("bot_slash_command_seconds", "Slash command latency from interaction creation", ("command",))
+BUTTON_ROUTES_TOTAL = metrics.Counter("bot_button_routes_total", "Button route invocations", ("route",))
+BUTTON_ROUTE_SECONDS = metrics.Histogram("bot_button_route_seconds", "Button route handler latency", ("route",))
+OPENDOTA_TRACE = tracing.add_http_spans(metrics.http_trace("opendota"), "opendota")
+# Сторож event loop: задержка heartbeat'а и стек того, что блокирует цикл дольше порога
+loop_monitor = metrics.LoopMonitor(
+    threshold=int(os.getenv("LOOP_LAG_THRESHOLD_MS", "250")) / 1000,
+    interval=int(os.getenv("LOOP_LAG_INTERVAL_MS", "100")) / 1000,
+    project_root=BASE_DIR,
+)
+
+_POSTGREST_OPS = {"GET": "select", "HEAD": "count", "POST": "insert", "PATCH": "update", "DELETE": "delete"}
+
+
+def _supabase_label(request) -> Tuple[str, str]:
+    """(operation, table) of a PostgREST request; RPCs are labelled rpc/<function>."""
+    path = request.url.path.split("/rest/v1/", 1)[-1]
+    if path.startswith("rpc/"):
+        return "rpc", path[len("rpc/"):]
+    op = _POSTGREST_OPS.get(request.method, request.method)
+    if op == "insert" and "resolution=" in request.headers.get("prefer", ""):
+        op = "upsert"
+    return op, path
+
+
+try:
+    metrics.instrument_httpx(supabase.postgrest.session, "supabase", _supabase_label)
+    tracing.add_httpx_spans(supabase.postgrest.session, "supabase", _supabase_label)
+except Exception as e:
+    logger.warning(f"Supabase metrics disabled: {e}")
+
+# Трассы медленнее TRACE_SLOW_MS пишутся в TRACE_DIR в формате Chrome trace (chrome://tracing, Perfetto)
+TRACE_SLOW_MS = int(os.getenv("TRACE_SLOW_MS", "2000"))
+TRACE_DIR = os.getenv("TRACE_DIR", os.path.join(BASE_DIR, "traces"))
+tracer = tracing.Tracer(TRACE_DIR, TRACE_SLOW_MS / 1000)
+_open_traces: "OrderedDict[int, tracing.Trace]" = OrderedDict()  # {interaction_id: trace} для слэш-команд
+OPEN_TRACES_LIMIT = 1024
+
+# /profiler: сэмплирование стека цикла или cProfile на время либо на N вызовов команды
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(BASE_DIR, "profiles"))
+live_profiler = profiler.Profiler(PROFILE_DIR, int(os.getenv("PROFILER_INTERVAL_MS", "5")) / 1000)
+
+
+def _slash_command_name(interaction: discord.Interaction) -> str:
+    command = interaction.command
+    return command.qualified_name if command else "unknown"
+
+
+def _interaction_age(interaction: discord.Interaction) -> float:
+    return (discord.utils.utcnow() - interaction.created_at).total_seconds()
+
+
+async def trace_interaction_check(interaction: discord.Interaction) -> bool:
+    """Open the root span of a slash command; it is closed on completion or error."""
+    if interaction.type != discord.InteractionType.application_command:
+        return True  # автодополнение не завершается событием completion
+    name = f"/{_slash_command_name(interaction)}"
+    _open_traces[interaction.id] = tracer.start(name, user_id=str(interaction.user.id))
+    live_profiler.enter(name)
+    while len(_open_traces) > OPEN_TRACES_LIMIT:
+        _, evicted = _open_traces.popitem(last=False)
+        _close_trace(evicted, "evicted")
+    return True
+
+
+bot.tree.interaction_check = trace_interaction_check
+
+
+def _close_trace(trace: tracing.Trace, status: str):
+    tracer.finish(trace, status=status)
+    live_profiler.exit(trace.name)
+
+
+def finish_interaction_trace(interaction: discord.Interaction, status: str):
+    trace = _open_traces.pop(interaction.id, None)
+    if trace is not None:
+        _close_trace(trace, status)
+
+
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    SLASH_COMMANDS.inc(command=command.qualified_name, status="ok")
+    SLASH_SECONDS.observe(_interaction_age(interaction), command=command.qualified_name)
+    finish_interaction_trace(interaction, "ok")
+
+
+@bot.tree.error
+async def on_app_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+    SLASH_COMMANDS.inc(command=_slash_command_name(interaction), status=type(error).__name__)
+    SLASH_SECONDS.observe(_interaction_age(interaction), command=_slash_command_name(interaction))
+    finish_interaction_trace(interaction, type(error).__name__)
+    # Дальше — стандартная обработка discord.py (лог с трейсбеком)
+    await app_commands.CommandTree.on_error(bot.tree, interaction, error)
 
 def safe_int(value, min_value=0, max_value=2**63 - 1):
     try:
@@ -98,6 +291,231 @@ def admin_only(func):
         return await func(interaction, *args, **kwargs)
     return wrapper
 
+# ---------------------- OUTBOUND SCHEDULER ----------------------
+
+# Все исходящие REST-вызовы «второго плана» (DM, правки embed, роли) идут через
+# одну очередь с приоритетами. Лимиты по маршрутам отслеживаются заранее
+# (token bucket), повторные правки одного сообщения склеиваются, а 429
+# блокирует маршрут на retry_after. Ответы на взаимодействия (interaction.response /
+# followup) идут мимо очереди и поэтому всегда опережают косметические правки.
+PRIORITY_MESSAGE = 0  # DM и сообщения в канал, которые ждёт пользователь
+PRIORITY_ROLE = 1     # выдача/снятие ролей
+PRIORITY_EDIT = 2     # косметические правки embed/кнопок
+
+# {вид маршрута: (ёмкость, период в секундах)}
+ROUTE_LIMITS: Dict[str, Tuple[int, float]] = {
+    "channel": (5, 5.0),
+    "dm": (5, 5.0),
+    "roles": (10, 10.0),
+    "global": (45, 1.0),
+}
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", "4"))
+OUTBOUND_MAX_RETRIES = 3
+OUTBOUND_MAX_BUCKETS = 4096
+
+
+class _Bucket:
+    __slots__ = ("capacity", "rate", "tokens", "updated", "blocked_until")
+
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available (0 if one is available now)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+
+class _OutboundJob:
+    __slots__ = ("route", "factory", "future", "attempts", "edit_key", "edit_kwargs", "state")
+
+    def __init__(self, route: str, factory: Optional[Callable[[], Awaitable]], future: asyncio.Future):
+        self.route = route
+        self.factory = factory
+        self.future = future
+        self.attempts = 0
+        self.edit_key: Optional[int] = None
+        self.edit_kwargs: dict = {}
+        self.state: Optional[tuple] = None
+
+
+class OutboundScheduler:
+    """Priority queue of outbound Discord REST calls with per-route buckets."""
+
+    def __init__(self, workers: int = OUTBOUND_WORKERS):
+        self._workers_count = workers
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._seq = itertools.count()
+        self._buckets: Dict[str, _Bucket] = {}
+        self._pending_edits: Dict[int, _OutboundJob] = {}  # {message_id: job}
+        self._workers: List[asyncio.Task] = []
+        self.delayed = 0  # задания, ждущие call_later перед возвратом в очередь
+
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+
+    def start(self):
+        if self._workers:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self._workers_count)]
+
+    def _bucket(self, route: str) -> _Bucket:
+        bucket = self._buckets.get(route)
+        if bucket is None:
+            if len(self._buckets) >= OUTBOUND_MAX_BUCKETS:
+                self._prune_buckets()
+            capacity, period = ROUTE_LIMITS[route.split(":", 1)[0]]
+            bucket = self._buckets[route] = _Bucket(capacity, period)
+        return bucket
+
+    def _prune_buckets(self):
+        """Drop buckets that have fully refilled (DM routes accumulate one per user)."""
+        now = time.monotonic()
+        for route, bucket in list(self._buckets.items()):
+            if route != "global" and bucket.delay(now) == 0 and bucket.tokens >= bucket.capacity:
+                del self._buckets[route]
+
+    def _put(self, priority: int, job: _OutboundJob, delay: float = 0.0):
+        entry = (priority, next(self._seq), job)
+        if delay > 0:
+            self.delayed += 1
+            asyncio.get_running_loop().call_later(delay, self._requeue, entry)
+        else:
+            self._queue.put_nowait(entry)
+
+    def _requeue(self, entry):
+        self.delayed -= 1
+        self._queue.put_nowait(entry)
+
+    def queued(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def pending_edits(self) -> int:
+        return len(self._pending_edits)
+
+    async def submit(self, route: str, factory: Callable[[], Awaitable], priority: int = PRIORITY_MESSAGE):
+        """Run factory() once the route allows it; returns its result or raises its exception."""
+        if not self.running:
+            return await factory()
+        job = _OutboundJob(route, factory, asyncio.get_running_loop().create_future())
+        self._put(priority, job)
+        with tracing.span("outbound", route=route, priority=priority):
+            return await job.future
+
+    def edit_pending(self, message_id: int) -> bool:
+        return message_id in self._pending_edits
+
+    async def edit(self, message, priority: int = PRIORITY_EDIT, state: Optional[tuple] = None, **kwargs):
+        """Queue message.edit(**kwargs); edits of the same message that are still queued are merged."""
+        if not self.running:
+            result = await message.edit(**kwargs)
+            if state is not None:
+                remember_sent_state(message.id, state)
+            return result
+        job = self._pending_edits.get(message.id)
+        if job is not None:
+            job.edit_kwargs.update(kwargs)
+            if state is not None:
+                job.state = state
+            return await job.future
+        job = _OutboundJob(route_for(message.channel), None, asyncio.get_running_loop().create_future())
+        job.edit_key = message.id
+        job.edit_kwargs = dict(kwargs)
+        job.state = state
+        job.factory = lambda: message.edit(**job.edit_kwargs)
+        self._pending_edits[message.id] = job
+        self._put(priority, job)
+        with tracing.span("outbound.edit", route=job.route):
+            return await job.future
+
+    async def _worker(self):
+        while True:
+            priority, _, job = await self._queue.get()
+            try:
+                await self._run(priority, job)
+            except Exception as e:
+                logger.error(f"Outbound worker error on {job.route}: {e}")
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, priority: int, job: _OutboundJob):
+        now = time.monotonic()
+        route_bucket = self._bucket(job.route)
+        global_bucket = self._bucket("global")
+        wait = max(route_bucket.delay(now), global_bucket.delay(now))
+        if wait > 0:
+            # Не держим воркер: задача вернётся в очередь, когда маршрут освободится
+            self._put(priority, job, wait)
+            return
+        route_bucket.take()
+        global_bucket.take()
+
+        if job.edit_key is not None and self._pending_edits.get(job.edit_key) is job:
+            # С этого момента новые правки того же сообщения ставятся отдельно
+            del self._pending_edits[job.edit_key]
+        try:
+            result = await job.factory()
+        except discord.HTTPException as e:
+            if e.status == 429 and job.attempts < OUTBOUND_MAX_RETRIES:
+                retry_after = float(getattr(e, "retry_after", 1.0) or 1.0)
+                route_bucket.block(retry_after)
+                job.attempts += 1
+                logger.warning(f"Rate limited on {job.route}, retrying in {retry_after:.1f}s (attempt {job.attempts})")
+                self._put(priority, job, retry_after)
+                return
+            if not job.future.done():
+                job.future.set_exception(e)
+            return
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+            return
+        if job.edit_key is not None and job.state is not None:
+            remember_sent_state(job.edit_key, job.state)
+        if not job.future.done():
+            job.future.set_result(result)
+
+
+def route_for(target) -> str:
+    """Rate-limit route for a send/edit target."""
+    if isinstance(target, (discord.User, discord.Member)):
+        return f"dm:{target.id}"
+    if isinstance(target, discord.DMChannel):
+        return f"dm:{target.recipient.id if target.recipient else target.id}"
+    return f"channel:{getattr(target, 'id', 0)}"
+
+
+outbound = OutboundScheduler()
+
+
+async def queue_role_change(member: discord.Member, add: Optional[discord.Role] = None, remove: Optional[discord.Role] = None):
+    """Add or remove a role through the scheduler (guild roles share one route)."""
+    if add is not None:
+        return await outbound.submit(f"roles:{member.guild.id}", lambda: member.add_roles(add), PRIORITY_ROLE)
+    if remove is not None:
+        return await outbound.submit(f"roles:{member.guild.id}", lambda: member.remove_roles(remove), PRIORITY_ROLE)
+
+
 # ---------------------- DB HELPERS ----------------------
 
 def get_rank_emoji(mmr: int) -> str:
@@ -172,7 +590,7 @@ async def get_rank_tier_from_steamid(steam_id: str) -> Optional[int]:
         if account_id <= 0:
             return None
         
-        async with aiohttp.ClientSession() as session:
+        async with aiohttp.ClientSession(trace_configs=[OPENDOTA_TRACE]) as session:
             async with session.get(f"https://api.opendota.com/api/players/{account_id}") as resp:
                 if resp.status != 200:
                     return None
@@ -214,7 +632,7 @@ async def get_mmr_from_steamid(steam_input: str, user_id: Optional[int] = None)
             logger.warning(f"Invalid account_id: {account_id} from {steam_id}")
             return None
         
-        async with aiohttp.ClientSession() as session:
+        async with aiohttp.ClientSession(trace_configs=[OPENDOTA_TRACE]) as session:
             async with session.get(f"https://api.opendota.com/api/players/{account_id}") as resp:
                 if resp.status != 200:
                     logger.warning(f"API error {resp.status} for account {account_id}")
@@ -304,26 +722,107 @@ async def get_free_dota_account() -> Optional[int]:
         logger.error(f"Error getting free account: {e}")
         return None
 
-async def remove_team_role_from_all(guild: discord.Guild, team_name: str):
-    """Снять роль у всех участников и удалить её"""
+class RoleSyncResult(NamedTuple):
+    added: int
+    removed: int
+    failed: int
+    deleted: bool
+
+
+def team_member_ids(team: dict) -> Set[int]:
+    """Discord ids that should hold the team role: leader plus filled slots."""
+    ids = {int(team[f"player{i}_id"]) for i in range(1, 6) if team.get(f"player{i}_id")}
+    if team.get("leader_id"):
+        ids.add(int(team["leader_id"]))
+    return ids
+
+
+async def sync_team_role(guild: discord.Guild, team_name: str, desired_ids: Set[int], delete_if_empty: bool = False) -> RoleSyncResult:
+    """Bring role membership to desired_ids with the minimal set of add/remove calls.
+
+    Changes are issued concurrently; the outbound scheduler paces them on the
+    guild's role route. Members that are not in the guild are skipped.
+    """
     role = discord.utils.get(guild.roles, name=team_name)
-    if role:
-        for member in role.members:
-            try:
-                await member.remove_roles(role)
-            except discord.Forbidden:
-                print(f"⚠️ Не могу убрать роль {team_name} у {member}")
+    if role is None:
+        if not desired_ids:
+            return RoleSyncResult(0, 0, 0, False)
+        role = await ensure_team_role(guild, team_name)
+        if role is None:
+            return RoleSyncResult(0, 0, len(desired_ids), False)
+
+    holders = list(role.members)
+    current = {m.id for m in holders}
+    to_add = [m for m in (guild.get_member(uid) for uid in desired_ids - current) if m is not None]
+    to_remove = [m for m in holders if m.id not in desired_ids]
+
+    results = await asyncio.gather(
+        *(queue_role_change(m, add=role) for m in to_add),
+        *(queue_role_change(m, remove=role) for m in to_remove),
+        return_exceptions=True
+    )
+    failed = 0
+    for member, result in zip(to_add + to_remove, results):
+        if isinstance(result, Exception):
+            failed += 1
+            logger.warning("Failed to update role %s for %s: %s", team_name, member, result)
+
+    deleted = False
+    if delete_if_empty and not desired_ids:
         try:
-            await role.delete(reason="Удаление команды")
+            await outbound.submit(f"roles:{guild.id}", lambda: role.delete(reason="Удаление команды"), PRIORITY_ROLE)
+            deleted = True
         except discord.Forbidden:
-            print(f"⚠️ Нет прав на удаление роли {team_name}")
+            logger.warning("No permission to delete role %s in guild %s", team_name, guild.id)
+        except discord.HTTPException as e:
+            logger.exception("Failed to delete role %s in guild %s: %s", team_name, guild.id, e)
+    return RoleSyncResult(len(to_add), len(to_remove), failed, deleted)
+
+
+async def reconcile_team_roles(guild: discord.Guild) -> RoleSyncResult:
+    """Startup pass: sync every team role of the guild with the teams table."""
+    response = await asyncio.to_thread(
+        supabase.table("teams")
+        .select("name,leader_id,player1_id,player2_id,player3_id,player4_id,player5_id")
+        .eq("guild_id", str(guild.id))
+        .execute
+    )
+    results = await asyncio.gather(
+        *(sync_team_role(guild, team["name"], team_member_ids(team)) for team in response.data or []),
+        return_exceptions=True
+    )
+    added = removed = failed = 0
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Role sync failed in guild {guild.id}: {result}")
+            failed += 1
+            continue
+        added += result.added
+        removed += result.removed
+        failed += result.failed
+    logger.info(f"Reconciled team roles in guild {guild.id}: +{added} -{removed}, {failed} failed")
+    return RoleSyncResult(added, removed, failed, False)
+
+
+async def reconcile_all_team_roles():
+    for guild in bot.guilds:
+        try:
+            await reconcile_team_roles(guild)
+        except Exception as e:
+            logger.error(f"Failed to reconcile team roles in guild {guild.id}: {e}")
+
+
+async def remove_team_role_from_all(guild: discord.Guild, team_name: str):
+    """Снять роль у всех участников и удалить её"""
+    await sync_team_role(guild, team_name, set(), delete_if_empty=True)
+
 async def remove_team_role(guild, member, team_name):
     role = discord.utils.get(guild.roles, name=team_name)
     if role is None:
         print(f"Role {team_name} not found in guild {guild.name}")
         return
     try:
-        await member.remove_roles(role)
+        await queue_role_change(member, remove=role)
         print(f"Removed role {team_name} from {member.id}")
     except discord.Forbidden:
         print(f"Bot lacks permissions to remove role {team_name} from {member.id}")
@@ -336,7 +835,9 @@ async def ensure_team_role(guild: discord.Guild, team_name: str) -> discord.Role
     if not role:
         rand_color = discord.Color(random.randint(0x000000, 0xFFFFFF))
         try:
-            role = await guild.create_role(name=team_name, colour=rand_color, hoist=True)
+            role = await outbound.submit(
+                f"roles:{guild.id}", lambda: guild.create_role(name=team_name, colour=rand_color, hoist=True), PRIORITY_ROLE
+            )
         except discord.Forbidden:
             print(f"⚠️ Нет прав на создание роли {team_name}")
             return None
@@ -347,7 +848,7 @@ async def assign_team_role(guild, member, team_name):
     role = discord.utils.get(guild.roles, name=team_name)
     if role:
         try:
-            await member.add_roles(role)
+            await queue_role_change(member, add=role)
             print(f"Assigned role {team_name} to {member.id}")
         except discord.Forbidden:
             print("Bot lacks permissions to assign roles")
@@ -381,31 +882,320 @@ async def ensure_user(user_id: int, name: str = None):
         logger.error(f"Error ensuring user {user_id}: {e}")
         raise
 
-async def get_balance(user_id: int) -> int:
-    """Get the balance of a user."""
+# ---------------------- BALANCE LEDGER ----------------------
+
+# Каждое изменение баланса — запись в balance_ledger (append-only) с причиной,
+# ссылкой на объект и ключом идемпотентности. Записи копятся в буфере и
+# пишутся пачкой RPC apply_ledger_batch, которая в той же транзакции обновляет
+# users.balance. В памяти держится проекция: баланс из БД + ещё не записанные
+# дельты. Повтор с тем же ключом (повторный расчёт/возврат) не применяется.
+LEDGER_FLUSH_SECONDS = float(os.getenv("LEDGER_FLUSH_SECONDS", "1"))
+LEDGER_RECENT_KEYS = 10000
+_balance_cache: Dict[int, int] = {}
+_ledger_buffer: List[dict] = []
+_ledger_recent_keys: "OrderedDict[str, None]" = OrderedDict()
+_ledger_flush_lock = tracing.TracedLock("ledger_flush")
+
+
+def _remember_ledger_key(key: str) -> bool:
+    """False if the key was already used in this process."""
+    if key in _ledger_recent_keys:
+        return False
+    _ledger_recent_keys[key] = None
+    while len(_ledger_recent_keys) > LEDGER_RECENT_KEYS:
+        _ledger_recent_keys.popitem(last=False)
+    return True
+
+
+async def _load_balance(user_id: int) -> int:
+    response = await asyncio.to_thread(
+        supabase.table("users").select("balance").eq("user_id", str(user_id)).execute
+    )
+    if response.data:
+        return int(response.data[0]["balance"])
     await ensure_user(user_id)
+    return 0
+
+
+async def get_balance(user_id: int) -> int:
+    """Get the balance of a user (creates the user row on first access)."""
+    user_id = int(user_id)
+    cached = _balance_cache.get(user_id)
+    if cached is not None:
+        return cached
     try:
-        response = await asyncio.to_thread(
-            supabase.table("users").select("balance").eq("user_id", str(user_id)).execute
-        )
-        return int(response.data[0]["balance"]) if response.data else 0
+        balance = await _load_balance(user_id)
     except Exception as e:
         logger.error(f"Error getting balance for user {user_id}: {e}")
         raise
-
-async def add_balance(user_id: int, delta: int):
+    # Пока шёл запрос, проекцию могла заполнить add_balance — она главнее
+    return _balance_cache.setdefault(user_id, balance)
+
+
+def _record_ledger_entry(user_id: int, delta: int, reason: str, ref_type: Optional[str], ref_id, idempotency_key: str):
+    _balance_cache[user_id] = _balance_cache.get(user_id, 0) + delta
+    _ledger_buffer.append({
+        "user_id": str(user_id),
+        "delta": delta,
+        "reason": reason,
+        "ref_type": ref_type,
+        "ref_id": str(ref_id) if ref_id is not None else None,
+        "idempotency_key": idempotency_key,
+    })
+
+
+async def add_balance(user_id: int, delta: int, reason: str = "adjust", ref_type: Optional[str] = None, ref_id=None, idempotency_key: Optional[str] = None) -> bool:
+    """Record a balance change in the ledger. Returns False if idempotency_key was already applied."""
+    user_id = int(user_id)
+    key = idempotency_key or f"{reason}:{uuid.uuid4().hex}"
     async with balance_lock:
-        await ensure_user(user_id)
+        if not _remember_ledger_key(key):
+            balance_log.debug("Ledger entry %s already applied, skipping", key)
+            return False
         try:
             current_balance = await get_balance(user_id)
-            new_balance = current_balance + int(delta)
-            await asyncio.to_thread(
-                supabase.table("users").update({"balance": new_balance}).eq("user_id", str(user_id)).execute
+        except Exception:
+            _ledger_recent_keys.pop(key, None)
+            raise
+        _record_ledger_entry(user_id, int(delta), reason, ref_type, ref_id, key)
+        balance_log.info("Balance updated for user %s: %s -> %s (%s)", user_id, current_balance, current_balance + int(delta), reason)
+    return True
+
+
+async def debit_balance(user_id: int, amount: int, reason: str, ref_type: Optional[str] = None, ref_id=None, idempotency_key: Optional[str] = None) -> Tuple[bool, int]:
+    """Atomically check and debit `amount` from the available balance. Returns (debited, available before)."""
+    user_id = int(user_id)
+    key = idempotency_key or f"{reason}:{uuid.uuid4().hex}"
+    async with balance_lock:
+        current_balance = await get_balance(user_id) - _held.get(user_id, 0)
+        if current_balance < amount or not _remember_ledger_key(key):
+            return False, current_balance
+        _record_ledger_entry(user_id, -int(amount), reason, ref_type, ref_id, key)
+        balance_log.info("Balance updated for user %s: %s -> %s (%s)", user_id, current_balance, current_balance - int(amount), reason)
+    return True, current_balance
+
+
+def _write_ledger_batch(batch: List[dict]) -> List[dict]:
+    return supabase.rpc("apply_ledger_batch", {"p_entries": batch}).execute().data or []
+
+
+async def flush_ledger_now():
+    """Write buffered ledger entries in one RPC and reconcile the projection with the DB."""
+    async with _ledger_flush_lock:
+        if not _ledger_buffer:
+            return
+        batch = list(_ledger_buffer)
+        _ledger_buffer.clear()
+        try:
+            applied = await asyncio.to_thread(_write_ledger_batch, batch)
+        except Exception as e:
+            logger.error(f"Error flushing {len(batch)} ledger entries: {e}")
+            _ledger_buffer[:0] = batch
+            return
+
+        applied_keys = {row["idempotency_key"] for row in applied}
+        for entry in batch:
+            if entry["idempotency_key"] not in applied_keys:
+                # Ключ уже был в БД (например, до перезапуска): дельту не применяем
+                logger.warning(f"Ledger entry {entry['idempotency_key']} was a duplicate, reverting")
+                _balance_cache[int(entry["user_id"])] -= entry["delta"]
+
+        _rebase_balances(applied)
+
+
+def _rebase_balances(rows: List[dict]):
+    """Set the projection to DB balance + entries still waiting in the buffer."""
+    pending: Dict[int, int] = {}
+    for entry in _ledger_buffer:
+        pending[int(entry["user_id"])] = pending.get(int(entry["user_id"]), 0) + entry["delta"]
+    for row in rows:
+        uid = int(row["user_id"])
+        _balance_cache[uid] = int(row["balance"]) + pending.get(uid, 0)
+
+
+@tasks.loop(seconds=LEDGER_FLUSH_SECONDS)
+async def flush_ledger():
+    await flush_ledger_now()
+
+
+async def get_ledger_history(user_id: int, limit: int = 10) -> List[dict]:
+    await flush_ledger_now()
+    response = await asyncio.to_thread(
+        supabase.table("balance_ledger")
+        .select("delta,reason,ref_type,ref_id,created_at")
+        .eq("user_id", str(user_id))
+        .order("id", desc=True)
+        .limit(limit)
+        .execute
+    )
+    return response.data or []
+
+# ---------------------- ESCROW HOLDS ----------------------
+
+# Ставка дуэли не списывается сразу, а резервируется холдом (balance_holds,
+# один на дуэль и участника). Отмена снимает холды одним условным UPDATE,
+# расчёт захватывает их в выплату через RPC settle_duel_with_holds. Доступный
+# баланс = баланс − активные холды; суммы холдов по пользователям держим в памяти.
+_held: Dict[int, int] = {}  # {user_id: сумма активных холдов}
+
+
+async def load_holds():
+    response = await asyncio.to_thread(
+        supabase.table("balance_holds").select("user_id,amount").eq("status", "held").execute
+    )
+    _held.clear()
+    for row in response.data or []:
+        uid = int(row["user_id"])
+        _held[uid] = _held.get(uid, 0) + int(row["amount"])
+    logger.info(f"Loaded active holds for {len(_held)} users")
+
+
+def _release_held(user_id: int, amount: int):
+    left = _held.get(user_id, 0) - amount
+    if left > 0:
+        _held[user_id] = left
+    else:
+        _held.pop(user_id, None)
+
+
+async def get_available_balance(user_id: int) -> int:
+    """Balance minus points reserved by active holds."""
+    return await get_balance(user_id) - _held.get(int(user_id), 0)
+
+
+async def hold_stake(duel_id: int, user_id: int, amount: int) -> bool:
+    """Reserve `amount` for the duel. False if the available balance is too low or the hold was already released/captured."""
+    user_id = int(user_id)
+    async with balance_lock:
+        available = await get_balance(user_id) - _held.get(user_id, 0)
+        if available < amount:
+            return False
+        response = await asyncio.to_thread(
+            supabase.table("balance_holds").upsert({
+                "user_id": str(user_id),
+                "amount": int(amount),
+                "ref_type": "duel",
+                "ref_id": str(duel_id),
+            }, on_conflict="ref_type,ref_id,user_id", ignore_duplicates=True).execute
+        )
+        # Пустой ответ — строка уже есть (повторный вызов): второй раз не резервируем,
+        # но снятый или захваченный холд резервом не считается
+        if response.data:
+            _held[user_id] = _held.get(user_id, 0) + int(amount)
+        else:
+            existing = await asyncio.to_thread(
+                supabase.table("balance_holds").select("status")
+                .eq("ref_type", "duel").eq("ref_id", str(duel_id)).eq("user_id", str(user_id)).execute
             )
-            logger.info(f"Balance updated for user {user_id}: {current_balance} -> {new_balance}")
+            if not existing.data or existing.data[0]["status"] != "held":
+                return False
+    balance_log.info("Hold %s for user %s on duel %s", amount, user_id, duel_id)
+    return True
+
+
+async def release_holds_for_duels(duel_ids: List[int]) -> Dict[int, int]:
+    """Release every active hold of the given duels in one UPDATE; returns {duel_id: released total}."""
+    if not duel_ids:
+        return {}
+    response = await asyncio.to_thread(
+        supabase.table("balance_holds")
+        .update({"status": "released", "settled_at": discord.utils.utcnow().isoformat()})
+        .eq("ref_type", "duel").in_("ref_id", [str(d) for d in duel_ids]).eq("status", "held")
+        .execute
+    )
+    released: Dict[int, int] = {}
+    async with balance_lock:
+        for row in response.data or []:
+            _release_held(int(row["user_id"]), int(row["amount"]))
+            released[int(row["ref_id"])] = released.get(int(row["ref_id"]), 0) + int(row["amount"])
+    return released
+
+
+async def release_duel_holds(duel_id: int) -> int:
+    """Release every active hold of the duel; returns the released total (0 if nothing was held)."""
+    released = (await release_holds_for_duels([duel_id])).get(int(duel_id), 0)
+    if released:
+        balance_log.info("Released holds on duel %s: %s", duel_id, released)
+    return released
+
+
+async def release_user_hold(duel_id: int, user_id: int) -> int:
+    """Release one participant's hold on the duel (e.g. after a lost join); returns the released amount."""
+    response = await asyncio.to_thread(
+        supabase.table("balance_holds")
+        .update({"status": "released", "settled_at": discord.utils.utcnow().isoformat()})
+        .eq("ref_type", "duel").eq("ref_id", str(duel_id)).eq("user_id", str(user_id)).eq("status", "held")
+        .execute
+    )
+    released = sum(int(row["amount"]) for row in response.data or [])
+    if released:
+        async with balance_lock:
+            _release_held(int(user_id), released)
+        balance_log.info("Released hold of user %s on duel %s: %s", user_id, duel_id, released)
+    return released
+
+
+async def settle_duel_holds(duel_id: int, winner_side: str, winner_id: int, payout: int) -> Optional[bool]:
+    """Mark the duel settled, capture its holds and pay the winner, in one DB transaction.
+
+    None if the duel already left processing/result_pending (a concurrent settle or cancel won),
+    otherwise whether any hold was captured.
+    """
+    # Пока идёт захват, буфер журнала не пишется: балансы из ответа не разойдутся с ним
+    async with _ledger_flush_lock:
+        response = await asyncio.to_thread(
+            supabase.rpc("settle_duel_with_holds", {
+                "p_duel_id": int(duel_id),
+                "p_winner_side": winner_side,
+                "p_winner_id": str(winner_id),
+                "p_payout": int(payout),
+            }).execute
+        )
+        rows = response.data or []
+        if not rows or not rows[0].get("settled"):
+            return None
+        rows = [row for row in rows if row.get("user_id") is not None]
+        async with balance_lock:
+            for row in rows:
+                if row.get("held"):
+                    _release_held(int(row["user_id"]), int(row["held"]))
+            _rebase_balances([row for row in rows if row.get("balance") is not None])
+    captured = any(row.get("held") for row in rows)
+    if not captured:
+        logger.warning(f"No active holds to capture on duel {duel_id}")
+    return captured
+
+# ---------------------- MODERATORS ----------------------
+
+# Модераторы по guild держатся в памяти: проверки на кнопках расчёта дуэлей
+# не ходят в БД. Таблица читается целиком при старте, /moderator add и kick
+# обновляют набор сразу после успешной записи.
+_moderators: Dict[str, Set[int]] = {}  # {guild_id: {user_id}}
+_moderators_loaded = False
+
+
+async def load_moderators():
+    """Load every guild's moderator set in one query."""
+    global _moderators_loaded
+    response = await asyncio.to_thread(
+        supabase.table("moderators").select("user_id,guild_id").execute
+    )
+    _moderators.clear()
+    for row in response.data or []:
+        _moderators.setdefault(str(row["guild_id"]), set()).add(int(row["user_id"]))
+    _moderators_loaded = True
+    logger.info(f"Loaded moderators for {len(_moderators)} guild(s)")
+
+
+async def _guild_moderators(guild_id: str) -> Set[int]:
+    """Moderator set for a guild; queries the table only if startup loading has not happened."""
+    if not _moderators_loaded:
+        try:
+            await load_moderators()
         except Exception as e:
-            logger.error(f"Error updating balance for user {user_id}: {e}")
-            raise
+            logger.error(f"Error loading moderators: {e}")
+    return _moderators.get(guild_id, set())
+
 
 async def add_moderator(user_id: int, guild_id: str) -> bool:
     """Добавить модератора для guild."""
@@ -416,6 +1206,8 @@ async def add_moderator(user_id: int, guild_id: str) -> bool:
                 "guild_id": guild_id
             }).execute
         )
+        if response.data:
+            _moderators.setdefault(guild_id, set()).add(int(user_id))
         return bool(response.data)
     except Exception as e:
         logger.error(f"Error adding moderator {user_id}: {e}")
@@ -427,6 +1219,8 @@ async def remove_moderator(user_id: int, guild_id: str) -> bool:
         response = await asyncio.to_thread(
             supabase.table("moderators").delete().eq("user_id", str(user_id)).eq("guild_id", guild_id).execute
         )
+        if response.data:
+            _moderators.get(guild_id, set()).discard(int(user_id))
         return bool(response.data)
     except Exception as e:
         logger.error(f"Error removing moderator {user_id}: {e}")
@@ -434,48 +1228,98 @@ async def remove_moderator(user_id: int, guild_id: str) -> bool:
 
 async def get_moderators(guild_id: str) -> List[int]:
     """Получить список ID модераторов для guild."""
-    try:
-        response = await asyncio.to_thread(
-            supabase.table("moderators").select("user_id").eq("guild_id", guild_id).execute
-        )
-        return [int(row["user_id"]) for row in response.data] if response.data else []
-    except Exception as e:
-        logger.error(f"Error getting moderators for guild {guild_id}: {e}")
-        return []
+    return sorted(await _guild_moderators(guild_id))
 
 async def is_moderator(user_id: int, guild_id: str) -> bool:
-    try:
-        response = await asyncio.to_thread(
-            supabase.table("moderators").select("user_id").eq("guild_id", guild_id).eq("user_id", str(user_id)).execute
-        )
-        is_mod = bool(response.data)
-        logger.info(f"is_moderator: user={user_id}, guild={guild_id}, found={is_mod}, data_len={len(response.data) if response.data else 0}")  # ✅ Расширь лог
-        return is_mod
-    except Exception as e:
-        logger.error(f"Error in is_moderator {user_id}/{guild_id}: {e}")
-        return False
+    return int(user_id) in await _guild_moderators(guild_id)
+
+# ---------------------- DUEL COOLDOWNS ----------------------
+
+# last_duel_time живёт в памяти: проверки кулдауна не ходят в БД,
+# записи копятся в _dirty_duel_times и сбрасываются пачкой фоновой задачей.
+DUEL_COOLDOWN_SECONDS = int(os.getenv("DUEL_COOLDOWN_SECONDS", "1"))
+DUEL_TIME_FLUSH_SECONDS = float(os.getenv("DUEL_TIME_FLUSH_SECONDS", "5"))
+_last_duel_times: Dict[int, int] = {}
+_dirty_duel_times: Dict[int, int] = {}
+_cooldowns_warm = False  # True после load_duel_cooldowns: промах в кэше = кулдаун истёк
+
+
+async def load_duel_cooldowns():
+    """Warm the tracker with every user whose cooldown has not expired yet."""
+    global _cooldowns_warm
+    since = int(time.time()) - DUEL_COOLDOWN_SECONDS
+    response = await asyncio.to_thread(
+        supabase.table("users").select("user_id,last_duel_time").gte("last_duel_time", since).execute
+    )
+    for row in response.data or []:
+        uid = int(row["user_id"])
+        _last_duel_times[uid] = max(_last_duel_times.get(uid, 0), int(row["last_duel_time"]))
+    _cooldowns_warm = True
+    logger.info(f"Duel cooldowns loaded: {len(_last_duel_times)} users on cooldown")
+
 
 async def check_duel_limit(user_id: int) -> bool:
-    """Check if a user can participate in a duel (24-hour cooldown)."""
-    try:
-        response = supabase.table("users").select("last_duel_time").eq("user_id", str(user_id)).execute()
+    """Check if a user can participate in a duel (DUEL_COOLDOWN_SECONDS cooldown)."""
+    user_id = int(user_id)
+    last_duel = _last_duel_times.get(user_id)
+    if last_duel is None:
+        if _cooldowns_warm:
+            return True
+        # До прогрева кэша — одиночный запрос, результат запоминаем
+        try:
+            response = await asyncio.to_thread(
+                supabase.table("users").select("last_duel_time").eq("user_id", str(user_id)).execute
+            )
+        except Exception as e:
+            logger.error(f"Error checking duel limit for user {user_id}: {e}")
+            raise
         last_duel = int(response.data[0]["last_duel_time"]) if response.data and response.data[0]["last_duel_time"] is not None else 0
-        now = int(time.time())
-        return now - last_duel >= 1  # 24 hours
-    except Exception as e:
-        logger.error(f"Error checking duel limit for user {user_id}: {e}")
-        raise
+        _last_duel_times[user_id] = last_duel
+    return int(time.time()) - last_duel >= DUEL_COOLDOWN_SECONDS
 
-async def update_duel_time(user_id: int):
-    """Update the last duel time for a user."""
-    try:
-        supabase.table("users").update({"last_duel_time": int(time.time())}).eq("user_id", str(user_id)).execute()
-    except Exception as e:
-        logger.error(f"Error updating duel time for user {user_id}: {e}")
-        raise
 
-async def create_duel(channel_id: int, player1_id: Optional[int] = None, player2_id: Optional[int] = None, team1_id: Optional[int] = None, team2_id: Optional[int] = None, points: int = 0, duel_type: str = "1v1", is_public: bool = False, creator_user_id: Optional[int] = None) -> int:
-    """Create a new duel and invite the opponent."""
+async def update_duel_time(*user_ids: int):
+    """Start the cooldown for the given users; the DB write is batched by flush_duel_times."""
+    now = int(time.time())
+    for user_id in user_ids:
+        _last_duel_times[int(user_id)] = now
+        _dirty_duel_times[int(user_id)] = now
+
+
+def _write_duel_times(batch: Dict[int, int]):
+    """One UPDATE per distinct timestamp (users started in the same call share it)."""
+    by_time: Dict[int, List[str]] = {}
+    for user_id, ts in batch.items():
+        by_time.setdefault(ts, []).append(str(user_id))
+    for ts, uids in by_time.items():
+        supabase.table("users").update({"last_duel_time": ts}).in_("user_id", uids).execute()
+
+
+@tasks.loop(seconds=DUEL_TIME_FLUSH_SECONDS)
+async def flush_duel_times():
+    if _dirty_duel_times:
+        batch = dict(_dirty_duel_times)
+        _dirty_duel_times.clear()
+        try:
+            await asyncio.to_thread(_write_duel_times, batch)
+        except Exception as e:
+            logger.error(f"Error flushing duel times for {len(batch)} users: {e}")
+            for user_id, ts in batch.items():
+                if _dirty_duel_times.get(user_id, 0) < ts:
+                    _dirty_duel_times[user_id] = ts
+            return
+
+    # Истёкшие кулдауны больше не нужны: после прогрева промах = "можно"
+    if _cooldowns_warm:
+        expired_before = int(time.time()) - DUEL_COOLDOWN_SECONDS
+        for user_id in [uid for uid, ts in _last_duel_times.items() if ts < expired_before and uid not in _dirty_duel_times]:
+            del _last_duel_times[user_id]
+
+async def create_duel(channel_id: int, player1_id: Optional[int] = None, player2_id: Optional[int] = None, team1_id: Optional[int] = None, team2_id: Optional[int] = None, points: int = 0, duel_type: str = "1v1", is_public: bool = False, creator_user_id: Optional[int] = None, invitee_id: Optional[int] = None) -> dict:
+    """Create a new duel and invite the opponent. Returns the inserted duel row.
+
+    invitee_id skips the team leader lookup for private 5v5 when the caller already knows it.
+    """
     now = int(time.time())
     try:
         insert_data = {
@@ -495,7 +1339,7 @@ async def create_duel(channel_id: int, player1_id: Optional[int] = None, player2
             "completed_at": None,
             "creator_id": str(creator_user_id) if creator_user_id else None,  # ✅ Добавлено: ID создателя дуэли
         }
-        logger.info(f"Creating duel with data: {insert_data}")
+        logger.debug("Creating duel with data: %s", insert_data)
         if duel_type == "1v1":
             if player1_id is None:
                 raise ValueError("player1_id required for 1v1")
@@ -506,26 +1350,32 @@ async def create_duel(channel_id: int, player1_id: Optional[int] = None, player2
             insert_data["team2_id"] = str(team2_id) if team2_id else None
 
         duel_response = await asyncio.to_thread(supabase.table("duels").insert(insert_data).execute)
-        logger.info(f"Created duel ID: {duel_response.data[0]['id']}, is_public: {duel_response.data[0].get('is_public', 'NOT SET')}, status: {duel_response.data[0].get('status')}")
+        logger.info("Created duel ID: %s, is_public: %s, status: %s", duel_response.data[0]["id"], duel_response.data[0].get("is_public"), duel_response.data[0].get("status"))
         duel_id = int(duel_response.data[0]["id"])
+        emit_event(
+            "duel_created", duel_id=duel_id, type=duel_type, points=int(points), is_public=is_public,
+            creator_id=str(creator_user_id or player1_id), opponent_id=str(player2_id) if player2_id else None,
+        )
+        if duel_type == "1v1":
+            track_open_duel(duel_id, int(player1_id), None)
+        else:
+            track_open_duel(duel_id, int(creator_user_id) if creator_user_id else None, int(team1_id) if team1_id else None)
         
+        invitee = None
         if not is_public and player2_id:  # Only for private 1v1
-            supabase.table("duel_invites").insert({
-                "duel_id": duel_id,
-                "user_id": str(player2_id),
-                "status": "pending",
-                "created_at": now
-            }).execute()
+            invitee = player2_id
         elif not is_public and team2_id:  # For private 5v5
-            leader2 = await get_team_leader(team2_id)
-            if leader2:
+            invitee = invitee_id or await get_team_leader(team2_id)
+        if invitee:
+            await asyncio.to_thread(
                 supabase.table("duel_invites").insert({
                     "duel_id": duel_id,
-                    "user_id": str(leader2),
+                    "user_id": str(invitee),
                     "status": "pending",
                     "created_at": now
-                }).execute()
-        return duel_id
+                }).execute
+            )
+        return duel_response.data[0]
     except Exception as e:
         logger.error(f"Error creating duel: {e}")
         raise
@@ -533,26 +1383,49 @@ async def create_duel(channel_id: int, player1_id: Optional[int] = None, player2
 async def set_duel_message(duel_id: int, message_id: int):
     """Set the message ID for a duel."""
     try:
-        supabase.table("duels").update({"message_id": int(message_id)}).eq("id", int(duel_id)).execute()
+        await asyncio.to_thread(
+            supabase.table("duels").update({"message_id": int(message_id)}).eq("id", int(duel_id)).execute
+        )
     except Exception as e:
         logger.error(f"Error setting duel message ID {duel_id}: {e}")
         raise
 
+async def refresh_duel_channel_message(duel: Optional[dict]):
+    """Re-render the duel's channel message from the given row."""
+    if not duel or not duel.get("message_id"):
+        return
+    channel = bot.get_channel(int(duel["channel_id"]))
+    if channel:
+        try:
+            msg = await channel.fetch_message(int(duel["message_id"]))
+            await refresh_duel_message(msg, duel)
+        except Exception as e:
+            logger.error(f"Error refreshing duel message {duel.get('id')}: {e}")
+
+
 async def update_duel_status(duel_id: int, new_status: str):
     try:
         supabase.table("duels").update({"status": new_status}).eq("id", int(duel_id)).execute()
-        duel = await get_duel(duel_id)
-        if duel and duel.get("message_id"):
-            channel = bot.get_channel(int(duel["channel_id"]))
-            if channel:
-                try:
-                    msg = await channel.fetch_message(int(duel["message_id"]))
-                    await refresh_duel_message(msg, duel)
-                except Exception as e:
-                    logger.error(f"Error refreshing duel message {duel_id}: {e}")
+        on_duel_status_change(duel_id, new_status)
+        await refresh_duel_channel_message(await get_duel(duel_id))
     except Exception as e:
         logger.error(f"Error updating duel status {duel_id}: {e}")
 
+
+# Статусы, из которых дуэль ещё можно отменить модератором (не settled/cancelled/expired)
+LIVE_DUEL_STATUSES = ("waiting", "public", "active", "processing", "result_pending", "result_canceled")
+
+
+async def transition_duel(duel_id: int, from_statuses: Tuple[str, ...], **fields) -> Optional[dict]:
+    """Conditional UPDATE of the duel: applies `fields` only while its status is one of `from_statuses`.
+
+    Returns the updated row, or None when a concurrent transition got there first.
+    """
+    response = await asyncio.to_thread(
+        supabase.table("duels").update(fields).eq("id", int(duel_id)).in_("status", list(from_statuses)).execute
+    )
+    return response.data[0] if response.data else None
+
 async def get_duel(duel_id: int) -> Optional[dict]:
     """Get details of a duel by ID."""
     try:
@@ -562,170 +1435,203 @@ async def get_duel(duel_id: int) -> Optional[dict]:
         logger.error(f"Error getting duel {duel_id}: {e}")
         raise
 
+# ---------------------- OPEN DUEL REGISTRY ----------------------
+
+# Открытые (waiting/public) дуэли в памяти: восстанавливаются на старте,
+# обновляются при создании и при каждом переходе статуса.
+OPEN_DUEL_STATUSES = ("waiting", "public")
+_open_duels: Dict[int, Tuple[Optional[int], Optional[int]]] = {}  # {duel_id: (owner_user_id, team1_id)}
+_open_duel_by_user: Dict[int, int] = {}
+_open_duel_by_team: Dict[int, int] = {}
+
+
+def track_open_duel(duel_id: int, owner_id: Optional[int], team_id: Optional[int] = None):
+    """Register an open duel under its creator (1v1 player / 5v5 leader) and team."""
+    duel_id = int(duel_id)
+    untrack_open_duel(duel_id)
+    _open_duels[duel_id] = (owner_id, team_id)
+    if owner_id is not None:
+        _open_duel_by_user[owner_id] = duel_id
+    if team_id is not None:
+        _open_duel_by_team[team_id] = duel_id
+
+
+def untrack_open_duel(duel_id: int):
+    """Drop a duel from the registry once it leaves waiting/public."""
+    duel_id = int(duel_id)
+    entry = _open_duels.pop(duel_id, None)
+    if entry is None:
+        return
+    owner_id, team_id = entry
+    if owner_id is not None and _open_duel_by_user.get(owner_id) == duel_id:
+        del _open_duel_by_user[owner_id]
+    if team_id is not None and _open_duel_by_team.get(team_id) == duel_id:
+        del _open_duel_by_team[team_id]
+
+
+def on_duel_status_change(duel_id: int, new_status: str, **fields):
+    emit_event("duel_status", duel_id=int(duel_id), status=new_status, **fields)
+    if new_status not in OPEN_DUEL_STATUSES:
+        untrack_open_duel(duel_id)
+
+
+async def load_open_duels():
+    """Rebuild the registry from the duels table (one query, plus one for legacy 5v5 rows)."""
+    response = await asyncio.to_thread(
+        supabase.table("duels")
+        .select("id,type,player1_id,team1_id,creator_id")
+        .in_("status", list(OPEN_DUEL_STATUSES))
+        .execute
+    )
+    rows = response.data or []
+
+    # Старые 5v5 без creator_id: лидера берём из teams одним запросом
+    missing_teams = {str(r["team1_id"]) for r in rows if r["type"] != "1v1" and not r.get("creator_id") and r.get("team1_id")}
+    leaders: Dict[str, str] = {}
+    if missing_teams:
+        teams_resp = await asyncio.to_thread(
+            supabase.table("teams").select("id,leader_id").in_("id", list(missing_teams)).execute
+        )
+        leaders = {str(t["id"]): t["leader_id"] for t in teams_resp.data or []}
+
+    _open_duels.clear()
+    _open_duel_by_user.clear()
+    _open_duel_by_team.clear()
+    for row in rows:
+        team_id = int(row["team1_id"]) if row.get("team1_id") else None
+        if row["type"] == "1v1":
+            owner = row.get("player1_id")
+        else:
+            owner = row.get("creator_id") or leaders.get(str(row.get("team1_id")))
+        track_open_duel(int(row["id"]), int(owner) if owner else None, team_id)
+    logger.info(f"Open duel registry loaded: {len(_open_duels)} duels")
+
+
 async def has_pending_duel(user_id: int) -> Optional[int]:
     """Проверяет, есть ли у пользователя открытая pending дуэль (waiting/public)."""
+    return _open_duel_by_user.get(int(user_id))
+
+
+def team_open_duel(team_id: int) -> Optional[int]:
+    """Open duel created by the given team, if any."""
+    return _open_duel_by_team.get(int(team_id))
+
+
+async def update_duel_invite_status(duel_id: int, user_id: int, status: str) -> bool:
+    """Update the status of a duel invite. Returns False if the accepting side cannot cover the stake.
+
+    The channel message is refreshed by the caller, once, from the updated row.
+    """
     try:
-        # Check 1v1: creator as player1
-        response = await asyncio.to_thread(
-            supabase.table("duels")
-            .select("id")
-            .eq("player1_id", str(user_id))
-            .in_("status", ["waiting", "public"])
-            .execute
-        )
-        if response.data:
-            return int(response.data[0]["id"])
-        
-        # Check 5v5: creator as team1 leader
-        user_team = await get_user_team(user_id)
-        if user_team and str(user_id) == user_team["leader_id"]:
-            response = await asyncio.to_thread(
-                supabase.table("duels")
-                .select("id")
-                .eq("team1_id", str(user_team["id"]))
-                .in_("status", ["waiting", "public"])
-                .execute
-            )
-            if response.data:
-                return int(response.data[0]["id"])
-        
-        return None
-    except Exception as e:
-        logger.error(f"Error checking pending duel for {user_id}: {e}")
-        return None
-
-async def update_duel_invite_status(duel_id: int, user_id: int, status: str):
-    """Update the status of a duel invite."""
-    try:
+        duel = await get_duel(duel_id)
+        if status == "accepted":
+            # Сначала резервируем ставку второй стороны: без неё дуэль не активируется
+            staker = int(duel["player2_id"]) if duel["type"] == "1v1" else await get_team_leader(duel.get("team2_id"))
+            if not staker or not await hold_stake(duel_id, staker, int(duel["points"])):
+                return False
         await asyncio.to_thread(
             supabase.table("duel_invites").update({"status": status}).eq("duel_id", int(duel_id)).eq("user_id", str(user_id)).execute
         )
-        duel = await get_duel(duel_id)
         if status == "accepted":
-            await asyncio.to_thread(
-                supabase.table("duels").update({"status": "active"}).eq("id", int(duel_id)).execute
-            )
-            # Deduct points from second player/leader
+            # Активируем только ожидающую дуэль: её мог успеть отменить sweeper приглашений
+            if not await transition_duel(duel_id, ("waiting",), status="active"):
+                # Снимаем только свой холд, и только если дуэль не активировал наш же предыдущий клик
+                current = await get_duel(duel_id)
+                if not current or current["status"] != "active":
+                    await release_user_hold(duel_id, staker)
+                return False
+            on_duel_status_change(duel_id, "active", via="accept", user_id=str(user_id))
+            # ✅ Cooldown только после accepted
             if duel["type"] == "1v1":
-                await add_balance(int(duel["player2_id"]), -int(duel["points"]))
-                # ✅ Cooldown только после accepted
-                await update_duel_time(int(duel["player1_id"]))
-                await update_duel_time(int(duel["player2_id"]))
+                await update_duel_time(int(duel["player1_id"]), staker)
             else:  # 5v5
-                leader2 = await get_team_leader(int(duel["team2_id"]))
-                if leader2:
-                    await add_balance(leader2, -int(duel["points"]))
-                    # ✅ Cooldown для лидеров только после accepted
-                    leader1 = await get_team_leader(int(duel["team1_id"]))
-                    if leader1:
-                        await update_duel_time(leader1)
-                    await update_duel_time(leader2)
-            # Refresh message
-            if duel.get("message_id"):
-                channel = bot.get_channel(int(duel["channel_id"]))
-                if channel:
-                    try:
-                        msg = await channel.fetch_message(int(duel["message_id"]))
-                        await refresh_duel_message(msg, duel)
-                    except Exception as e:
-                        logger.error(f"Error refreshing after accept {duel_id}: {e}")
+                leader1 = await get_team_leader(duel.get("team1_id"))
+                await update_duel_time(*[uid for uid in (leader1, staker) if uid])
         elif status == "declined":
-            await asyncio.to_thread(
-                supabase.table("duels").update({"status": "cancelled"}).eq("id", int(duel_id)).execute
-            )
-            # Refund first player/leader (без cooldown)
-            if duel["type"] == "1v1":
-                await add_balance(int(duel["player1_id"]), int(duel["points"]))
-            else:
-                leader1 = await get_team_leader(int(duel["team1_id"]))
-                if leader1:
-                    await add_balance(leader1, int(duel["points"]))
-            # Refresh message
-            if duel.get("message_id"):
-                channel = bot.get_channel(int(duel["channel_id"]))
-                if channel:
-                    try:
-                        msg = await channel.fetch_message(int(duel["message_id"]))
-                        await refresh_duel_message(msg, duel)
-                    except Exception as e:
-                        logger.error(f"Error refreshing after decline {duel_id}: {e}")
+            # Отменяем только ожидающую дуэль: параллельный accept мог её уже активировать
+            if not await transition_duel(duel_id, ("waiting",), status="cancelled"):
+                return False
+            on_duel_status_change(duel_id, "cancelled", via="decline", user_id=str(user_id))
+            # Снимаем холд создателя (без cooldown)
+            await release_duel_holds(duel_id)
+        return True
     except Exception as e:
         logger.error(f"Error updating duel invite status for duel {duel_id}, user {user_id}: {e}")
+        return False
+
+async def _release_lost_join(duel_id: int, user_id: int, slot: str, value: str):
+    """Drop the hold of a join that lost the slot, unless the slot is ours (a repeated click)."""
+    current = await get_duel(duel_id)
+    if not current or current.get(slot) != value:
+        await release_user_hold(duel_id, user_id)
 
-async def join_public_duel(duel_id: int, joining_user_id: int, joining_team_id: Optional[int] = None, points: int = 0):
-    """Handle joining a public duel (1v1 or 5v5)."""
+async def join_public_duel(duel_id: int, joining_user_id: int, joining_team_id: Optional[int] = None, points: int = 0) -> Tuple[bool, str, Optional[dict]]:
+    """Handle joining a public duel (1v1 or 5v5). On success also returns the updated duel row for the caller's refresh."""
     try:
         duel = await get_duel(duel_id)
         if not duel or duel["status"] != "public" or duel["is_public"] is False:
-            return False, "Дуэль недоступна для присоединения."
+            return False, "Дуэль недоступна для присоединения.", None
         
         if duel["type"] == "1v1":
             if duel["player2_id"] is not None:
-                return False, "Дуэль уже заполнена."
-            bal = await get_balance(joining_user_id)
+                return False, "Дуэль уже заполнена.", None
+            bal = await get_available_balance(joining_user_id)
             if bal < points:
-                return False, f"Недостаточно поинтов: {bal}."
+                return False, f"Недостаточно поинтов: {bal}.", None
             # ✅ Cooldown проверка перед join, но update только после
             if not await check_duel_limit(joining_user_id):
-                return False, "Вы уже дуэлились сегодня."
+                return False, "Вы уже дуэлились сегодня.", None
             if str(joining_user_id) == duel["player1_id"]:
-                return False, "Вы уже в дуэли."
-            await asyncio.to_thread(
-                supabase.table("duels").update({"player2_id": str(joining_user_id), "status": "active"}).eq("id", duel_id).execute
+                return False, "Вы уже в дуэли.", None
+            if not await hold_stake(duel_id, joining_user_id, points):
+                return False, "Недостаточно поинтов.", None
+            # Слот занимает только тот, кто застал дуэль публичной и пустой
+            joined = await asyncio.to_thread(
+                supabase.table("duels").update({"player2_id": str(joining_user_id), "status": "active"})
+                .eq("id", duel_id).eq("status", "public").is_("player2_id", "null").execute
             )
-            await add_balance(joining_user_id, -points)
+            if not joined.data:
+                await _release_lost_join(duel_id, joining_user_id, "player2_id", str(joining_user_id))
+                return False, "Дуэль уже заполнена.", None
+            on_duel_status_change(duel_id, "active", via="public_join", user_id=str(joining_user_id))
             # ✅ Cooldown стартует только после join
-            await update_duel_time(joining_user_id)
-            await update_duel_time(int(duel["player1_id"]))
-            # Refresh message
-            if duel.get("message_id"):
-                channel = bot.get_channel(int(duel["channel_id"]))
-                if channel:
-                    try:
-                        msg = await channel.fetch_message(int(duel["message_id"]))
-                        await refresh_duel_message(msg, duel)
-                    except Exception as e:
-                        logger.error(f"Error refreshing after public join 1v1 {duel_id}: {e}")
-            return True, "Вы присоединились к дуэли. Она активна!"
+            await update_duel_time(joining_user_id, int(duel["player1_id"]))
+            return True, "Вы присоединились к дуэли. Она активна!", joined.data[0]
         else:  # 5v5
             team = await get_team(joining_team_id)
             if not team or not await is_team_full_and_confirmed(team):
-                return False, "Ваша команда должна быть полной и подтвержденной."
+                return False, "Ваша команда должна быть полной и подтвержденной.", None
             if str(joining_user_id) != team["leader_id"]:
-                return False, "Только лидер может присоединить команду."
-            bal = await get_balance(joining_user_id)
+                return False, "Только лидер может присоединить команду.", None
+            bal = await get_available_balance(joining_user_id)
             if bal < points:
-                return False, f"Недостаточно поинтов у лидера: {bal}."
+                return False, f"Недостаточно поинтов у лидера: {bal}.", None
             # ✅ Cooldown проверка перед join
             if not await check_duel_limit(joining_user_id):
-                return False, "Лидер уже участвовал в дуэли сегодня."
+                return False, "Лидер уже участвовал в дуэли сегодня.", None
             if duel["team1_id"] and str(joining_team_id) == duel["team1_id"]:
-                return False, "Нельзя присоединиться к своей дуэли."
-            if duel["team1_id"] is None:
-                await asyncio.to_thread(
-                    supabase.table("duels").update({"team1_id": str(joining_team_id), "status": "active"}).eq("id", duel_id).execute
+                return False, "Нельзя присоединиться к своей дуэли.", None
+            # Создатель занимает team1, присоединившаяся команда — свободный слот team2
+            if duel["team2_id"] is None:
+                if not await hold_stake(duel_id, joining_user_id, points):
+                    return False, "Недостаточно поинтов у лидера.", None
+                joined = await asyncio.to_thread(
+                    supabase.table("duels").update({"team2_id": str(joining_team_id), "status": "active"})
+                    .eq("id", duel_id).eq("status", "public").is_("team2_id", "null").execute
                 )
-                await add_balance(joining_user_id, -points)
+                if not joined.data:
+                    await _release_lost_join(duel_id, joining_user_id, "team2_id", str(joining_team_id))
+                    return False, "Дуэль уже заполнена.", None
+                on_duel_status_change(duel_id, "active", via="public_join", user_id=str(joining_user_id), team_id=str(joining_team_id))
                 # ✅ Cooldown для обоих лидеров после join
-                await update_duel_time(joining_user_id)
-                creator_leader = await get_team_leader(int(duel["team1_id"]))
-                if creator_leader:
-                    await update_duel_time(creator_leader)
-                # Refresh message
-                if duel.get("message_id"):
-                    channel = bot.get_channel(int(duel["channel_id"]))
-                    if channel:
-                        try:
-                            msg = await channel.fetch_message(int(duel["message_id"]))
-                            await refresh_duel_message(msg, duel)
-                        except Exception as e:
-                            logger.error(f"Error refreshing after public join 5v5 {duel_id}: {e}")
-                return True, "Ваша команда присоединилась к дуэли. Она активна!"
+                creator_leader = await get_team_leader(duel.get("team1_id"))
+                await update_duel_time(*[uid for uid in (joining_user_id, creator_leader) if uid])
+                return True, "Ваша команда присоединилась к дуэли. Она активна!", joined.data[0]
             else:
-                return False, "Дуэль уже заполнена."
+                return False, "Дуэль уже заполнена.", None
     except Exception as e:
         logger.error(f"Error joining public duel {duel_id}: {e}")
-        return False, "Ошибка присоединения."
+        return False, "Ошибка присоединения.", None
 
 async def auto_refund_public_duel(duel_id: int, creator_id: int, points: int):
     """Auto-refund public duel after 1 hour if no join."""
@@ -735,10 +1641,13 @@ async def auto_refund_public_duel(duel_id: int, creator_id: int, points: int):
         if not duel or duel["status"] != "public":
             logger.info(f"Auto-refund skipped for {duel_id}: status {duel['status'] if duel else 'None'}")
             return
-        # Refund creator
-        await add_balance(creator_id, points)
-        # Update status
-        await update_duel_status(duel_id, "cancelled")
+        # Отменяем, только если дуэль всё ещё публичная: join мог успеть раньше
+        if not await transition_duel(duel_id, ("public",), status="cancelled"):
+            logger.info(f"Auto-refund skipped for {duel_id}: joined meanwhile")
+            return
+        on_duel_status_change(duel_id, "cancelled", via="auto_refund")
+        # Снимаем холд создателя
+        await release_duel_holds(duel_id)
         # Notify in channel
         channel = bot.get_channel(int(duel["channel_id"]))
         if channel:
@@ -747,10 +1656,9 @@ async def auto_refund_public_duel(duel_id: int, creator_id: int, points: int):
             view = discord.ui.View()  # No buttons
             if duel.get("message_id"):
                 try:
-                    msg = await channel.fetch_message(int(duel["message_id"]))
-                    await msg.edit(embed=embed, view=view)
+                    await outbound.edit(channel.get_partial_message(int(duel["message_id"])), embed=embed, view=view)
                 except:
-                    await channel.send(embed=embed)
+                    await safe_send(channel, embed=embed)
             else:
                 await channel.send(embed=embed)
         logger.info(f"Auto-refund for duel {duel_id}: {points} returned to {creator_id}")
@@ -758,7 +1666,8 @@ async def auto_refund_public_duel(duel_id: int, creator_id: int, points: int):
         logger.error(f"Error in auto-refund {duel_id}: {e}")
 
 async def settle_duel(duel_id: int, winner_side: str) -> Tuple[bool, str]:
-    logger.info(f"Starting settle_duel for {duel_id}, winner {winner_side}")
+    logger.info("Starting settle_duel for %s, winner %s", duel_id, winner_side)
+    started = time.perf_counter()
     if winner_side not in ("A", "B"):
         return False, "Победитель должен быть 'A' или 'B'."
     
@@ -769,50 +1678,42 @@ async def settle_duel(duel_id: int, winner_side: str) -> Tuple[bool, str]:
         if duel["status"] not in ("processing", "result_pending"):  # Allow manual on processing too
             return False, "Дуэль не в состоянии для завершения."
         
-        logger.info(f"Duel {duel_id} current status: {duel['status']}")
+        logger.debug("Duel %s current status: %s", duel_id, duel["status"])
         points = int(duel["points"])
         total_pot = points * 2  # Общий банк
         burn_rate = DEFAULT_BURN  # 0.25
         burned_amount = int(total_pot * burn_rate)  # 25% сгорает
         payout = total_pot - burned_amount  # Остаток победителю
         
-        winner_leader = None
-        if winner_side == "A":
-            if duel["type"] == "1v1":
-                winner_leader = int(duel["player1_id"])
-            else:
-                winner_leader = await get_team_leader(int(duel["team1_id"]))
-        else:  # winner_side == "B"
-            if duel["type"] == "1v1":
-                winner_leader = int(duel["player2_id"])
-            else:
-                winner_leader = await get_team_leader(int(duel["team2_id"]))
+        # Лидеры сторон A и B: ставки обеих захватываются, выплата — победителю
+        if duel["type"] == "1v1":
+            side_a, side_b = int(duel["player1_id"]), int(duel["player2_id"])
+        else:
+            side_a = await get_team_leader(int(duel["team1_id"]))
+            side_b = await get_team_leader(int(duel["team2_id"]))
+        winner_leader, loser_leader = (side_a, side_b) if winner_side == "A" else (side_b, side_a)
         
         if not winner_leader:
             return False, "Не удалось определить лидера победителя."
         
         # Передача точек в лог
-        logger.info(f"Winner leader {winner_leader}, total_pot {total_pot}, burned {burned_amount}, payout {payout}, updating to settled")
-        
-        # Обновление статуса и winner_side
-        supabase.table("duels").update({"status": "settled", "winner_side": winner_side}).eq("id", int(duel_id)).execute()
-        
-        # Немедленная проверка: повторный запрос для обхода кэша
-        response = supabase.table("duels").select("status", "winner_side").eq("id", int(duel_id)).execute()
-        if not response.data:
-            logger.error(f"No data after update for duel {duel_id}")
-            return False, "Обновление не применилось."
-        updated_db = response.data[0]
-        logger.info(f"DB check after update: status {updated_db['status']}, winner_side {updated_db.get('winner_side', 'None')}")
-        if updated_db["status"] != "settled" or updated_db.get("winner_side") != winner_side:
-            logger.error(f"DB update failed: expected settled/{winner_side}, got {updated_db['status']}/{updated_db.get('winner_side')}")
-            return False, "Ошибка обновления БД."
-        
-        # Передача payout лидеру победителя (учитывая, что у него уже -points)
-        await add_balance(winner_leader, payout)
-        logger.info(f"Balance updated for {winner_leader}: +{payout} (netto +{payout - points})")
+        logger.info("Winner leader %s, total_pot %s, burned %s, payout %s, updating to settled", winner_leader, total_pot, burned_amount, payout)
         
-        await update_duel_status(duel_id, "settled")
+        # Статус, winner_side и захват холдов обеих сторон — одна транзакция;
+        # победителю — payout (нетто +payout - points)
+        captured = await settle_duel_holds(duel_id, winner_side, winner_leader, payout)
+        if captured is None:
+            logger.warning(f"Settle of duel {duel_id} lost to a concurrent transition")
+            return False, "Дуэль уже завершена или отменена."
+        balance_log.info("Captured holds on duel %s: %s +%s (netto +%s)", duel_id, winner_leader, payout, payout - points)
+        emit_event(
+            "duel_settled", duel_id=int(duel_id), winner_side=winner_side, winner_id=str(winner_leader),
+            loser_id=str(loser_leader) if loser_leader else None, points=points, pot=total_pot, burned=burned_amount, payout=payout, captured=captured,
+            latency_ms=elapsed_ms(started),
+        )
+        on_duel_status_change(duel_id, "settled", winner_side=winner_side)
+        # RPC уже записал статус: сообщение обновляем один раз, из той же строки
+        await refresh_duel_channel_message({**duel, "status": "settled", "winner_side": winner_side})
         return True, f"Дуэль завершена! Победитель: {winner_side} ({payout} поинтов лидеру, сгорело {burned_amount})."
     except Exception as e:
         logger.error(f"Error settling duel {duel_id}: {e}")
@@ -849,24 +1750,75 @@ async def create_team(leader_id: int, players: List[int], name: str) -> int:
         raise
 
 
-async def get_team(team_id: int) -> Optional[dict]:
-    """Get details of a team by ID."""
+# ---------------------- TEAM CACHE ----------------------
+
+# Команды в памяти. Любая мутация teams вызывает invalidate_team, которая
+# увеличивает версию: загрузка, начатая до инвалидации, в кэш не попадёт.
+_team_cache: Dict[int, dict] = {}
+_team_versions: Dict[int, int] = {}
+_team_epoch = 0  # растёт при массовых удалениях (cleanup_db)
+
+
+def invalidate_team(team_id: int):
+    """Drop a team from the cache after any write to its row."""
+    team_id = int(team_id)
+    _team_cache.pop(team_id, None)
+    _team_versions[team_id] = _team_versions.get(team_id, 0) + 1
+
+
+def invalidate_all_teams():
+    """Drop every cached team after a bulk write to the teams table."""
+    global _team_epoch
+    _team_cache.clear()
+    _team_epoch += 1
+
+
+def _team_version(team_id: int) -> Tuple[int, int]:
+    return _team_epoch, _team_versions.get(int(team_id), 0)
+
+
+def _cache_team(team: dict, version: Tuple[int, int]):
+    if _team_version(team["id"]) == version:
+        _team_cache[int(team["id"])] = team
+
+
+async def get_team(team_id: Optional[int]) -> Optional[dict]:
+    """Get details of a team by ID (cached until the team is invalidated)."""
+    if not team_id:
+        return None
+    team_id = int(team_id)
+    cached = _team_cache.get(team_id)
+    if cached is not None:
+        return cached
+    version = _team_version(team_id)
     try:
-        response = supabase.table("teams").select("*").eq("id", int(team_id)).execute()
-        return response.data[0] if response.data else None
+        response = await asyncio.to_thread(
+            supabase.table("teams").select("*").eq("id", team_id).execute
+        )
     except Exception as e:
         logger.error(f"Error getting team {team_id}: {e}")
         raise
+    team = response.data[0] if response.data else None
+    if team:
+        _cache_team(team, version)
+    return team
 
 async def get_user_team(user_id: int) -> Optional[dict]:
     """Get the team a user is part of."""
+    epoch, versions = _team_epoch, dict(_team_versions)
     try:
-        response = supabase.table("teams").select("*").or_(f"leader_id.eq.{str(user_id)},player1_id.eq.{str(user_id)},player2_id.eq.{str(user_id)},player3_id.eq.{str(user_id)},player4_id.eq.{str(user_id)},player5_id.eq.{str(user_id)}").execute()
-        return response.data[0] if response.data else None
+        response = await asyncio.to_thread(
+            supabase.table("teams").select("*").or_(f"leader_id.eq.{str(user_id)},player1_id.eq.{str(user_id)},player2_id.eq.{str(user_id)},player3_id.eq.{str(user_id)},player4_id.eq.{str(user_id)},player5_id.eq.{str(user_id)}").execute
+        )
     except Exception as e:
         logger.error(f"Error getting team for user {user_id}: {e}")
         raise
-async def get_team_leader(team_id: int) -> Optional[int]:
+    team = response.data[0] if response.data else None
+    if team:
+        _cache_team(team, (epoch, versions.get(int(team["id"]), 0)))
+    return team
+
+async def get_team_leader(team_id: Optional[int]) -> Optional[int]:
     """Get the leader ID of a team."""
     team = await get_team(team_id)
     return int(team["leader_id"]) if team else None
@@ -893,19 +1845,97 @@ async def remove_from_team(user_id: int):
     try:
         team = await get_user_team(user_id)
         if team:
-            team_id = team["id"]
-            updates = {}
-            for i in range(1, 6):
-                if team[f"player{i}_id"] == str(user_id):
-                    updates[f"player{i}_id"] = None
-            if updates:
-                supabase.table("teams").update(updates).eq("id", team_id).execute()
-                supabase.table("team_invites").update({"status": "left"}).eq("team_id", team_id).eq("user_id", str(user_id)).execute()
-                supabase.table("teams").update({"status": "pending"}).eq("id", team_id).execute()
+            await release_team_member(int(team["id"]), user_id)
     except Exception as e:
         logger.error(f"Error removing user {user_id} from team: {e}")
         raise
 
+# ---------------------- TEAM INVITE SERVICE ----------------------
+
+TEAM_SIZE = 5
+
+
+async def accept_team_invite(invite_id: int, user_id: int) -> Tuple[str, Optional[dict]]:
+    """Принять приглашение одной транзакцией (RPC accept_team_invite).
+
+    Returns (result, team): result is 'accepted', 'stale' or 'full'; team carries
+    id, name, leader_id, guild_id, member_count and status after the update.
+    """
+    try:
+        response = await asyncio.to_thread(
+            supabase.rpc("accept_team_invite", {"p_invite_id": int(invite_id), "p_user_id": str(user_id)}).execute
+        )
+    except Exception as e:
+        logger.error(f"Error accepting team invite {invite_id} for user {user_id}: {e}")
+        raise
+    row = response.data[0] if response.data else None
+    if not row or row["result"] == "stale":
+        return "stale", None
+    if row["result"] == "accepted":
+        invalidate_team(row["id"])
+    return row["result"], row
+
+
+async def join_public_team(team_id: int, user_id: int) -> Tuple[str, Optional[dict]]:
+    """Вступить в публичную команду (RPC join_public_team). Same result contract as accept_team_invite."""
+    try:
+        response = await asyncio.to_thread(
+            supabase.rpc("join_public_team", {"p_team_id": int(team_id), "p_user_id": str(user_id)}).execute
+        )
+    except Exception as e:
+        logger.error(f"Error joining public team {team_id} for user {user_id}: {e}")
+        raise
+    row = response.data[0] if response.data else None
+    if not row or row["result"] == "stale":
+        return "stale", None
+    if row["result"] == "accepted":
+        invalidate_team(row["id"])
+    return row["result"], row
+
+
+async def decline_team_invite(invite_id: int, user_id: int) -> Optional[int]:
+    """Отклонить pending-приглашение. Returns the team id, or None if the invite is stale."""
+    try:
+        response = await asyncio.to_thread(
+            supabase.table("team_invites")
+            .update({"status": "declined"})
+            .eq("id", int(invite_id))
+            .eq("user_id", str(user_id))
+            .eq("status", "pending")
+            .execute
+        )
+    except Exception as e:
+        logger.error(f"Error declining team invite {invite_id} for user {user_id}: {e}")
+        raise
+    return int(response.data[0]["team_id"]) if response.data else None
+
+
+async def release_team_member(team_id: int, user_id: int) -> bool:
+    """Освободить слот игрока (выход или кик) и уменьшить счётчик участников."""
+    try:
+        response = await asyncio.to_thread(
+            supabase.rpc("release_team_member", {"p_team_id": int(team_id), "p_user_id": str(user_id)}).execute
+        )
+        invalidate_team(team_id)
+        return bool(response.data)
+    except Exception as e:
+        logger.error(f"Error releasing user {user_id} from team {team_id}: {e}")
+        raise
+
+
+async def announce_team_join(team: dict, user_id: int, leader_notice: str):
+    """Выдать роль новому участнику и уведомить лидера."""
+    guild_id = team.get("guild_id")
+    if guild_id:
+        guild = bot.get_guild(int(guild_id))
+        if guild:
+            member = guild.get_member(user_id)
+            if member:
+                await assign_team_role(guild, member, team["name"])
+    leader = bot.get_user(int(team["leader_id"]))
+    if leader:
+        await safe_send(leader, content=leader_notice)
+
 async def create_match(channel_id: int, team_a: str, team_b: str, burn: float) -> int:
     """Create a new match for betting."""
     now = int(time.time())
@@ -963,6 +1993,9 @@ async def place_bet(match_id: int, user_id: int, team: str, amount: int) -> Tupl
     if amount <= 0:
         return False, "Сумма должна быть > 0."
 
+    stake_key = f"bet_stake:{uuid.uuid4().hex}"
+    debited = False
+    started = time.perf_counter()
     try:
         match = await get_match(match_id)
         if not match:
@@ -970,18 +2003,12 @@ async def place_bet(match_id: int, user_id: int, team: str, amount: int) -> Tupl
         if match["status"] != "Открыта":
             return False, "Ставки закрыты."
 
-        await ensure_user(user_id)
-        current_balance = await get_balance(user_id)
-        if amount > current_balance:
+        # Проверка и списание атомарны относительно других изменений баланса
+        debited, current_balance = await debit_balance(user_id, amount, "bet_stake", "match", match_id, stake_key)
+        if not debited:
             return False, f"Недостаточно поинтов. Ваш баланс: {current_balance}."
 
         async with balance_lock:  # Ensure atomic transaction
-            # Deduct balance directly
-            new_balance = current_balance - amount
-            await asyncio.to_thread(
-                supabase.table("users").update({"balance": new_balance}).eq("user_id", str(user_id)).execute
-            )
-
             # Insert bet
             await asyncio.to_thread(
                 supabase.table("bets").insert({
@@ -993,26 +2020,32 @@ async def place_bet(match_id: int, user_id: int, team: str, amount: int) -> Tupl
                 }).execute
             )
 
-            # Update match total
-            if team == "A":
-                new_total = int(match["total_a"]) + amount
-                await asyncio.to_thread(
-                    supabase.table("matches").update({"total_a": new_total}).eq("id", int(match_id)).execute
-                )
-            else:
-                new_total = int(match["total_b"]) + amount
-                await asyncio.to_thread(
-                    supabase.table("matches").update({"total_b": new_total}).eq("id", int(match_id)).execute
-                )
+            # Сумма стороны — инкремент в БД, а не запись прочитанного total + amount
+            await asyncio.to_thread(
+                supabase.rpc("increment_match_total", {
+                    "p_match_id": int(match_id),
+                    "p_team": team,
+                    "p_amount": amount,
+                }).execute
+            )
 
+        emit_event(
+            "bet_placed", match_id=int(match_id), user_id=str(user_id), team=team, amount=amount,
+            latency_ms=elapsed_ms(started),
+        )
         return True, "Ставка принята!"
     except Exception as e:
         logger.error(f"Error placing bet for match {match_id}, user {user_id}: {e}")
-        # Potential refund if deducted but failed
-        try:
-            await add_balance(user_id, amount)
-        except:
-            pass
+        emit_event(
+            "bet_failed", match_id=int(match_id), user_id=str(user_id), team=team, amount=amount,
+            refunded=debited, error=str(e)[:200], latency_ms=elapsed_ms(started),
+        )
+        # Refund only if the stake was actually deducted
+        if debited:
+            try:
+                await add_balance(user_id, amount, "bet_refund", "match", match_id, f"{stake_key}:refund")
+            except:
+                pass
         return False, f"Ошибка при размещении ставки: {str(e)}"
 
 
@@ -1033,6 +2066,7 @@ async def close_bet(match_id: int) -> Tuple[bool, str]:
 async def cancel_bet(match_id: int) -> Tuple[bool, str, int]:
     """Cancel a match and refund all bets."""
     refunded = 0
+    started = time.perf_counter()
     try:
         # получаем матч через helper (await безопасен, т.к. get_match — async)
         m = await get_match(match_id)
@@ -1047,7 +2081,7 @@ async def cancel_bet(match_id: int) -> Tuple[bool, str, int]:
         supabase.table("matches").update({"status": "cancelling"}).eq("id", int(match_id)).execute()
 
         # получаем ставки (синхронный вызов execute — НЕ await)
-        bets_res = supabase.table("bets").select("user_id,amount").eq("match_id", int(match_id)).execute()
+        bets_res = supabase.table("bets").select("id,user_id,amount").eq("match_id", int(match_id)).execute()
         bets = bets_res.data or []
 
         # делаем возвраты
@@ -1062,13 +2096,15 @@ async def cancel_bet(match_id: int) -> Tuple[bool, str, int]:
             if amt <= 0:
                 continue
 
-            await add_balance(uid, amt)
+            await add_balance(uid, amt, "bet_refund", "bet", bet["id"], f"bet:{bet['id']}:refund")
             refunded += amt
-            logger.info(f"[cancel_bet] refunded {amt} to user {uid} for match {match_id}")
+            logger.info("[cancel_bet] refunded %s to user %s for match %s", amt, uid, match_id)
+            emit_event("bet_refunded", match_id=int(match_id), bet_id=bet["id"], user_id=str(uid), amount=amt)
 
         # помечаем матч как отменённый
         supabase.table("matches").update({"status": "cancelled"}).eq("id", int(match_id)).execute()
-        logger.info(f"[cancel_bet] match={match_id} cancelled, total_refunded={refunded}")
+        logger.info("[cancel_bet] match=%s cancelled, total_refunded=%s", match_id, refunded)
+        emit_event("match_cancelled", match_id=int(match_id), bets=len(bets), refunded=refunded, latency_ms=elapsed_ms(started))
 
         return True, f"Матч отменен. Возвращено {refunded} поинтов.", refunded
 
@@ -1087,6 +2123,7 @@ async def settle_bet(match_id: int, winner: str) -> Tuple[bool, str]:
     winner = (winner or "").strip().upper()
     if winner not in ("A", "B"):
         return False, "winner должен быть 'A' или 'B'"
+    started = time.perf_counter()
 
     try:
         # 1) читаем матч (без await для supabase-py)
@@ -1111,6 +2148,10 @@ async def settle_bet(match_id: int, winner: str) -> Tuple[bool, str]:
         # Никто не ставил на победителя — всё сгорает
         if W <= 0:
             supabase.table("matches").update({"status": "settled"}).eq("id", int(match_id)).execute()
+            emit_event(
+                "match_settled", match_id=int(match_id), winner=winner, total_a=total_a, total_b=total_b,
+                distribute=0, burned=L, paid=0, latency_ms=elapsed_ms(started),
+            )
             return True, "Никто не ставил на победителя. Весь проигрыш сгорел."
 
         # 2) ставки победителей
@@ -1144,14 +2185,19 @@ async def settle_bet(match_id: int, winner: str) -> Tuple[bool, str]:
 
         # 4) выплаты: ставка + доля из проигравшего банка
         paid_total = 0
-        for _, uid, amt, part_int, _ in shares:
+        for bid, uid, amt, part_int, _ in shares:
             payout = int(amt) + int(part_int)
             paid_total += payout
-            await add_balance(int(uid), payout)
+            await add_balance(int(uid), payout, "bet_payout", "bet", bid, f"bet:{bid}:payout")
+            emit_event("bet_paid", match_id=int(match_id), bet_id=bid, user_id=str(uid), stake=int(amt), amount=payout)
 
         supabase.table("matches").update({"status": "settled"}).eq("id", int(match_id)).execute()
         burned = L - distribute
-        logger.info(f"[settle_bet] match={match_id} winner={winner} distribute={distribute} burned={burned} paid_total={paid_total}")
+        logger.info("[settle_bet] match=%s winner=%s distribute=%s burned=%s paid_total=%s", match_id, winner, distribute, burned, paid_total)
+        emit_event(
+            "match_settled", match_id=int(match_id), winner=winner, total_a=total_a, total_b=total_b,
+            distribute=distribute, burned=burned, paid=paid_total, latency_ms=elapsed_ms(started),
+        )
         return True, f"Выплаты завершены. Раздали {distribute} из банка проигравших."
     except Exception as e:
         logger.exception(f"Error settling bet for match {match_id}: {e}")
@@ -1196,6 +2242,176 @@ def get_dotabuff_account_id(steam_input: str) -> Optional[int]:
     except Exception as e:
         logger.error(f"Error extracting account_id from {steam_input}: {e}")
         return None
+# ---------------------- RENDERING ----------------------
+
+# Embeds собираются из компактных кортежей состояния: спецификация embed
+# мемоизируется по состоянию, а хэш последнего отправленного состояния
+# хранится по message_id, чтобы не редактировать сообщение без изменений.
+EmbedSpec = Tuple[str, Optional[str], int, Tuple[Tuple[str, str, bool], ...], Optional[str], Optional[str]]  # title, description, color, fields, footer, image
+SENT_STATE_LIMIT = 2048
+_sent_states: "OrderedDict[int, int]" = OrderedDict()  # {message_id: hash(state)}
+
+EH_EMOJI = "<:EH:1412492188809560196>"
+
+DUEL_STATUS_DISPLAY = {
+    "waiting": "Ожидание оппонента",
+    "active": "Активна",
+    "result_pending": "Ожидание результата",
+    "settled": "Завершена",
+    "cancelled": "Отменена",
+    "public": "Открыта для присоединения",
+    "queued": "В очереди",
+    "processing": "Обработка"
+}
+
+DUEL_HINTS = {
+    "waiting": "Ожидаем второго участника.",
+    "active": "Дуэль идёт! Загрузите скриншот через /submit_duel.",
+    "result_pending": "Ожидаем подтверждения от админа.",
+    "cancelled": "Дуэль отменена.",
+    "public": "Открыто для присоединения.",
+    "queued": "Ожидание бота Dota."
+}
+
+
+def embed_from_spec(spec: EmbedSpec) -> discord.Embed:
+    """Build a fresh Embed from a (memoized) spec; callers may mutate the result."""
+    title, description, color, fields, footer, image = spec
+    embed = discord.Embed(title=title, description=description, color=color)
+    for name, value, inline in fields:
+        embed.add_field(name=name, value=value, inline=inline)
+    if footer:
+        embed.set_footer(text=footer)
+    if image:
+        embed.set_image(url=image)
+    return embed
+
+
+def view_state(view: Optional[discord.ui.View]) -> tuple:
+    """Hashable summary of a view's buttons."""
+    if view is None:
+        return ()
+    return tuple(
+        (getattr(item, "custom_id", None), getattr(item, "label", None), getattr(item, "disabled", False))
+        for item in view.children
+    )
+
+
+def remember_sent_state(message_id: int, state: tuple):
+    _sent_states[message_id] = hash(state)
+    _sent_states.move_to_end(message_id)
+    while len(_sent_states) > SENT_STATE_LIMIT:
+        _sent_states.popitem(last=False)
+
+
+async def edit_if_changed(message, state: tuple, **kwargs) -> bool:
+    """Edit message unless state matches what was last sent to it. Returns True if an edit went out."""
+    # Пока правка стоит в очереди, новое состояние склеивается с ней
+    if not outbound.edit_pending(message.id) and _sent_states.get(message.id) == hash(state):
+        return False
+    await outbound.edit(message, state=state, **kwargs)
+    return True
+
+
+@lru_cache(maxsize=512)
+def render_duel_spec(state: tuple) -> EmbedSpec:
+    duel_id, duel_type, status, points, player1_id, player2_id, team1_name, team2_name, winner_side, screenshot_url = state
+
+    # Логика цветов по статусу
+    if status in ["waiting", "public"]:
+        color = discord.Color.green()  # Зеленый: новая/открытая
+    elif status == "active":
+        color = discord.Color.yellow()  # Желтый: активна
+    elif status == "settled":
+        color = discord.Color.red()     # Красный: завершена успешно
+    elif status == "cancelled":
+        color = discord.Color.dark_grey()  # Серый/черный: отменена
+    else:
+        color = discord.Color.blue()
+
+    fields = []
+    if duel_type == "1v1":
+        p2 = f"<@{player2_id}>" if player2_id else "Свободно"
+        fields.append(("Участники", f"<@{player1_id}> vs {p2}", False))
+    else:  # 5v5
+        fields.append(("Команды", f"{team1_name} vs {team2_name}", False))
+
+    fields.append(("Ставка", f"{points} EH Points", True))
+    fields.append(("Статус", DUEL_STATUS_DISPLAY.get(status, status), True))
+
+    if status == "settled":
+        total_pot = points * 2
+        burned_amount = int(total_pot * DEFAULT_BURN)
+        payout = total_pot - burned_amount
+        fields.append(("Победитель", f"{winner_side or 'N/A'} (+{payout} поинтов)", False))
+        fields.append(("Сгорело", f"{burned_amount} поинтов", True))
+    else:
+        hint = DUEL_HINTS.get(status, "")
+        if hint:
+            fields.append(("Подсказка", hint, False))
+
+    return (f"⚔️ Дуэль: {duel_type}", None, color.value, tuple(fields), f"ID дуэли: {duel_id}", screenshot_url)
+
+
+async def duel_render_state(duel: dict) -> tuple:
+    """Compact, hashable state of everything build_duel_embed shows."""
+    team1_name = team2_name = None
+    if duel["type"] != "1v1":
+        team1, team2 = await asyncio.gather(get_team(duel.get("team1_id")), get_team(duel.get("team2_id")))
+        team1_name = team1["name"] if team1 else "Свободно"
+        team2_name = team2["name"] if team2 else "Свободно"
+    return (
+        duel["id"], duel["type"], duel["status"], int(duel.get("points") or 0),
+        duel.get("player1_id"), duel.get("player2_id"), team1_name, team2_name,
+        duel.get("winner_side"), duel.get("screenshot_url"),
+    )
+
+
+@lru_cache(maxsize=512)
+def render_match_spec(state: tuple) -> EmbedSpec:
+    match_id, team_a, team_b, total_a, total_b, status = state
+    color = discord.Color.dark_gray() if status in ["settled", "cancelled"] else discord.Color.blurple()
+    fields = (
+        (f"Банк {team_a}", f"{total_a} {EH_EMOJI}", True),
+        (f"Банк {team_b}", f"{total_b} {EH_EMOJI}", True),
+        ("Статус", status, False),
+    )
+    return (f"Матч: {team_a} vs {team_b}", None, color.value, fields, f"match:{match_id}", None)
+
+
+def match_render_state(m: dict) -> tuple:
+    return (
+        int(m["id"]), m["team_a"], m["team_b"],
+        int(m["total_a"]) if m.get("total_a") else 0,
+        int(m["total_b"]) if m.get("total_b") else 0,
+        m["status"],
+    )
+
+
+@lru_cache(maxsize=256)
+def render_leaderboard_spec(rows: Tuple[Tuple[str, int], ...], start: int, page: int, max_page: int) -> EmbedSpec:
+    desc = "\n".join(
+        [f"**{i+1}.** <@{user_id}> — {balance}💰" for i, (user_id, balance) in enumerate(rows, start=start)]
+    )
+    return (f"🏆 Лидерборд (стр. {page+1}/{max_page+1})", desc, discord.Color.gold().value, (), None, None)
+
+
+@lru_cache(maxsize=256)
+def render_teams_spec(rows: tuple, start: int, page: int, max_page: int) -> EmbedSpec:
+    players_list = []
+    for i, (name, status, is_public, leader_id, players) in enumerate(rows, start=start):
+        participants_str = " ".join([f"<@{p}>" for p in players if p != leader_id]) if players else "❌ Нет участников"
+        status_emoji = "✅" if status == "confirmed" else "⏳"
+        type_str = "🌍 Публичная" if is_public else "🔒 Приватная"
+        players_list.append(
+            f"**{i + 1}. {name}** {status_emoji} {type_str}\n"
+            f"👑 **Лидер:** <@{leader_id}>\n"
+            f"👥 **Участники:** {participants_str}"
+        )
+    desc = "\n\n".join(players_list) or "Нет команд"
+    return (f"👥 Команды (стр. {page+1}/{max_page+1})", desc, discord.Color.blue().value, (), None, None)
+
+
 # ---------------------- UI ----------------------
 
 
@@ -1211,7 +2427,7 @@ class ManualMMRView(discord.ui.View):
 class LeaderboardView(discord.ui.View):
     def __init__(self, data, per_page=10):
         super().__init__(timeout=120)
-        self.data = data
+        self.rows = tuple((row["user_id"], row["balance"]) for row in data)
         self.per_page = per_page
         self.page = 0
         self.max_page = (len(data) - 1) // per_page
@@ -1224,31 +2440,28 @@ class LeaderboardView(discord.ui.View):
         self.add_item(self.prev_button)
         self.add_item(self.next_button)
 
-    async def update_message(self, interaction):
+    def page_embed(self) -> discord.Embed:
         start = self.page * self.per_page
-        end = start + self.per_page
-        chunk = self.data[start:end]
+        return embed_from_spec(render_leaderboard_spec(self.rows[start:start + self.per_page], start, self.page, self.max_page))
 
-        desc = "\n".join(
-            [f"**{i+1}.** <@{row['user_id']}> — {row['balance']}💰" for i, row in enumerate(chunk, start=start)]
-        )
-
-        embed = discord.Embed(
-            title=f"🏆 Лидерборд (стр. {self.page+1}/{self.max_page+1})",
-            description=desc,
-            color=discord.Color.gold()
-        )
-        await interaction.response.edit_message(embed=embed, view=self)
+    async def update_message(self, interaction, changed: bool = True):
+        # Крайняя страница: отвечаем без правки сообщения
+        if not changed:
+            await interaction.response.defer()
+            return
+        await interaction.response.edit_message(embed=self.page_embed(), view=self)
 
     async def prev_page(self, interaction):
-        if self.page > 0:
+        changed = self.page > 0
+        if changed:
             self.page -= 1
-        await self.update_message(interaction)
+        await self.update_message(interaction, changed)
 
     async def next_page(self, interaction):
-        if self.page < self.max_page:
+        changed = self.page < self.max_page
+        if changed:
             self.page += 1
-        await self.update_message(interaction)
+        await self.update_message(interaction, changed)
 
 class BetAmountModal(discord.ui.Modal, title="Введите сумму ставки"):
     def __init__(self, match_id: int, team: str):
@@ -1300,65 +2513,16 @@ class TeamInviteView(discord.ui.View):
         )
         self.add_item(self.decline_button)
 
-    async def accept_team(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.user_id:
-            await interaction.response.send_message("Это не ваше приглашение.", ephemeral=True)
-            return
-        # Проверяем статус
-        invite_resp = supabase.table("team_invites").select("status, team_id").eq("id", self.invite_id).execute()
-        if not invite_resp.data or invite_resp.data[0]["status"] != "pending":
-            await interaction.response.send_message("Приглашение устарело.", ephemeral=True)
-            return
-        team_id = int(invite_resp.data[0]["team_id"])
-        team = supabase.table("teams").select("*").eq("id", team_id).execute().data[0]
-        player_count = sum(1 for i in range(1, 6) if team.get(f"player{i}_id"))
-        if player_count >= 5:
-            await interaction.response.send_message("Команда заполнена.", ephemeral=True)
-            return
-        # Обновляем
-        supabase.table("team_invites").update({"status": "accepted"}).eq("id", self.invite_id).execute()
-        updates = {}
-        for i in range(1, 6):
-            if team.get(f"player{i}_id") is None:
-                updates[f"player{i}_id"] = str(self.user_id)
-                break
-        if updates:
-            supabase.table("teams").update(updates).eq("id", team_id).execute()
-            # Check all invites
-            invites = supabase.table("team_invites").select("status").eq("team_id", team_id).execute().data
-            if all(invite["status"] == "accepted" for invite in invites):
-                supabase.table("teams").update({"status": "confirmed"}).eq("id", team_id).execute()
-        # Assign role
-        guild = interaction.guild
-        if guild:
-            member = guild.get_member(self.user_id)
-            if member:
-                await assign_team_role(guild, member, team["name"])
-        # Уведомить лидера
-        leader_id = int(team["leader_id"])
-        leader = bot.get_user(leader_id)
-        if leader:
-            await safe_send(leader, f"<@{self.user_id}> присоединился к вашей команде!")
-        # Ответ и disable
-        await interaction.response.send_message("Вы присоединились к команде!", ephemeral=True)
-        button.disabled = True
-        self.decline_button.disabled = True
-        await interaction.edit_original_response(view=self)
-
-    async def decline_team(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.user_id:
-            await interaction.response.send_message("Это не ваше приглашение.", ephemeral=True)
-            return
-        supabase.table("team_invites").update({"status": "declined"}).eq("id", self.invite_id).execute()
-        await interaction.response.send_message("Вы отклонили приглашение.", ephemeral=True)
-        self.accept_button.disabled = True
-        button.disabled = True
-        await interaction.edit_original_response(view=self)
-    
 class TeamsView(discord.ui.View):
     def __init__(self, data, per_page=10):
         super().__init__(timeout=120)
-        self.data = data
+        self.rows = tuple(
+            (
+                row["name"], row["status"], bool(row["is_public"]), row["leader_id"],
+                tuple(row.get(f"player{j}_id") for j in range(1, 6) if row.get(f"player{j}_id")),
+            )
+            for row in data
+        )
         self.per_page = per_page
         self.page = 0
         self.max_page = (len(data) - 1) // per_page
@@ -1371,41 +2535,27 @@ class TeamsView(discord.ui.View):
         self.add_item(self.prev_button)
         self.add_item(self.next_button)
 
-    async def update_message(self, interaction):
+    def page_embed(self) -> discord.Embed:
         start = self.page * self.per_page
-        end = start + self.per_page
-        chunk = self.data[start:end]
-
-        players_list = []
-        for i, row in enumerate(chunk, start=start):
-            players = [row.get(f'player{j}_id') for j in range(1, 6) if row.get(f'player{j}_id')]
-            participants_str = " ".join([f"<@{p}>" for p in players if p != row['leader_id']]) if players else "❌ Нет участников"
-            status_emoji = "✅" if row['status'] == "confirmed" else "⏳"
-            type_str = "🌍 Публичная" if row['is_public'] else "🔒 Приватная"
-            players_list.append(
-                f"**{start + i + 1}. {row['name']}** {status_emoji} {type_str}\n"
-                f"👑 **Лидер:** <@{row['leader_id']}>\n"
-                f"👥 **Участники:** {participants_str}"
-            )
+        return embed_from_spec(render_teams_spec(self.rows[start:start + self.per_page], start, self.page, self.max_page))
 
-        desc = "\n\n".join(players_list) or "Нет команд"
-
-        embed = discord.Embed(
-            title=f"👥 Команды (стр. {self.page+1}/{self.max_page+1})",
-            description=desc,
-            color=discord.Color.blue()
-        )
-        await interaction.response.edit_message(embed=embed, view=self)
+    async def update_message(self, interaction, changed: bool = True):
+        if not changed:
+            await interaction.response.defer()
+            return
+        await interaction.response.edit_message(embed=self.page_embed(), view=self)
 
     async def prev_page(self, interaction):
-        if self.page > 0:
+        changed = self.page > 0
+        if changed:
             self.page -= 1
-        await self.update_message(interaction)
+        await self.update_message(interaction, changed)
 
     async def next_page(self, interaction):
-        if self.page < self.max_page:
+        changed = self.page < self.max_page
+        if changed:
             self.page += 1
-        await self.update_message(interaction)
+        await self.update_message(interaction, changed)
 
 class DuelInviteView(discord.ui.View):
     def __init__(self, duel_id: int, invitee_id: Optional[int] = None):
@@ -1502,14 +2652,14 @@ class ModeratorDuelView(discord.ui.View):
             style=discord.ButtonStyle.secondary, 
             custom_id=f"mod_cancel_duel:{duel_id}:{guild_id}"
         ))
-        logger.info(f"Created ModeratorDuelView for duel={duel_id}, guild={guild_id}, children={len(self.children)}")  # Дебаг: должно быть 4
+        render_log.debug("Created ModeratorDuelView for duel=%s, guild=%s, children=%d", duel_id, guild_id, len(self.children))  # должно быть 4
 
     async def on_interaction(self, interaction: discord.Interaction):
         """Handle all button clicks by parsing custom_id."""
         custom_id = interaction.data.get('custom_id', '')
         await interaction.response.defer(ephemeral=True)  # Defer всегда
         
-        logger.info(f"Button clicked: custom_id={custom_id}, user={interaction.user.id}")
+        router_log.debug("Button clicked: custom_id=%s, user=%s", custom_id, interaction.user.id)
         
         if not await is_moderator(interaction.user.id, self.guild_id):
             await interaction.followup.send("❌ Вы не модератор.", ephemeral=True)
@@ -1518,66 +2668,47 @@ class ModeratorDuelView(discord.ui.View):
             return
         
         if custom_id.startswith("mod_settle_a:"):
-            await self._handle_settle(interaction, "A")
+            return await self._handle_settle(interaction, "A")
         elif custom_id.startswith("mod_settle_b:"):
-            await self._handle_settle(interaction, "B")
+            return await self._handle_settle(interaction, "B")
         elif custom_id.startswith("mod_cancel_result:"):
-            await self._handle_cancel_result(interaction)
+            return await self._handle_cancel_result(interaction)
         elif custom_id.startswith("mod_cancel_duel:"):
-            await self._handle_cancel_duel(interaction)
+            return await self._handle_cancel_duel(interaction)
         else:
             await interaction.followup.send("❌ Неизвестная кнопка.", ephemeral=True)
             self.disable_all_items()
             await interaction.edit_original_response(view=self)
 
     async def _handle_settle(self, interaction: discord.Interaction, winner_side: str):
+        # Публичное сообщение обновляет сам settle_duel
         ok, msg = await settle_duel(self.duel_id, winner_side)
         if ok:
             await interaction.followup.send(f"✅ {msg}", ephemeral=True)
-            # Обновляем публичное сообщение
-            duel = await get_duel(self.duel_id)
-            if duel and duel.get("message_id"):
-                channel = bot.get_channel(int(duel["channel_id"]))
-                if channel:
-                    try:
-                        pub_msg = await channel.fetch_message(int(duel["message_id"]))
-                        await refresh_duel_message(pub_msg, duel)
-                    except Exception as e:
-                        logger.error(f"Failed to refresh public after settle {self.duel_id}: {e}")
         else:
             await interaction.followup.send(f"❌ {msg}", ephemeral=True)
         self.disable_all_items()
         await interaction.edit_original_response(view=self)
+        return f"✅ {msg}" if ok else None
 
     async def _handle_cancel_result(self, interaction: discord.Interaction):
-        await update_duel_status(self.duel_id, "result_canceled")
-        duel = await get_duel(self.duel_id)
-        await interaction.followup.send("✅ Результат отменён.", ephemeral=True)
-        if duel and duel.get("message_id"):
-            channel = bot.get_channel(int(duel["channel_id"]))
-            if channel:
-                try:
-                    pub_msg = await channel.fetch_message(int(duel["message_id"]))
-                    await refresh_duel_message(pub_msg, duel)
-                except Exception as e:
-                    logger.error(f"Failed to refresh after cancel_result {self.duel_id}: {e}")
+        duel = await transition_duel(self.duel_id, ("result_pending",), status="result_canceled")
+        if duel:
+            on_duel_status_change(self.duel_id, "result_canceled", via="moderator", user_id=str(interaction.user.id))
+            await interaction.followup.send("✅ Результат отменён.", ephemeral=True)
+            await refresh_duel_channel_message(duel)
+        else:
+            await interaction.followup.send("Дуэль уже завершена или отменена.", ephemeral=True)
         self.disable_all_items()
         await interaction.edit_original_response(view=self)
+        return "✅ Результат отменён." if duel else None
 
     async def _handle_cancel_duel(self, interaction: discord.Interaction):
-        duel = await get_duel(self.duel_id)
+        # Отмена конкурирует с расчётом: холды снимает только выигравший переход
+        duel = await transition_duel(self.duel_id, LIVE_DUEL_STATUSES, status="cancelled")
         if duel:
-            points = int(duel["points"])
-            if duel["type"] == "1v1":
-                await add_balance(int(duel["player1_id"]), points)
-                if duel["player2_id"]:
-                    await add_balance(int(duel["player2_id"]), points)
-            else:
-                l1 = await get_team_leader(int(duel["team1_id"]))
-                l2 = await get_team_leader(int(duel["team2_id"]))
-                if l1: await add_balance(l1, points)
-                if l2: await add_balance(l2, points)
-            await update_duel_status(self.duel_id, "cancelled")
+            on_duel_status_change(self.duel_id, "cancelled", via="moderator", user_id=str(interaction.user.id))
+            await release_duel_holds(self.duel_id)
             await interaction.followup.send("✅ Дуэль отменена, поинты возвращены.", ephemeral=True)
             if duel.get("message_id"):
                 channel = bot.get_channel(int(duel["channel_id"]))
@@ -1587,44 +2718,34 @@ class ModeratorDuelView(discord.ui.View):
                         await refresh_duel_message(pub_msg, duel)
                     except Exception as e:
                         logger.error(f"Failed to refresh after cancel_duel {self.duel_id}: {e}")
+        else:
+            await interaction.followup.send("Дуэль уже завершена или отменена.", ephemeral=True)
         self.disable_all_items()
         await interaction.edit_original_response(view=self)
+        return "✅ Дуэль отменена, поинты возвращены." if duel else None
 
     def disable_all_items(self):
         for item in self.children:
             item.disabled = True
 
 async def refresh_match_message(interaction: discord.Interaction, match_id: int, edit_message: bool = False):
-    """Refresh the match message with updated data."""
+    """Refresh the match message with updated data (skipped when nothing visible changed)."""
     m = await get_match(match_id)
     if not m:
         return
-    total_a = int(m["total_a"]) if m["total_a"] else 0
-    total_b = int(m["total_b"]) if m["total_b"] else 0
-    team_a = m["team_a"]
-    team_b = m["team_b"]
-    status = m["status"]
-    burn = float(m["burn"]) if m["burn"] is not None else DEFAULT_BURN
-
-    EH_EMOJI = "<:EH:1412492188809560196>"
-
-    embed = discord.Embed(title=f"Матч: {team_a} vs {team_b}", color=discord.Color.dark_gray() if status in ["settled", "cancelled"] else discord.Color.blurple())
-    embed.add_field(name=f"Банк {team_a}", value=f"{total_a} {EH_EMOJI}", inline=True)
-    embed.add_field(name=f"Банк {team_b}", value=f"{total_b} {EH_EMOJI}", inline=True)
-    embed.add_field(name="Статус", value=status, inline=False)
-    embed.set_footer(text=f"match:{match_id}")
-
-
-    view = MatchView(match_id, team_a, team_b, status)
+    state = match_render_state(m)
+    embed = embed_from_spec(render_match_spec(state))
+    view = MatchView(match_id, m["team_a"], m["team_b"], m["status"])
 
     try:
         if edit_message and interaction.message:
-            await interaction.message.edit(embed=embed, view=view)
+            message = interaction.message
         else:
             channel = bot.get_channel(int(m["channel_id"]))
-            if channel is not None:
-                msg = await channel.fetch_message(int(m["message_id"]))
-                await msg.edit(embed=embed, view=view)
+            if channel is None or not m.get("message_id"):
+                return
+            message = channel.get_partial_message(int(m["message_id"]))
+        await edit_if_changed(message, (state, view_state(view)), embed=embed, view=view)
     except discord.HTTPException as e:
         logger.error(f"Failed to edit message for match {match_id}: {e}")
         if interaction.response.is_done():
@@ -1632,189 +2753,74 @@ async def refresh_match_message(interaction: discord.Interaction, match_id: int,
         else:
             await interaction.response.send_message("❌ Не удалось обновить сообщение матча.", ephemeral=True)
 
-async def refresh_duel_message(message: discord.Message, duel: dict):
-    """Refresh the duel message with updated data."""
-    # Сохраняем старую картинку, если была
-    old_embed = message.embeds[0] if message.embeds else None
-    screenshot_url = old_embed.image.url if old_embed and old_embed.image else None
-    
-    embed = await build_duel_embed(duel)
-    if screenshot_url:
-        embed.set_image(url=screenshot_url)
-
-    guild = message.guild  # Получаем guild из сообщения
 
-    # ---------- Отладка ----------
-    logger.info(f"DEBUG duel dict: {duel}")
-    logger.info(f"DEBUG duel type: {duel.get('type')} status: {duel.get('status')}")
+# ---------------------- SLASH COMMANDS ----------------------
 
-    # ---------- Определение имён ----------
-    winner_a_name = f"Игрок {duel.get('player1_id', '?')}"
-    winner_b_name = f"Игрок {duel.get('player2_id', '?')}"
+async def safe_send(target, priority: int = PRIORITY_MESSAGE, **kwargs):
+    """Safely send message to channel or user through the outbound scheduler, handling Forbidden."""
+    if not isinstance(target, discord.abc.Messageable):
+        logger.warning(f"Invalid target for safe_send: {type(target)}")
+        return None
 
     try:
-        if duel["type"] == "1v1":
-            player1_id = duel.get("player1_id")
-            player2_id = duel.get("player2_id")
+        return await outbound.submit(route_for(target), lambda: target.send(**kwargs), priority)
+    except discord.Forbidden:
+        logger.warning(f"Cannot send to {target}: DMs closed or no perms")
+        return None
+    except discord.HTTPException as e:
+        logger.error(f"HTTP error sending message: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"Unexpected error sending message: {e}")
+        return None
 
-            if player1_id:
-                try:
-                    member1 = guild.get_member(int(player1_id)) if guild else None
-                    if member1:
-                        winner_a_name = member1.display_name
-                except Exception as e:
-                    logger.warning(f"Ошибка при обработке player1_id {player1_id}: {e}")
+DM_FANOUT_CONCURRENCY = int(os.getenv("DM_FANOUT_CONCURRENCY", "5"))
 
-            if player2_id:
-                try:
-                    member2 = guild.get_member(int(player2_id)) if guild else None
-                    if member2:
-                        winner_b_name = member2.display_name
-                except Exception as e:
-                    logger.warning(f"Ошибка при обработке player2_id {player2_id}: {e}")
 
-        elif duel["type"] == "5v5":
-            team1_leader = await get_team_leader(int(duel.get("team1_id", 0)))
-            if team1_leader:
-                member1 = guild.get_member(team1_leader) if guild else None
-                winner_a_name = member1.display_name if member1 else f"Лидер {team1_leader}"
+class DMResult(NamedTuple):
+    user_id: int
+    ok: bool
+    error: Optional[str]  # причина для отчёта пользователю
+    message: Optional[discord.Message] = None
 
-            team2_leader = await get_team_leader(int(duel.get("team2_id", 0)))
-            if team2_leader:
-                member2 = guild.get_member(team2_leader) if guild else None
-                winner_b_name = member2.display_name if member2 else f"Лидер {team2_leader}"
 
-    except Exception as e:
-        logger.error(f"Ошибка при определении имён: {e}")
+async def fan_out_dms(deliveries: List[Tuple[discord.abc.User, dict]], concurrency: int = DM_FANOUT_CONCURRENCY) -> List[DMResult]:
+    """Send DMs concurrently (at most `concurrency` in flight); one result per recipient, in order."""
+    semaphore = asyncio.Semaphore(concurrency)
 
-    logger.info(f"Names for duel {duel['id']}: A='{winner_a_name}', B='{winner_b_name}'")
+    async def deliver(user, kwargs) -> DMResult:
+        async with semaphore:
+            try:
+                message = await outbound.submit(route_for(user), lambda: user.send(**kwargs), PRIORITY_MESSAGE)
+                return DMResult(user.id, True, None, message)
+            except discord.Forbidden:
+                return DMResult(user.id, False, "ЛС закрыты")
+            except discord.HTTPException as e:
+                logger.error(f"HTTP error sending DM to {user.id}: {e}")
+                return DMResult(user.id, False, "ошибка Discord")
+            except Exception as e:
+                logger.error(f"Unexpected error sending DM to {user.id}: {e}")
+                return DMResult(user.id, False, "ошибка отправки")
 
-    # ---------- Цвет и подсказка для отменённого результата ----------
-    if duel.get("status") == "result_canceled":
-        embed.color = discord.Color.grey()  # Серая линия
-        embed.add_field(name="Статус", value="Результат отменён", inline=False)  # Подсказка
+    return list(await asyncio.gather(*(deliver(user, kwargs) for user, kwargs in deliveries)))
 
-    # ---------- Кнопки ----------
-    view = discord.ui.View()
-    if duel["status"] == "waiting" and not duel["is_public"]:
-        invitee_id = duel.get("player2_id") if duel["type"] == "1v1" else await get_team_leader(int(duel.get("team2_id", 0)))
-        if invitee_id:
-            view.add_item(discord.ui.Button(label="Присоединиться", style=discord.ButtonStyle.success, custom_id=f"duel_accept:{duel['id']}:{invitee_id}"))
-            view.add_item(discord.ui.Button(label="Отклонить", style=discord.ButtonStyle.danger, custom_id=f"duel_decline:{duel['id']}:{invitee_id}"))
-    elif duel["status"] == "public" and duel["type"] in ["1v1", "5v5"]:
-        view.add_item(discord.ui.Button(label="Присоединиться", style=discord.ButtonStyle.success, custom_id=f"join_public_duel:{duel['id']}"))
-    elif duel["status"] == "result_pending":
-        view = discord.ui.View()
-    # ✅ Убрана кнопка "Отменить дуэль" полностью
-    # Если статус "result_canceled" — view пустой (все кнопки пропадают)
 
-    # ---------- Обновление сообщения ----------
+async def record_invite_message(table: str, filters: dict, message: Optional[discord.Message]):
+    """Remember where an invite DM landed so the expiry sweeper can disable its buttons."""
+    if message is None:
+        return
+    query = supabase.table(table).update({"channel_id": str(message.channel.id), "message_id": str(message.id)})
+    for column, value in filters.items():
+        query = query.eq(column, value)
     try:
-        await message.edit(embed=embed, view=view)
-        logger.info(f"Successfully edited duel message {duel['id']}")
+        await asyncio.to_thread(query.execute)
     except Exception as e:
-        logger.error(f"Failed to edit duel message {duel['id']}: {e}")
+        logger.error(f"Failed to record invite message in {table}: {e}")
 
 
-
-
-# ---------------------- SLASH COMMANDS ----------------------
-
-async def safe_send(target, **kwargs):
-    """Safely send message to channel or user, handling Forbidden and rate limits."""
-    if not isinstance(target, discord.abc.Messageable):
-        logger.warning(f"Invalid target for safe_send: {type(target)}")
-        return None
-    
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            return await target.send(**kwargs)
-        except discord.Forbidden:
-            logger.warning(f"Cannot send to {target}: DMs closed or no perms")
-            return None
-        except discord.HTTPException as e:
-            if e.status == 429:  # Rate limit
-                retry_after = getattr(e, 'retry_after', 1)
-                logger.warning(f"Rate limited, retrying in {retry_after}s (attempt {attempt + 1})")
-                await asyncio.sleep(retry_after)
-                continue
-            logger.error(f"HTTP error sending message: {e}")
-            return None
-        except Exception as e:
-            logger.error(f"Unexpected error sending message: {e}")
-            if attempt == max_retries - 1:
-                return None
-            await asyncio.sleep(2 ** attempt)  # Exponential backoff
-    return None
-
 async def build_duel_embed(duel: dict) -> discord.Embed:
-    embed = discord.Embed(title=f"⚔️ Дуэль: {duel['type']}", color=discord.Color.blue())  # Default blue
-    
-    # Логика цветов по статусу
-    if duel["status"] in ["waiting", "public"]:
-        embed.color = discord.Color.green()  # Зеленый: новая/открытая
-    elif duel["status"] == "active":
-        embed.color = discord.Color.yellow()  # Желтый: активна
-    elif duel["status"] == "settled":
-        embed.color = discord.Color.red()     # Красный: завершена успешно
-    elif duel["status"] == "cancelled":
-        embed.color = discord.Color.dark_grey()  # Серый/черный: отменена
-    
-    if duel.get("screenshot_url"):
-        embed.set_image(url=duel["screenshot_url"])
-    
-    if duel["type"] == "1v1":
-        p1 = f"<@{duel.get('player1_id', 'N/A')}>"
-        p2 = f"<@{duel.get('player2_id', 'N/A')}> " if duel.get('player2_id') else "Свободно"
-        embed.add_field(name="Участники", value=f"{p1} vs {p2}", inline=False)
-    else:  # 5v5
-        team1_id = int(duel.get('team1_id', 0))
-        team2_id = int(duel.get('team2_id', 0))
-        team1 = await get_team(team1_id)
-        team2 = await get_team(team2_id)
-        team1_name = team1["name"] if team1 else "Свободно"
-        team2_name = team2["name"] if team2 else "Свободно"
-        embed.add_field(name="Команды", value=f"{team1_name} vs {team2_name}", inline=False)
-    
-    embed.add_field(name="Ставка", value=f"{duel['points']} EH Points", inline=True)
-    
-    # Унифицированный статус на русский
-    status_display = {
-        "waiting": "Ожидание оппонента",
-        "active": "Активна",
-        "result_pending": "Ожидание результата",
-        "settled": "Завершена",
-        "cancelled": "Отменена",
-        "public": "Открыта для присоединения",
-        "queued": "В очереди",
-        "processing": "Обработка"
-    }
-    embed.add_field(name="Статус", value=status_display.get(duel["status"], duel["status"]), inline=True)
-    
-    if duel["status"] == "settled":
-        winner_side = duel.get("winner_side", "N/A")
-        points = duel.get("points", 0)
-        total_pot = points * 2
-        burned_amount = int(total_pot * DEFAULT_BURN)
-        payout = total_pot - burned_amount
-        embed.add_field(name="Победитель", value=f"{winner_side} (+{payout} поинтов)", inline=False)
-        embed.add_field(name="Сгорело", value=f"{burned_amount} поинтов", inline=True)
-    else:
-        hints = {
-            "waiting": "Ожидаем второго участника.",
-            "active": "Дуэль идёт! Загрузите скриншот через /submit_duel.",
-            "result_pending": "Ожидаем подтверждения от админа.",
-            "cancelled": "Дуэль отменена.",
-            "public": "Открыто для присоединения.",
-            "queued": "Ожидание бота Dota."
-        }
-        hint = hints.get(duel["status"], "")
-        if hint:
-            embed.add_field(name="Подсказка", value=hint, inline=False)
-
+    embed = embed_from_spec(render_duel_spec(await duel_render_state(duel)))
     embed.timestamp = discord.utils.utcnow()
-    embed.set_footer(text=f"ID дуэли: {duel['id']}")
     return embed
 
 async def get_team_steam_ids(team_id: int) -> List[str]:
@@ -1858,568 +2864,551 @@ async def on_ready():
     except Exception as e:
         logger.error(f"Ошибка синхронизации команд: {e}")
 
-@bot.event
-async def on_interaction(interaction: discord.Interaction):
-    if interaction.type != discord.InteractionType.component:
+# ---------------------- BUTTON ROUTER ----------------------
+
+# custom_id имеет вид "<prefix>:<arg1>:<arg2>..." — prefix выбирает обработчик.
+# Обработчик idempotent-маршрута возвращает текст результата при успехе (None —
+# отказ/ошибка, результат не запоминается).
+ButtonHandler = Callable[[discord.Interaction, List[str]], Awaitable[Optional[str]]]
+
+
+class ButtonRoute(NamedTuple):
+    handler: ButtonHandler
+    min_args: int
+    idempotent: bool  # повтор того же действия тем же пользователем получает сохранённый ответ
+    money: bool       # дополнительно квитанция в БД (interaction_receipts)
+
+
+BUTTON_ROUTES: Dict[str, ButtonRoute] = {}
+ROUTE_STATS: Dict[str, List[float]] = {}  # {prefix: [calls, total_seconds, max_seconds]}
+
+
+def button_route(prefix: str, min_args: int = 0, idempotent: bool = False, money: bool = False):
+    """Регистрирует обработчик кнопки для custom_id с указанным префиксом."""
+    def decorator(func: ButtonHandler) -> ButtonHandler:
+        if prefix in BUTTON_ROUTES:
+            raise ValueError(f"Duplicate button route: {prefix}")
+        BUTTON_ROUTES[prefix] = ButtonRoute(func, min_args, idempotent or money, money)
+        return func
+    return decorator
+
+
+# ---------------------- IDEMPOTENCY ----------------------
+
+# Повторная доставка interaction отсекается по interaction.id; двойной клик —
+# по ключу действия "<custom_id>:<user_id>". Результат держится в памяти
+# IDEMPOTENCY_TTL секунд; для денежных действий ещё и квитанция в БД, которая
+# переживает перезапуск. Повторы отвечают сохранённым текстом без запросов.
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "30"))
+RECEIPT_STALE_SECONDS = int(os.getenv("RECEIPT_STALE_SECONDS", "120"))
+IDEMPOTENCY_LIMIT = 4096
+DUPLICATE_DONE = "✅ Это действие уже выполнено."
+DUPLICATE_IN_FLIGHT = "⏳ Это действие уже выполняется."
+_seen_interactions: "OrderedDict[int, None]" = OrderedDict()
+_action_results: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()  # {key: (expires, result)}
+_actions_in_flight: Set[str] = set()
+
+
+def _bounded_put(store: OrderedDict, key, value):
+    store[key] = value
+    store.move_to_end(key)
+    while len(store) > IDEMPOTENCY_LIMIT:
+        store.popitem(last=False)
+
+
+def first_delivery(interaction: discord.Interaction) -> bool:
+    """False if this interaction id was already dispatched."""
+    if interaction.id in _seen_interactions:
+        return False
+    _bounded_put(_seen_interactions, interaction.id, None)
+    return True
+
+
+def cached_action_result(key: str) -> Optional[str]:
+    entry = _action_results.get(key)
+    if entry is None:
+        return None
+    if entry[0] < time.monotonic():
+        del _action_results[key]
+        return None
+    return entry[1]
+
+
+async def claim_receipt(key: str, interaction_id: int) -> Tuple[bool, Optional[str]]:
+    """Claim a DB receipt for a money action. Returns (claimed, stored result)."""
+    response = await asyncio.to_thread(
+        supabase.rpc("claim_interaction_receipt", {
+            "p_key": key,
+            "p_interaction_id": str(interaction_id),
+            "p_stale_seconds": RECEIPT_STALE_SECONDS,
+        }).execute
+    )
+    row = (response.data or [{}])[0]
+    return bool(row.get("claimed")), row.get("result")
+
+
+async def finish_receipt(key: str, interaction_id: int, result: Optional[str]):
+    """Store the result, or drop the claim when the action did not complete (so it can be retried)."""
+    table = supabase.table("interaction_receipts")
+    if result is None:
+        builder = table.delete().eq("action_key", key).eq("interaction_id", str(interaction_id)).is_("completed_at", "null")
+    else:
+        builder = table.update({"result": result, "completed_at": discord.utils.utcnow().isoformat()}) \
+            .eq("action_key", key).eq("interaction_id", str(interaction_id))
+    try:
+        await asyncio.to_thread(builder.execute)
+    except Exception as e:
+        logger.error(f"Failed to finish receipt {key}: {e}")
+
+
+async def reply_duplicate(interaction: discord.Interaction, text: str):
+    try:
+        if interaction.response.is_done():
+            await interaction.followup.send(text, ephemeral=True)
+        else:
+            await interaction.response.send_message(text, ephemeral=True)
+    except discord.HTTPException:
+        pass
+
+
+async def run_idempotent(route: ButtonRoute, interaction: discord.Interaction, args: List[str], key: str) -> Optional[str]:
+    """Run an idempotent route once per action key; duplicates get the stored result."""
+    cached = cached_action_result(key)
+    if cached is not None:
+        await reply_duplicate(interaction, cached)
+        return cached
+    if key in _actions_in_flight:
+        await reply_duplicate(interaction, DUPLICATE_IN_FLIGHT)
+        return None
+
+    _actions_in_flight.add(key)
+    result = None
+    try:
+        if route.money:
+            claimed, stored = await claim_receipt(key, interaction.id)
+            if not claimed:
+                text = stored or DUPLICATE_IN_FLIGHT
+                if stored:
+                    _bounded_put(_action_results, key, (time.monotonic() + IDEMPOTENCY_TTL, stored))
+                await reply_duplicate(interaction, text)
+                return stored
+        try:
+            result = await route.handler(interaction, args)
+        finally:
+            if route.money:
+                await finish_receipt(key, interaction.id, result)
+        if result is not None:
+            _bounded_put(_action_results, key, (time.monotonic() + IDEMPOTENCY_TTL, result))
+        return result
+    finally:
+        _actions_in_flight.discard(key)
+
+
+def record_route_timing(prefix: str, elapsed: float):
+    """Accumulate per-route call count and latency."""
+    stats = ROUTE_STATS.setdefault(prefix, [0, 0.0, 0.0])
+    stats[0] += 1
+    stats[1] += elapsed
+    if elapsed > stats[2]:
+        stats[2] = elapsed
+    BUTTON_ROUTES_TOTAL.inc(route=prefix)
+    BUTTON_ROUTE_SECONDS.observe(elapsed, route=prefix)
+
+
+@button_route("duel_accept", min_args=2, money=True)
+async def route_duel_accept(interaction: discord.Interaction, args: List[str]):
+    duel_id = int(args[0])
+    user_id = int(args[1])
+
+    if interaction.user.id != user_id:
+        await interaction.response.send_message("Это не ваше приглашение.", ephemeral=True)
         return
-    if interaction.data['component_type'] != 2:  # Button
+
+    duel = await get_duel(duel_id)
+    if not duel or duel["status"] != "waiting":
+        await interaction.response.send_message("Приглашение устарело.", ephemeral=True)
         return
-    cid = interaction.data['custom_id']
-    if cid.startswith("duel_accept:"):
-        parts = cid.split(":")
-        if len(parts) < 3:
-            await interaction.response.send_message("Неверный формат.", ephemeral=True)
-            return
-        _, duel_id_str, user_id_str = parts
-        duel_id = int(duel_id_str)
-        user_id = int(user_id_str)
-        
-        if interaction.user.id != user_id:
-            await interaction.response.send_message("Это не ваше приглашение.", ephemeral=True)
-            return
-            
-        duel = await get_duel(duel_id)
-        if not duel or duel["status"] != "waiting":
-            await interaction.response.send_message("Приглашение устарело.", ephemeral=True)
-            return
-            
-        await interaction.response.defer(ephemeral=True)
-        await update_duel_invite_status(duel_id, user_id, "accepted")
-        updated_duel = await get_duel(duel_id)
-        
-        # Создаем новый embed и disabled view
-        new_embed = await build_duel_embed(updated_duel)
-        new_embed.add_field(name="Статус", value="Принято! Дуэль активна.", inline=False)
-        disabled_view = create_disabled_view("duel_invite")
-        
-        try:
-            await interaction.edit_original_response(embed=new_embed, view=disabled_view)
-        except discord.NotFound:
-            logger.warning(f"Original message not found for duel accept {duel_id}")
-        except Exception as e:
-            logger.error(f"Failed to edit duel accept message: {e}")
-        
-        # Обновляем канал
-        if updated_duel.get("message_id"):
-            channel = bot.get_channel(int(updated_duel["channel_id"]))
-            if channel:
-                try:
-                    msg = await channel.fetch_message(int(updated_duel["message_id"]))
-                    await refresh_duel_message(msg, updated_duel)
-                except Exception as e:
-                    logger.error(f"Error refreshing channel message {duel_id}: {e}")
-        
-        await interaction.followup.send("✅ Дуэль активирована!", ephemeral=True)
+
+    await interaction.response.defer(ephemeral=True)
+    if not await update_duel_invite_status(duel_id, user_id, "accepted"):
+        current = await get_duel(duel_id)
+        if not current or current["status"] != "waiting":
+            await interaction.followup.send("Приглашение устарело.", ephemeral=True)
+        else:
+            await interaction.followup.send(f"Недостаточно доступных поинтов для ставки {duel['points']}.", ephemeral=True)
         return
+    updated_duel = await get_duel(duel_id)
 
-    elif cid.startswith("duel_decline:"):
-        parts = cid.split(":")
-        if len(parts) < 3:
-            await interaction.response.send_message("Неверный формат.", ephemeral=True)
-            return
-        _, duel_id_str, user_id_str = parts
-        duel_id = int(duel_id_str)
-        user_id = int(user_id_str)
-        
-        if interaction.user.id != user_id:
-            await interaction.response.send_message("Это не ваше приглашение.", ephemeral=True)
-            return
-            
-        duel = await get_duel(duel_id)
-        if not duel or duel["status"] != "waiting":
-            await interaction.response.send_message("Приглашение устарело.", ephemeral=True)
-            return
-            
-        await interaction.response.defer(ephemeral=True)
-        await update_duel_invite_status(duel_id, user_id, "declined")
-        updated_duel = await get_duel(duel_id)
-        
-        # Создаем новый embed и disabled view
-        new_embed = await build_duel_embed(updated_duel)
-        new_embed.add_field(name="Статус", value="Отклонено. Дуэль отменена.", inline=False)
-        disabled_view = create_disabled_view("duel_invite")
-        
-        try:
-            await interaction.edit_original_response(embed=new_embed, view=disabled_view)
-        except discord.NotFound:
-            logger.warning(f"Original message not found for duel decline {duel_id}")
-        except Exception as e:
-            logger.error(f"Failed to edit duel decline message: {e}")
-        
-        # Обновляем канал
-        if updated_duel.get("message_id"):
-            channel = bot.get_channel(int(updated_duel["channel_id"]))
-            if channel:
-                try:
-                    msg = await channel.fetch_message(int(updated_duel["message_id"]))
-                    await refresh_duel_message(msg, updated_duel)
-                except Exception as e:
-                    logger.error(f"Error refreshing channel message {duel_id}: {e}")
-        
-        await interaction.followup.send("❌ Дуэль отменена.", ephemeral=True)
+    # Создаем новый embed и disabled view
+    new_embed = await build_duel_embed(updated_duel)
+    new_embed.add_field(name="Статус", value="Принято! Дуэль активна.", inline=False)
+    disabled_view = create_disabled_view("duel_invite")
+
+    try:
+        await interaction.edit_original_response(embed=new_embed, view=disabled_view)
+    except discord.NotFound:
+        logger.warning(f"Original message not found for duel accept {duel_id}")
+    except Exception as e:
+        logger.error(f"Failed to edit duel accept message: {e}")
+
+    # Обновляем канал
+    if updated_duel.get("message_id"):
+        channel = bot.get_channel(int(updated_duel["channel_id"]))
+        if channel:
+            try:
+                msg = await channel.fetch_message(int(updated_duel["message_id"]))
+                await refresh_duel_message(msg, updated_duel)
+            except Exception as e:
+                logger.error(f"Error refreshing channel message {duel_id}: {e}")
+
+    await interaction.followup.send("✅ Дуэль активирована!", ephemeral=True)
+    return "✅ Дуэль активирована!"
+
+
+@button_route("duel_decline", min_args=2, money=True)
+async def route_duel_decline(interaction: discord.Interaction, args: List[str]):
+    duel_id = int(args[0])
+    user_id = int(args[1])
+
+    if interaction.user.id != user_id:
+        await interaction.response.send_message("Это не ваше приглашение.", ephemeral=True)
         return
 
-    elif cid.startswith("team_accept:"):
-        parts = cid.split(":")
-        if len(parts) < 3:
-            await interaction.response.send_message("Неверный формат.", ephemeral=True)
-            return
-        _, invite_id_str, user_id_str = parts[:3]
-        invite_id = int(invite_id_str)
-        user_id = int(user_id_str)
-        
-        if interaction.user.id != user_id:
-            await interaction.response.send_message("Это не ваше приглашение.", ephemeral=True)
-            return
-            
-        # Проверяем статус
-        invite_resp = supabase.table("team_invites").select("status, team_id").eq("id", invite_id).execute()
-        if not invite_resp.data or invite_resp.data[0]["status"] != "pending":
-            await interaction.response.send_message("Приглашение устарело.", ephemeral=True)
-            return
-            
-        team_id = int(invite_resp.data[0]["team_id"])
-        team = supabase.table("teams").select("*").eq("id", team_id).execute().data[0]
-        player_count = sum(1 for i in range(1, 6) if team.get(f"player{i}_id"))
-        if player_count >= 5:
-            await interaction.response.send_message("Команда заполнена.", ephemeral=True)
-            return
-            
-        await interaction.response.defer()
-        
-        # Обновляем данные команды
-        supabase.table("team_invites").update({"status": "accepted"}).eq("id", invite_id).execute()
-        updates = {}
-        for i in range(1, 6):
-            if team.get(f"player{i}_id") is None:
-                updates[f"player{i}_id"] = str(user_id)
-                break
-        if updates:
-            supabase.table("teams").update(updates).eq("id", team_id).execute()
-            invites = supabase.table("team_invites").select("status").eq("team_id", team_id).execute().data
-            if all(invite["status"] == "accepted" for invite in invites):
-                supabase.table("teams").update({"status": "confirmed"}).eq("id", team_id).execute()
-        
-        # Назначаем роль
-        guild_id = team.get("guild_id")
-        if guild_id:
-            guild = bot.get_guild(int(guild_id))
-            if guild:
-                member = guild.get_member(user_id)
-                if member:
-                    await assign_team_role(guild, member, team["name"])
-        
-        # Уведомляем лидера
-        leader_id = int(team["leader_id"])
-        leader = bot.get_user(leader_id)
-        if leader:
-            await safe_send(leader, content=f"<@{user_id}> присоединился к вашей команде!")
-        
-        # Убираем view и отправляем подтверждение
-        empty_view = discord.ui.View()
-        try:
-            await interaction.edit_original_response(view=empty_view)
-        except Exception as e:
-            logger.error(f"Failed to edit team accept message: {e}")
-            
-        await interaction.followup.send("Вы присоединились к команде!", ephemeral=True)
+    duel = await get_duel(duel_id)
+    if not duel or duel["status"] != "waiting":
+        await interaction.response.send_message("Приглашение устарело.", ephemeral=True)
         return
 
-    elif cid.startswith("team_decline:"):
-        parts = cid.split(":")
-        if len(parts) < 3:
-            await interaction.response.send_message("Неверный формат.", ephemeral=True)
-            return
-        _, invite_id_str, user_id_str = parts[:3]
-        invite_id = int(invite_id_str)
-        user_id = int(user_id_str)
-        
-        if interaction.user.id != user_id:
-            await interaction.response.send_message("Это не ваше приглашение.", ephemeral=True)
-            return
-            
-        invite_resp = supabase.table("team_invites").select("status").eq("id", invite_id).execute()
-        if not invite_resp.data or invite_resp.data[0]["status"] != "pending":
-            await interaction.response.send_message("Приглашение устарело.", ephemeral=True)
-            return
-            
-        await interaction.response.defer()
-        supabase.table("team_invites").update({"status": "declined"}).eq("id", invite_id).execute()
-        
-        # Уведомляем лидера
-        invite_data = supabase.table("team_invites").select("team_id").eq("id", invite_id).execute().data[0]
-        team_id = int(invite_data["team_id"])
-        team = supabase.table("teams").select("leader_id").eq("id", team_id).execute().data[0]
-        leader_id = int(team["leader_id"])
-        leader = bot.get_user(leader_id)
-        if leader:
-            await safe_send(leader, content=f"<@{user_id}> отклонил приглашение в вашу команду.")
-        
-        # Убираем view
-        empty_view = discord.ui.View()
-        try:
-            await interaction.edit_original_response(view=empty_view)
-        except Exception as e:
-            logger.error(f"Failed to edit team decline message: {e}")
-            
-        await interaction.followup.send("Вы отклонили приглашение.", ephemeral=True)
+    await interaction.response.defer(ephemeral=True)
+    await update_duel_invite_status(duel_id, user_id, "declined")
+    updated_duel = await get_duel(duel_id)
+
+    # Создаем новый embed и disabled view
+    new_embed = await build_duel_embed(updated_duel)
+    new_embed.add_field(name="Статус", value="Отклонено. Дуэль отменена.", inline=False)
+    disabled_view = create_disabled_view("duel_invite")
+
+    try:
+        await interaction.edit_original_response(embed=new_embed, view=disabled_view)
+    except discord.NotFound:
+        logger.warning(f"Original message not found for duel decline {duel_id}")
+    except Exception as e:
+        logger.error(f"Failed to edit duel decline message: {e}")
+
+    # Обновляем канал
+    if updated_duel.get("message_id"):
+        channel = bot.get_channel(int(updated_duel["channel_id"]))
+        if channel:
+            try:
+                msg = await channel.fetch_message(int(updated_duel["message_id"]))
+                await refresh_duel_message(msg, updated_duel)
+            except Exception as e:
+                logger.error(f"Error refreshing channel message {duel_id}: {e}")
+
+    await interaction.followup.send("❌ Дуэль отменена.", ephemeral=True)
+    return "❌ Дуэль отменена."
+
+
+@button_route("team_accept", min_args=2, idempotent=True)
+async def route_team_accept(interaction: discord.Interaction, args: List[str]):
+    invite_id = int(args[0])
+    user_id = int(args[1])
+
+    if interaction.user.id != user_id:
+        await interaction.response.send_message("Это не ваше приглашение.", ephemeral=True)
         return
-    elif cid.startswith("join_public_duel:"):
-        _, duel_id_str = cid.split(":", 1)
-        duel_id = int(duel_id_str)
-        user_id = interaction.user.id
-        duel = await get_duel(duel_id)
-        points = duel["points"]
-        if duel["type"] == "1v1":
-            ok, msg = await join_public_duel(duel_id, user_id, None, points)
-        else:  # 5v5
-            team = await get_user_team(user_id)
-            if not team or str(user_id) != team["leader_id"]:
-                await interaction.response.send_message("Только лидер команды может присоединиться.", ephemeral=True)
-                return
-            if not await is_team_full_and_confirmed(team):
-                await interaction.response.send_message("Команда должна быть полной и подтвержденной.", ephemeral=True)
-                return
-            ok, msg = await join_public_duel(duel_id, user_id, team["id"], points)
-        await interaction.response.send_message(msg, ephemeral=True)
-        if ok:
-            updated_duel = await get_duel(duel_id)
-            await refresh_duel_message(interaction.message, updated_duel)
+
+    await interaction.response.defer()
+    result, team = await accept_team_invite(invite_id, user_id)
+    if result == "stale":
+        await interaction.followup.send("Приглашение устарело.", ephemeral=True)
         return
-    elif cid.startswith("cancel_duel:"):
-        parts = cid.split(":")
-        if len(parts) < 3:
-            await interaction.response.send_message("Неверный формат.", ephemeral=True)
-            return
-        _, duel_id_str, creator_id_str = parts
-        duel_id = int(duel_id_str)
-        creator_id = int(creator_id_str)
-        if interaction.user.id != creator_id:
-            await interaction.response.send_message("❌ Только создатель дуэли может её отменить.", ephemeral=True)
+    if result == "full":
+        await interaction.followup.send("Команда заполнена.", ephemeral=True)
+        return
+
+    await announce_team_join(team, user_id, f"<@{user_id}> присоединился к вашей команде!")
+
+    # Убираем view и отправляем подтверждение
+    try:
+        await interaction.edit_original_response(view=discord.ui.View())
+    except Exception as e:
+        logger.error(f"Failed to edit team accept message: {e}")
+
+    await interaction.followup.send("Вы присоединились к команде!", ephemeral=True)
+    return "Вы присоединились к команде!"
+
+
+@button_route("team_decline", min_args=2)
+async def route_team_decline(interaction: discord.Interaction, args: List[str]):
+    invite_id = int(args[0])
+    user_id = int(args[1])
+
+    if interaction.user.id != user_id:
+        await interaction.response.send_message("Это не ваше приглашение.", ephemeral=True)
+        return
+
+    await interaction.response.defer()
+    team_id = await decline_team_invite(invite_id, user_id)
+    if team_id is None:
+        await interaction.followup.send("Приглашение устарело.", ephemeral=True)
+        return
+
+    # Уведомляем лидера
+    leader_id = await get_team_leader(team_id)
+    leader = bot.get_user(leader_id) if leader_id else None
+    if leader:
+        await safe_send(leader, content=f"<@{user_id}> отклонил приглашение в вашу команду.")
+
+    # Убираем view
+    try:
+        await interaction.edit_original_response(view=discord.ui.View())
+    except Exception as e:
+        logger.error(f"Failed to edit team decline message: {e}")
+
+    await interaction.followup.send("Вы отклонили приглашение.", ephemeral=True)
+
+
+@button_route("join_public_duel", min_args=1, money=True)
+async def route_join_public_duel(interaction: discord.Interaction, args: List[str]):
+    duel_id = int(args[0])
+    user_id = interaction.user.id
+    duel = await get_duel(duel_id)
+    if not duel:
+        await interaction.response.send_message("Дуэль недоступна для присоединения.", ephemeral=True)
+        return
+    points = duel["points"]
+    if duel["type"] == "1v1":
+        ok, msg, updated_duel = await join_public_duel(duel_id, user_id, None, points)
+    else:  # 5v5
+        team = await get_user_team(user_id)
+        if not team or str(user_id) != team["leader_id"]:
+            await interaction.response.send_message("Только лидер команды может присоединиться.", ephemeral=True)
             return
-        duel = await get_duel(duel_id)
-        if duel["status"] not in ["waiting", "public"]:
-            await interaction.response.send_message("Дуэль уже идет, загрузите скриншот конца игры.", ephemeral=True)
+        if not await is_team_full_and_confirmed(team):
+            await interaction.response.send_message("Команда должна быть полной и подтвержденной.", ephemeral=True)
             return
-        
-        await add_balance(creator_id, int(duel["points"]))  # Refund создателю
-        supabase.table("duels").update({"status": "cancelled", "reason": "cancelled_by_creator"}).eq("id", duel_id).execute()
-        updated_duel = await get_duel(duel_id)
+        ok, msg, updated_duel = await join_public_duel(duel_id, user_id, team["id"], points)
+    await interaction.response.send_message(msg, ephemeral=True)
+    if ok:
         await refresh_duel_message(interaction.message, updated_duel)
-        
-        # Если есть invitee, уведомить в DM
-        invitee_id = duel.get("player2_id") if duel["type"] == "1v1" else await get_team_leader(int(duel.get("team2_id", 0)))
-        if invitee_id:
-            invitee_user = bot.get_user(int(invitee_id))
-            if invitee_user:
-                await safe_send(invitee_user, f"Дуэль отменена создателем <@{creator_id}>.")
-        
-        await interaction.response.send_message("✅ Дуэль отменена. Поинты возвращены.", ephemeral=True)
-        
-        # ИСПРАВЛЕНИЕ: Создаем новый view с отключенными кнопками вместо редактирования старого
-        try:
-            # Создаем новый view на основе типа дуэли
-            if duel.get("is_public"):
-                # Для публичной дуэли
-                new_view = discord.ui.View()
-                new_view.add_item(discord.ui.Button(
-                    label="Присоединиться", 
-                    style=discord.ButtonStyle.success, 
-                    disabled=True
-                ))
-                new_view.add_item(discord.ui.Button(
-                    label="Отменить дуэль", 
-                    style=discord.ButtonStyle.danger, 
-                    disabled=True
-                ))
-            else:
-                # Для приватной дуэли
-                new_view = discord.ui.View()
-                new_view.add_item(discord.ui.Button(
-                    label="Отменить дуэль", 
-                    style=discord.ButtonStyle.danger, 
-                    disabled=True
-                ))
-            
-            await interaction.message.edit(view=new_view)
-        except Exception as e:
-            logger.error(f"Failed to disable cancel button: {e}")
-        
+        return msg
+
+
+@button_route("cancel_duel", min_args=2, money=True)
+async def route_cancel_duel(interaction: discord.Interaction, args: List[str]):
+    duel_id = int(args[0])
+    creator_id = int(args[1])
+    if interaction.user.id != creator_id:
+        await interaction.response.send_message("❌ Только создатель дуэли может её отменить.", ephemeral=True)
         return
-    elif cid.startswith("settle_a:"):
-        _, duel_id_str = cid.split(":", 1)
-        duel_id = int(duel_id_str)
-        if not interaction.user.guild_permissions.administrator:
-            await interaction.response.send_message("Только админ.", ephemeral=True)
-            return
-        await interaction.response.defer(ephemeral=True)
-        logger.info(f"Admin {interaction.user.id} pressed settle_a for duel {duel_id}")
-        try:
-            ok, msg = await settle_duel(duel_id, "A")
-            updated_duel = await get_duel(duel_id)
-            logger.info(f"After settle, duel {duel_id} status: {updated_duel['status'] if updated_duel else 'None'}")
-            if ok and updated_duel and updated_duel.get("message_id"):
-                channel = bot.get_channel(int(updated_duel["channel_id"]))
-                if channel:
-                    try:
-                        msg = await channel.fetch_message(int(updated_duel["message_id"]))
-                        await refresh_duel_message(msg, updated_duel)
-                        logger.info(f"Message refreshed for duel {duel_id}")
-                    except Exception as e:
-                        logger.error(f"Error refreshing duel message {duel_id} in settle_a: {e}")
-            await interaction.followup.send(msg if 'msg' in locals() else "Дуэль завершена.", ephemeral=True)
-        except Exception as e:
-            logger.error(f"Error in settle_a for duel {duel_id}: {e}")
-            await interaction.followup.send("Произошла ошибка при завершении дуэли.", ephemeral=True)
-        return
-    elif cid.startswith("settle_b:"):
-        _, duel_id_str = cid.split(":", 1)
-        duel_id = int(duel_id_str)
-        if not interaction.user.guild_permissions.administrator:
-            await interaction.response.send_message("Только админ.", ephemeral=True)
-            return
-        await interaction.response.defer(ephemeral=True)
-        logger.info(f"Admin {interaction.user.id} pressed settle_b for duel {duel_id}")
-        try:
-            ok, msg = await settle_duel(duel_id, "B")
-            updated_duel = await get_duel(duel_id)
-            logger.info(f"After settle, duel {duel_id} status: {updated_duel['status'] if updated_duel else 'None'}")
-            if ok and updated_duel and updated_duel.get("message_id"):
-                channel = bot.get_channel(int(updated_duel["channel_id"]))
-                if channel:
-                    try:
-                        msg_obj = await channel.fetch_message(int(updated_duel["message_id"]))
-                        await refresh_duel_message(msg_obj, updated_duel)
-                        logger.info(f"Message refreshed for duel {duel_id}")
-                    except Exception as e:
-                        logger.error(f"Error refreshing duel message {duel_id} in settle_b: {e}")
-            await interaction.followup.send(msg if 'msg' in locals() else "Дуэль завершена.", ephemeral=True)
-        except Exception as e:
-            logger.error(f"Error in settle_b for duel {duel_id}: {e}")
-            await interaction.followup.send("Произошла ошибка при завершении дуэли.", ephemeral=True)
-        return
-    elif cid.startswith("cancel_result:"):
-        _, duel_id_str = cid.split(":", 1)
-        duel_id = int(duel_id_str)
-        if not interaction.user.guild_permissions.administrator:
-            await interaction.response.send_message("Только админ.", ephemeral=True)
-            return
-        duel = await get_duel(duel_id)
-        if not duel or duel["status"] != "result_pending":
-            await interaction.response.send_message("Дуэль не в статусе для отмены результата.", ephemeral=True)
-            return
-        # Устанавливаем новый статус
-        supabase.table("duels").update({"status": "result_canceled"}).eq("id", duel_id).execute()
-        updated_duel = await get_duel(duel_id)
-        if updated_duel and updated_duel.get("message_id"):
-            channel = bot.get_channel(int(updated_duel["channel_id"]))
-            if channel:
-                try:
-                    msg = await channel.fetch_message(int(updated_duel["message_id"]))
-                    await refresh_duel_message(msg, updated_duel)  # Теперь embed серый, view пустой, статус "Результат отменён"
-                    logger.info(f"Result canceled for duel {duel_id}")
-                except Exception as e:
-                    logger.error(f"Error updating message after cancel_result {duel_id}: {e}")
-        await interaction.response.send_message("Результат отменён. Дуэль закрыта.", ephemeral=True)
+    duel = await get_duel(duel_id)
+    if duel["status"] not in ["waiting", "public"]:
+        await interaction.response.send_message("Дуэль уже идет, загрузите скриншот конца игры.", ephemeral=True)
+        return
+
+    # Сначала условный переход: если accept/join успел раньше, холды не трогаем
+    updated_duel = await transition_duel(duel_id, OPEN_DUEL_STATUSES, status="cancelled", reason="cancelled_by_creator")
+    if not updated_duel:
+        await interaction.response.send_message("Дуэль уже идет, загрузите скриншот конца игры.", ephemeral=True)
+        return
+    on_duel_status_change(duel_id, "cancelled", via="creator", user_id=str(interaction.user.id))
+    await release_duel_holds(duel_id)  # Снимаем холд создателя
+    # Ответ до правок и ЛС: они идут через троттлинг outbound и могут ждать очереди дольше 3 с
+    await interaction.response.send_message("✅ Дуэль отменена. Поинты возвращены.", ephemeral=True)
+    await refresh_duel_message(interaction.message, updated_duel)
+
+    # Если есть invitee, уведомить в DM
+    invitee_id = duel.get("player2_id") if duel["type"] == "1v1" else await get_team_leader(duel.get("team2_id"))
+    if invitee_id:
+        invitee_user = bot.get_user(int(invitee_id))
+        if invitee_user:
+            await safe_send(invitee_user, content=f"Дуэль отменена создателем <@{creator_id}>.")
+
+    # Создаем новый view с отключенными кнопками вместо редактирования старого
+    try:
+        new_view = discord.ui.View()
+        if duel.get("is_public"):
+            new_view.add_item(discord.ui.Button(label="Присоединиться", style=discord.ButtonStyle.success, disabled=True))
+        new_view.add_item(discord.ui.Button(label="Отменить дуэль", style=discord.ButtonStyle.danger, disabled=True))
+        await outbound.edit(interaction.message, view=new_view)
+    except Exception as e:
+        logger.error(f"Failed to disable cancel button: {e}")
+    return "✅ Дуэль отменена. Поинты возвращены."
+
+
+@button_route("cancel_public_duel", min_args=2, money=True)
+async def route_cancel_public_duel(interaction: discord.Interaction, args: List[str]):
+    duel_id = int(args[0])
+    creator_id = int(args[1])
+    if interaction.user.id != creator_id:
+        await interaction.response.send_message("❌ Только создатель дуэли может её отменить.", ephemeral=True)
+        return
+    duel = await get_duel(duel_id)
+    if duel["status"] != "public":
+        await interaction.response.send_message("Дуэль уже идет, загрузите скриншот конца игры.", ephemeral=True)
+        return
+    updated_duel = await transition_duel(duel_id, ("public",), status="cancelled", reason="cancelled_by_creator")
+    if not updated_duel:
+        await interaction.response.send_message("Дуэль уже идет, загрузите скриншот конца игры.", ephemeral=True)
+        return
+    on_duel_status_change(duel_id, "cancelled", via="creator", user_id=str(interaction.user.id))
+    await release_duel_holds(duel_id)
+    # Ответ до правки сообщения: outbound.edit может ждать очереди канала
+    await interaction.response.send_message("✅ Дуэль отменена. Поинты возвращены.", ephemeral=True)
+    await refresh_duel_message(interaction.message, updated_duel)
+    return "✅ Дуэль отменена. Поинты возвращены."
+
+
+async def _admin_settle(interaction: discord.Interaction, duel_id: int, winner_side: str):
+    """Общая логика кнопок settle_a/settle_b."""
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("Только админ.", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True)
+    logger.info("Admin %s pressed settle_%s for duel %s", interaction.user.id, winner_side.lower(), duel_id)
+    try:
+        # Публичное сообщение обновляет сам settle_duel
+        ok, msg = await settle_duel(duel_id, winner_side)
+        await interaction.followup.send(msg, ephemeral=True)
+        return msg if ok else None
+    except Exception as e:
+        logger.error(f"Error in settle_{winner_side.lower()} for duel {duel_id}: {e}")
+        await interaction.followup.send("Произошла ошибка при завершении дуэли.", ephemeral=True)
+
+
+@button_route("settle_a", min_args=1, money=True)
+async def route_settle_a(interaction: discord.Interaction, args: List[str]):
+    return await _admin_settle(interaction, int(args[0]), "A")
+
+
+@button_route("settle_b", min_args=1, money=True)
+async def route_settle_b(interaction: discord.Interaction, args: List[str]):
+    return await _admin_settle(interaction, int(args[0]), "B")
+
+
+@button_route("cancel_result", min_args=1, money=True)
+async def route_cancel_result(interaction: discord.Interaction, args: List[str]):
+    duel_id = int(args[0])
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("Только админ.", ephemeral=True)
+        return
+    duel = await get_duel(duel_id)
+    if not duel or duel["status"] != "result_pending":
+        await interaction.response.send_message("Дуэль не в статусе для отмены результата.", ephemeral=True)
+        return
+    # Условный переход: параллельный расчёт или отмена не перезаписываются
+    updated_duel = await transition_duel(duel_id, ("result_pending",), status="result_canceled")
+    if not updated_duel:
+        await interaction.response.send_message("Дуэль уже завершена или отменена.", ephemeral=True)
+        return
+    on_duel_status_change(duel_id, "result_canceled", via="admin", user_id=str(interaction.user.id))
+    await interaction.response.send_message("Результат отменён. Дуэль закрыта.", ephemeral=True)
+    # Теперь embed серый, view пустой, статус "Результат отменён"
+    await refresh_duel_channel_message(updated_duel)
+    logger.info(f"Result canceled for duel {duel_id}")
+    return "Результат отменён. Дуэль закрыта."
+
+
+@button_route("join_team", min_args=1, idempotent=True)
+async def route_join_team(interaction: discord.Interaction, args: List[str]):
+    team_id = int(args[0])
+    user_id = interaction.user.id
+    # Проверяем SteamID
+    resp = supabase.table("users").select("steam_id").eq("user_id", str(user_id)).execute()
+    steam_id = resp.data[0]["steam_id"] if resp.data and resp.data[0].get("steam_id") else None
+    if not steam_id:
+        await interaction.response.send_message("❌ Для присоединения к команде нужно зарегистрировать SteamID.", ephemeral=True)
+        return
+    # Проверяем, что не в другой команде
+    if await get_user_team(user_id):
+        await interaction.response.send_message("❌ Вы уже состоите в другой команде.", ephemeral=True)
+        return
+    # Приглашение создаётся сразу принятым, слот занимается в той же транзакции
+    result, joined = await join_public_team(team_id, user_id)
+    if result == "stale":
+        await interaction.response.send_message("❌ Команда не найдена или не публичная.", ephemeral=True)
         return
-    elif cid.startswith("team_accept:"):
-        parts = cid.split(":")
-        if len(parts) < 3:
-            await interaction.response.send_message("Неверный формат.", ephemeral=True)
-            return
-        _, invite_id_str, user_id_str = parts[:3]
-        invite_id = int(invite_id_str)
-        user_id = int(user_id_str)
-        if interaction.user.id != user_id:
-            await interaction.response.send_message("Это не ваше приглашение.", ephemeral=True)
-            return
-        # Проверяем статус
-        invite_resp = supabase.table("team_invites").select("status, team_id").eq("id", invite_id).execute()
-        if not invite_resp.data or invite_resp.data[0]["status"] != "pending":
-            await interaction.response.send_message("Приглашение устарело.", ephemeral=True)
-            return
-        team_id = int(invite_resp.data[0]["team_id"])
-        team = supabase.table("teams").select("*").eq("id", team_id).execute().data[0]
-        player_count = sum(1 for i in range(1, 6) if team.get(f"player{i}_id"))
-        if player_count >= 5:
-            await interaction.response.send_message("Команда заполнена.", ephemeral=True)
-            return
-        # Defer to allow editing
-        await interaction.response.defer()
-        # Обновляем
-        supabase.table("team_invites").update({"status": "accepted"}).eq("id", invite_id).execute()
-        updates = {}
-        for i in range(1, 6):
-            if team.get(f"player{i}_id") is None:
-                updates[f"player{i}_id"] = str(user_id)
-                break
-        if updates:
-            supabase.table("teams").update(updates).eq("id", team_id).execute()
-            # Check if full now
-            invites = supabase.table("team_invites").select("status").eq("team_id", team_id).execute().data
-            if all(invite["status"] == "accepted" for invite in invites):
-                supabase.table("teams").update({"status": "confirmed"}).eq("id", team_id).execute()
-        # Assign role
-        guild_id = team.get("guild_id")
-        if guild_id:
-            guild = bot.get_guild(int(guild_id))
-            if guild:
-                member = guild.get_member(user_id)
-                if member:
-                    await assign_team_role(guild, member, team["name"])
-        # Уведомить лидера
-        leader_id = int(team["leader_id"])
-        leader = bot.get_user(leader_id)
-        if leader:
-            await safe_send(leader, content=f"<@{user_id}> присоединился к вашей команде!")
-        # Edit original to remove view
-        await interaction.edit_original_response(view=None)
-        # Followup confirmation
-        await interaction.followup.send("Вы присоединились к команде!", ephemeral=True)
-        return
-    elif cid.startswith("team_decline:"):
-        parts = cid.split(":")
-        if len(parts) < 3:
-            await interaction.response.send_message("Неверный формат.", ephemeral=True)
-            return
-        _, invite_id_str, user_id_str = parts[:3]
-        invite_id = int(invite_id_str)
-        user_id = int(user_id_str)
-        if interaction.user.id != user_id:
-            await interaction.response.send_message("Это не ваше приглашение.", ephemeral=True)
-            return
-        # Проверяем статус
-        invite_resp = supabase.table("team_invites").select("status").eq("id", invite_id).execute()
-        if not invite_resp.data or invite_resp.data[0]["status"] != "pending":
-            await interaction.response.send_message("Приглашение устарело.", ephemeral=True)
-            return
-        # Defer
-        await interaction.response.defer()
-        supabase.table("team_invites").update({"status": "declined"}).eq("id", invite_id).execute()
-        # Уведомить лидера
-        invite_data = supabase.table("team_invites").select("team_id").eq("id", invite_id).execute().data[0]
-        team_id = int(invite_data["team_id"])
-        team = supabase.table("teams").select("leader_id").eq("id", team_id).execute().data[0]
-        leader_id = int(team["leader_id"])
-        leader = bot.get_user(leader_id)
-        if leader:
-            await safe_send(leader, content=f"<@{user_id}> отклонил приглашение в вашу команду.")
-        # Edit original to remove view
-        await interaction.edit_original_response(view=None)
-        # Followup
-        await interaction.followup.send("Вы отклонили приглашение.", ephemeral=True)
-        return
-    elif cid.startswith("join_team:"):
-        _, team_id_str = cid.split(":", 1)
-        team_id = int(team_id_str)
-        user_id = interaction.user.id
-        # Проверяем SteamID
-        resp = supabase.table("users").select("steam_id").eq("user_id", str(user_id)).execute()
-        steam_id = resp.data[0]["steam_id"] if resp.data and resp.data[0].get("steam_id") else None
-        if not steam_id:
-            await interaction.response.send_message("❌ Для присоединения к команде нужно зарегистрировать SteamID.", ephemeral=True)
-            return
-        # Проверяем, что не в другой команде
-        if await get_user_team(user_id):
-            await interaction.response.send_message("❌ Вы уже состоите в другой команде.", ephemeral=True)
-            return
-        # Проверяем команду
-        team = await get_team(team_id)
-        if not team or not team["is_public"]:
-            await interaction.response.send_message("❌ Команда не найдена или не публичная.", ephemeral=True)
-            return
-        player_count = sum(1 for i in range(1, 6) if team.get(f"player{i}_id"))
-        if player_count >= 5:
-            await interaction.response.send_message("❌ Команда заполнена.", ephemeral=True)
-            return
-        # Создаём invite и сразу accept
-        now = int(time.time())
-        invite_response = supabase.table("team_invites").insert({
-            "team_id": team_id,
-            "user_id": str(user_id),
-            "status": "accepted",
-            "created_at": now
-        }).execute()
-        invite_id = int(invite_response.data[0]["id"])
-        # Добавляем в слот
-        updates = {}
-        for i in range(1, 6):
-            if team.get(f"player{i}_id") is None:
-                updates[f"player{i}_id"] = str(user_id)
-                break
-        if updates:
-            supabase.table("teams").update(updates).eq("id", team_id).execute()
-            # Check if full
-            invites = supabase.table("team_invites").select("status").eq("team_id", team_id).execute().data
-            if all(invite["status"] == "accepted" for invite in invites):
-                supabase.table("teams").update({"status": "confirmed"}).eq("id", team_id).execute()
-        # Assign role
-        guild_id = team.get("guild_id")
-        if guild_id:
-            guild = bot.get_guild(int(guild_id))
-            if guild:
-                member = guild.get_member(user_id)
-                if member:
-                    await assign_team_role(guild, member, team["name"])
-        # Уведомить лидера
-        leader_id = int(team["leader_id"])
-        leader = bot.get_user(leader_id)
-        if leader:
-            await safe_send(leader, content=f"<@{user_id}> присоединился к вашей публичной команде через объявление!")
-        # Отключить кнопку если full
-        if player_count + 1 >= 5:
-            view = interaction.message.view
-            for item in view.children:
-                if isinstance(item, discord.ui.Button) and item.label == "Присоединиться":
-                    item.disabled = True
-            await interaction.message.edit(view=view)
-        await interaction.response.send_message("✅ Вы присоединились к команде!", ephemeral=True)
-        return
-    # ✅ Добавлено: Обработка неизвестных custom_id - defer чтобы избежать ошибок Discord
-    elif cid.startswith("cancel_public_duel:"):
-        parts = cid.split(":")
-        if len(parts) < 3:
-            await interaction.response.send_message("Неверный формат.", ephemeral=True)
-            return
-        _, duel_id_str, creator_id_str = parts
-        duel_id = int(duel_id_str)
-        creator_id = int(creator_id_str)
-        if interaction.user.id != creator_id:
-            await interaction.response.send_message("❌ Только создатель дуэли может её отменить.", ephemeral=True)
-            return
-        # Логика отмены (как в callback)
-        duel = await get_duel(duel_id)
-        if duel["status"] != "public":
-            await interaction.response.send_message("Дуэль уже идет, загрузите скриншот конца игры.", ephemeral=True)
-            return
-        await add_balance(creator_id, int(duel["points"]))
-        supabase.table("duels").update({"status": "cancelled", "reason": "cancelled_by_creator"}).eq("id", duel_id).execute()
-        updated_duel = await get_duel(duel_id)
-        await refresh_duel_message(interaction.message, updated_duel)
-        await interaction.response.send_message("✅ Дуэль отменена. Поинты возвращены.", ephemeral=True)
-    # Обработчик в on_interaction (добавьте elif):
-    elif cid.startswith("manual_mmr:"):
-            _, user_id_str = cid.split(":", 1)
-            user_id = int(user_id_str)
-            if interaction.user.id != user_id:
-                await interaction.response.send_message("Это не ваше.", ephemeral=True)
-                return
-            modal = MMRModal()  # Ваш существующий MMR модал
-            await interaction.response.send_modal(modal)
-    elif cid.startswith("bet:"):
-        parts = cid.split(":")
-        if len(parts) == 3:
-            _, team, match_id_str = parts
-            match_id = int(match_id_str)
-            modal = BetAmountModal(match_id, team)
-            await interaction.response.send_modal(modal)
-            return
-    else:
+    if result == "full":
+        await interaction.response.send_message("❌ Команда заполнена.", ephemeral=True)
+        return
+    # Ответ уходит сразу; роль, DM и правка объявления идут через планировщик
+    await interaction.response.send_message("✅ Вы присоединились к команде!", ephemeral=True)
+    await announce_team_join(joined, user_id, f"<@{user_id}> присоединился к вашей публичной команде через объявление!")
+    # Отключить кнопку если full
+    if joined["member_count"] >= TEAM_SIZE:
+        view = interaction.message.view
+        for item in view.children:
+            if isinstance(item, discord.ui.Button) and item.label == "Присоединиться":
+                item.disabled = True
+        await outbound.edit(interaction.message, view=view)
+    return "✅ Вы присоединились к команде!"
+
+
+@button_route("manual_mmr", min_args=1)
+async def route_manual_mmr(interaction: discord.Interaction, args: List[str]):
+    user_id = int(args[0])
+    if interaction.user.id != user_id:
+        await interaction.response.send_message("Это не ваше.", ephemeral=True)
+        return
+    await interaction.response.send_modal(MMRModal())
+
+
+@button_route("bet", min_args=2)
+async def route_bet(interaction: discord.Interaction, args: List[str]):
+    team, match_id_str = args[0], args[1]
+    await interaction.response.send_modal(BetAmountModal(int(match_id_str), team))
+
+
+async def _route_moderator_button(interaction: discord.Interaction, args: List[str]):
+    """mod_* кнопки: custom_id несёт duel_id и guild_id, view собирается заново."""
+    view = ModeratorDuelView(int(args[0]), args[1])
+    return await view.on_interaction(interaction)
+
+
+for _mod_prefix in ("mod_settle_a", "mod_settle_b", "mod_cancel_result", "mod_cancel_duel"):
+    button_route(_mod_prefix, min_args=2, money=True)(_route_moderator_button)
+
+
+@bot.event
+async def on_interaction(interaction: discord.Interaction):
+    if interaction.type != discord.InteractionType.component:
+        return
+    if interaction.data.get('component_type') != 2:  # Button
+        return
+    cid = interaction.data.get('custom_id', '')
+    prefix, _, tail = cid.partition(":")
+    route = BUTTON_ROUTES.get(prefix)
+    if route is None:
+        # Неизвестный custom_id (или кнопка persistent view) - defer чтобы избежать ошибок Discord
         try:
             await interaction.response.defer(ephemeral=True)
         except discord.HTTPException:
             pass  # Уже acknowledged
-    
+        return
+
+    if not first_delivery(interaction):
+        return  # повторная доставка того же interaction
+    args = tail.split(":") if tail else []
+    if len(args) < route.min_args:
+        await interaction.response.send_message("Неверный формат.", ephemeral=True)
+        return
+
+    started = time.perf_counter()
+    live_profiler.enter(f"button:{prefix}")
+    try:
+        with tracer.trace(f"button:{prefix}", custom_id=cid, user_id=str(interaction.user.id)):
+            if route.idempotent:
+                await run_idempotent(route, interaction, args, f"{cid}:{interaction.user.id}")
+            else:
+                await route.handler(interaction, args)
+    finally:
+        live_profiler.exit(f"button:{prefix}")
+        elapsed = time.perf_counter() - started
+        record_route_timing(prefix, elapsed)
+        router_log.debug("Route %s handled in %.1f ms", prefix, elapsed * 1000)
+
+
 class MMRModal(Modal, title="Введите ваш MMR"):
     mmr = TextInput(label="MMR", placeholder="Например: 2500")
 
@@ -2571,15 +3560,44 @@ async def setup_register(interaction: discord.Interaction, channel: Optional[dis
 async def balance_cmd(interaction: discord.Interaction, user: Optional[discord.Member] = None):
     target = user or interaction.user
     bal = await get_balance(target.id)
+    held = _held.get(target.id, 0)
+    held_note = f" (в дуэлях зарезервировано {held})" if held else ""
     if user:
         await interaction.response.send_message(
-            f"Баланс {target.mention}: **{bal}** поинтов", ephemeral=True
+            f"Баланс {target.mention}: **{bal}** поинтов{held_note}", ephemeral=True
         )
     else:
         await interaction.response.send_message(
-            f"Ваш баланс: **{bal}** поинтов", ephemeral=True
+            f"Ваш баланс: **{bal}** поинтов{held_note}", ephemeral=True
         )
 
+LEDGER_REASONS = {
+    "duel_stake": "Ставка в дуэли",
+    "duel_refund": "Возврат за дуэль",
+    "duel_payout": "Выигрыш в дуэли",
+    "bet_stake": "Ставка на матч",
+    "bet_refund": "Возврат ставки",
+    "bet_payout": "Выигрыш ставки",
+    "grant": "Начисление админом",
+}
+
+@bot.tree.command(name="history", description="Последние изменения баланса")
+@app_commands.describe(user="Чью историю посмотреть (если не указать, то вашу)")
+async def history_cmd(interaction: discord.Interaction, user: Optional[discord.Member] = None):
+    target = user or interaction.user
+    await interaction.response.defer(ephemeral=True)
+    rows = await get_ledger_history(target.id)
+    if not rows:
+        await interaction.followup.send("История пуста.", ephemeral=True)
+        return
+    lines = []
+    for row in rows:
+        ref = f" · {row['ref_type']} #{row['ref_id']}" if row.get("ref_type") and row.get("ref_id") else ""
+        when = (row.get("created_at") or "")[:16].replace("T", " ")
+        lines.append(f"`{int(row['delta']):+}` {LEDGER_REASONS.get(row['reason'], row['reason'])}{ref} — {when}")
+    embed = discord.Embed(title=f"История баланса: {target.display_name}", description="\n".join(lines), color=discord.Color.gold())
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
 @bot.tree.command(name="leaderboard", description="Показать топ игроков по балансу")
 async def leaderboard_cmd(interaction: discord.Interaction):
     data = supabase.table("users").select("user_id,balance").order("balance", desc=True).limit(100).execute().data
@@ -2588,26 +3606,7 @@ async def leaderboard_cmd(interaction: discord.Interaction):
         return
 
     view = LeaderboardView(data)
-
-    # первый ответ — теперь приватный
-    await interaction.response.send_message("Загрузка...", view=view, ephemeral=True)
-
-    # редактируем только для вызвавшего
-    msg = await interaction.original_response()
-    start = 0
-    end = view.per_page
-    chunk = data[start:end]
-
-    desc = "\n".join(
-        [f"**{i+1}.** <@{row['user_id']}> — {row['balance']}💰" for i, row in enumerate(chunk, start=start)]
-    )
-
-    embed = discord.Embed(
-        title=f"🏆 Лидерборд (стр. 1/{view.max_page+1})",
-        description=desc,
-        color=discord.Color.gold()
-    )
-    await msg.edit(content=None, embed=embed, view=view)
+    await interaction.response.send_message(embed=view.page_embed(), view=view, ephemeral=True)
 
 @bot.tree.command(name="teams", description="Показать список всех команд")
 async def teams_cmd(interaction: discord.Interaction):
@@ -2617,34 +3616,7 @@ async def teams_cmd(interaction: discord.Interaction):
         return
 
     view = TeamsView(data)
-
-    # Send initial response (private)
-    await interaction.response.send_message("Загрузка...", view=view, ephemeral=True)
-
-    # Edit response with team list
-    msg = await interaction.original_response()
-    start = 0
-    end = view.per_page
-    chunk = data[start:end]
-
-    players_list = []
-    for i, row in enumerate(chunk, start=start):
-        players = [row.get(f'player{j}_id') for j in range(1, 6) if row.get(f'player{j}_id')]
-        participants_str = " ".join([f"<@{p}>" for p in players if p != row['leader_id']]) if players else "❌ Нет участников"
-        players_list.append(
-            f"**{i + 1}. {row['name']}**"
-            f"👑 **Лидер:** <@{row['leader_id']}>\n"
-            f"👥 **Участники:** {participants_str}"
-        )
-
-    desc = "\n\n".join(players_list) or "Нет команд"
-
-    embed = discord.Embed(
-        title=f"👥 Команды (стр. 1/{view.max_page+1})",
-        description=desc,
-        color=discord.Color.blue()
-    )
-    await msg.edit(content=None, embed=embed, view=view)
+    await interaction.response.send_message(embed=view.page_embed(), view=view, ephemeral=True)
 
 
 @app_commands.default_permissions(manage_guild=True)
@@ -2656,7 +3628,7 @@ async def grant_cmd(interaction: discord.Interaction, user: discord.User, amount
         await interaction.response.send_message("Сумма должна быть ненулевой.", ephemeral=True)
         return
 
-    await add_balance(user.id, amount)
+    await add_balance(user.id, amount, "grant", "admin", interaction.user.id, f"grant:{interaction.id}")
     new_bal = await get_balance(user.id)
     await interaction.response.send_message(
         f"Выдано {amount} поинтов {user.mention}. Новый баланс: {new_bal}",
@@ -2676,16 +3648,13 @@ async def bid_cmd(interaction: discord.Interaction, team_a: str, team_b: str, bu
 
     match_id = await create_match(interaction.channel_id, team_a, team_b, b)
 
-    embed = discord.Embed(title=f"Матч: {team_a} vs {team_b}", color=discord.Color.blurple())
-    embed.add_field(name=f"Банк {team_a}", value="0 поинтов", inline=True)
-    embed.add_field(name=f"Банк {team_b}", value="0 поинтов", inline=True)
-    embed.add_field(name="Статус", value="Открыта", inline=False)
-    embed.set_footer(text=f"match:{match_id}")
-
+    state = (int(match_id), team_a, team_b, 0, 0, "Открыта")
+    embed = embed_from_spec(render_match_spec(state))
     view = MatchView(match_id, team_a, team_b, "Открыта")
 
     await interaction.response.send_message(embed=embed, view=view)
     msg = await interaction.original_response()
+    remember_sent_state(msg.id, (state, view_state(view)))
     await set_match_message(match_id, msg.id)
 
 @app_commands.default_permissions(manage_guild=True)
@@ -2718,6 +3687,32 @@ async def settle_bet_cmd(interaction: discord.Interaction, match_id: int, winner
     if ok:
         await refresh_match_message(interaction, match_id)
 
+class DuelContext(NamedTuple):
+    """Данные для проверок /duel, загруженные одним параллельным шагом."""
+    balance: int
+    user_team: Optional[dict]
+    opponent_balance: Optional[int]
+    opponent_team: Optional[dict]
+    opponent_cooldown_ok: bool
+
+
+async def _resolved(value=None):
+    return value
+
+
+async def load_duel_context(user_id: int, opponent_id: Optional[int], duel_type: str) -> DuelContext:
+    """Fetch balances, teams and the opponent cooldown concurrently (one round trip of latency)."""
+    is_team = duel_type == "5v5"
+    results = await asyncio.gather(
+        get_available_balance(user_id),
+        get_user_team(user_id) if is_team else _resolved(),
+        get_available_balance(opponent_id) if opponent_id else _resolved(),
+        get_user_team(opponent_id) if is_team and opponent_id else _resolved(),
+        check_duel_limit(opponent_id) if opponent_id else _resolved(True),
+    )
+    return DuelContext(*results)
+
+
 # Полный duel_cmd с интеграцией CancelDuelView (для private блоков)
 @bot.tree.command(name="duel", description="Создать дуэль")
 @app_commands.describe(
@@ -2733,119 +3728,106 @@ async def settle_bet_cmd(interaction: discord.Interaction, match_id: int, winner
 )
 async def duel_cmd(interaction: discord.Interaction, type: str, points: int = 100, opponent: Optional[discord.Member] = None):
     user_id = interaction.user.id
-    bal = await get_balance(user_id)
+    duel_id = None
     try:
         if points < 50 or points > 200:
             await interaction.response.send_message("Ставка должна быть 50-200 поинтов.", ephemeral=True)
             return
 
-        if bal < points:
-            await interaction.response.send_message(f"Недостаточно поинтов: {bal}.", ephemeral=True)
-            return
-
-        # ✅ Новый check: нет ли pending дуэли
+        # ✅ Проверки в памяти — до любых запросов в БД
         pending_duel_id = await has_pending_duel(user_id)
         if pending_duel_id:
             await interaction.response.send_message(f"❌ У вас уже есть открытая дуэль #{pending_duel_id}. Дождитесь ответа или отмените её.", ephemeral=True)
             return
 
         is_public = opponent is None
+        if opponent and opponent.id == user_id:
+            await interaction.response.send_message("Нельзя вызвать себя.", ephemeral=True)
+            return
+        if type == "1v1" and not is_public:
+            opp_pending = await has_pending_duel(opponent.id)
+            if opp_pending:
+                await interaction.response.send_message(f"У оппонента уже есть открытая дуэль #{opp_pending}.", ephemeral=True)
+                return
+
+        ctx = await load_duel_context(user_id, opponent.id if opponent else None, type)
+
+        if ctx.balance < points:
+            await interaction.response.send_message(f"Недостаточно поинтов: {ctx.balance}.", ephemeral=True)
+            return
 
         if type == "1v1":
-            if not is_public and opponent is None:
-                await interaction.response.send_message("Для приватной 1v1 укажите оппонента.", ephemeral=True)
-                return
-            if opponent and opponent.id == user_id:
-                await interaction.response.send_message("Нельзя вызвать себя.", ephemeral=True)
-                return
             if not is_public:
-                # Optional: check pending для opponent
-                opp_pending = await has_pending_duel(opponent.id)
-                if opp_pending:
-                    await interaction.response.send_message(f"У оппонента уже есть открытая дуэль #{opp_pending}.", ephemeral=True)
-                    return
-                if not await check_duel_limit(opponent.id):
+                if not ctx.opponent_cooldown_ok:
                     await interaction.response.send_message("Оппонент уже дуэлился сегодня.", ephemeral=True)
                     return
-                opponent_bal = await get_balance(opponent.id)
-                if opponent_bal < points:
-                    await interaction.response.send_message(f"У {opponent.mention} недостаточно: {opponent_bal}.", ephemeral=True)
+                if ctx.opponent_balance < points:
+                    await interaction.response.send_message(f"У {opponent.mention} недостаточно: {ctx.opponent_balance}.", ephemeral=True)
                     return
-                await add_balance(user_id, -points)
-                duel_id = await create_duel(interaction.channel_id, player1_id=user_id, player2_id=opponent.id, points=points, duel_type="1v1", is_public=False, creator_user_id=user_id)
-                # DM to opponent
-                opponent_user = opponent
-                embed = await build_duel_embed(await get_duel(duel_id))
-                view = DuelInviteView(duel_id, opponent.id)
-                await safe_send(opponent_user, embed=embed, view=view)
-                # Main response
-                embed = await build_duel_embed(await get_duel(duel_id))
-                view = CancelDuelView(duel_id, user_id)  # Или PublicDuelView для private? Adjust
-                await interaction.response.send_message(embed=embed, view=view)
-                msg = await interaction.original_response()
-                await set_duel_message(duel_id, msg.id)
-            else:  # public 1v1
-                await add_balance(user_id, -points)
-                duel_id = await create_duel(interaction.channel_id, player1_id=user_id, points=points, duel_type="1v1", is_public=True, creator_user_id=user_id)
-                await interaction.response.defer()
-                await interaction.followup.send("Создаётся публичная дуэль (без оппонента).", ephemeral=True)
-                embed = await build_duel_embed(await get_duel(duel_id))
-                view = PublicDuelView(duel_id, user_id)
-                await interaction.edit_original_response(embed=embed, view=view)
-                await set_duel_message(duel_id, interaction.message.id if interaction.message else 0)
-                asyncio.create_task(auto_refund_public_duel(duel_id, user_id, points))
-
+            duel_kwargs = {"player1_id": user_id, "player2_id": opponent.id if opponent else None}
         else:  # 5v5
-            user_team = await get_user_team(user_id)
+            user_team = ctx.user_team
             if not user_team or str(user_id) != user_team["leader_id"]:
                 await interaction.response.send_message("Для 5v5 вы должны быть лидером команды.", ephemeral=True)
                 return
             if not await is_team_full_and_confirmed(user_team):
                 await interaction.response.send_message("Ваша команда должна быть полной и подтвержденной.", ephemeral=True)
                 return
+            opponent_team = ctx.opponent_team
             if not is_public:
-                if opponent is None:
-                    await interaction.response.send_message("Для приватной 5v5 укажите оппонента (лидера).", ephemeral=True)
-                    return
-                opponent_team = await get_user_team(opponent.id)
                 if not opponent_team or str(opponent.id) != opponent_team["leader_id"]:
                     await interaction.response.send_message("Оппонент должен быть лидером команды.", ephemeral=True)
                     return
                 if not await is_team_full_and_confirmed(opponent_team):
                     await interaction.response.send_message("Команда оппонента не полная.", ephemeral=True)
                     return
-                # Optional: check pending для opponent
-                opp_pending = await has_pending_duel(opponent.id)
+                opp_pending = team_open_duel(opponent_team["id"])
                 if opp_pending:
                     await interaction.response.send_message(f"У оппонента уже есть открытая дуэль #{opp_pending}.", ephemeral=True)
                     return
-                if not await check_duel_limit(opponent.id):
+                if not ctx.opponent_cooldown_ok:
                     await interaction.response.send_message("Лидер оппонента уже дуэлился сегодня.", ephemeral=True)
                     return
-                opponent_bal = await get_balance(opponent.id)
-                if opponent_bal < points:
-                    await interaction.response.send_message(f"У лидера оппонента недостаточно: {opponent_bal}.", ephemeral=True)
+                if ctx.opponent_balance < points:
+                    await interaction.response.send_message(f"У лидера оппонента недостаточно: {ctx.opponent_balance}.", ephemeral=True)
                     return
-                await add_balance(user_id, -points)
-                duel_id = await create_duel(interaction.channel_id, team1_id=user_team["id"], team2_id=opponent_team["id"], points=points, duel_type="5v5", is_public=False, creator_user_id=user_id)
-                embed = await build_duel_embed(await get_duel(duel_id))
-                view = DuelInviteView(duel_id, opponent.id)
-                await safe_send(opponent, embed=embed, view=view)
-                embed = await build_duel_embed(await get_duel(duel_id))
-                view = CancelDuelView(duel_id, user_id)
-                await interaction.response.send_message(embed=embed, view=view)
-                msg = await interaction.original_response()
-                await set_duel_message(duel_id, msg.id)
-            else:  # public 5v5
-                await add_balance(user_id, -points)
-                duel_id = await create_duel(interaction.channel_id, team1_id=user_team["id"], points=points, duel_type="5v5", is_public=True, creator_user_id=user_id)
-                await interaction.response.defer()
-                await interaction.followup.send("Создаётся публичная дуэль (без оппонента).", ephemeral=True)
-                embed = await build_duel_embed(await get_duel(duel_id))
-                view = PublicDuelView(duel_id, user_id)
-                await interaction.edit_original_response(embed=embed, view=view)
-                await set_duel_message(duel_id, interaction.message.id if interaction.message else 0)
-                asyncio.create_task(auto_refund_public_duel(duel_id, user_id, points))
+            duel_kwargs = {
+                "team1_id": user_team["id"],
+                "team2_id": opponent_team["id"] if not is_public else None,
+                "invitee_id": opponent.id if not is_public else None,
+            }
+
+        duel = await create_duel(interaction.channel_id, points=points, duel_type=type, is_public=is_public, creator_user_id=user_id, **duel_kwargs)
+        duel_id = int(duel["id"])
+        # Ставка создателя резервируется холдом по id дуэли, а не списывается
+        if not await hold_stake(duel_id, user_id, points):
+            await update_duel_status(duel_id, "cancelled")
+            duel_id = None
+            await interaction.response.send_message("Недостаточно доступных поинтов.", ephemeral=True)
+            return
+
+        # Один embed из только что вставленной строки — и для канала, и для ЛС
+        embed = await build_duel_embed(duel)
+        if is_public:
+            await interaction.response.send_message(embed=embed, view=PublicDuelView(duel_id, user_id))
+        else:
+            await interaction.response.send_message(embed=embed, view=CancelDuelView(duel_id, user_id))
+        msg = await interaction.original_response()
+
+        if is_public:
+            await set_duel_message(duel_id, msg.id)
+            asyncio.create_task(auto_refund_public_duel(duel_id, user_id, points))
+        else:
+            _, (delivery,) = await asyncio.gather(
+                set_duel_message(duel_id, msg.id),
+                fan_out_dms([(opponent, {"embed": embed, "view": DuelInviteView(duel_id, opponent.id)})]),
+            )
+            if delivery.ok:
+                await record_invite_message("duel_invites", {"duel_id": duel_id, "user_id": str(opponent.id)}, delivery.message)
+            else:
+                await interaction.followup.send(
+                    f"⚠️ Не удалось доставить приглашение {opponent.mention} ({delivery.error}).", ephemeral=True
+                )
 
     except Exception as e:
         logger.error(f"Error in duel_cmd for user {user_id}: {e}")
@@ -2856,18 +3838,22 @@ async def duel_cmd(interaction: discord.Interaction, type: str, points: int = 10
                 await interaction.response.send_message(f"❌ Ошибка создания дуэли: {str(e)[:100]}...", ephemeral=True)
         except:
             pass
-        if bal >= points:
-            await add_balance(user_id, points)
+        if duel_id:
+            await update_duel_status(duel_id, "cancelled")
+            await release_duel_holds(duel_id)
 
 
 
 async def refresh_duel_message(message: discord.Message, duel: dict):
     """Refresh the duel message with updated data."""
     # Сохраняем старую картинку, если была
-    old_embed = message.embeds[0] if message.embeds else None
+    embeds = getattr(message, "embeds", None)  # у PartialMessage embed'ов нет
+    old_embed = embeds[0] if embeds else None
     screenshot_url = old_embed.image.url if old_embed and old_embed.image else None
     
-    embed = await build_duel_embed(duel)
+    state = await duel_render_state(duel)
+    embed = embed_from_spec(render_duel_spec(state))
+    embed.timestamp = discord.utils.utcnow()
     if screenshot_url:
         embed.set_image(url=screenshot_url)
 
@@ -2899,12 +3885,12 @@ async def refresh_duel_message(message: discord.Message, duel: dict):
                     logger.warning(f"Ошибка при обработке player2_id {player2_id}: {e}")
 
         elif duel["type"] == "5v5":
-            team1_leader = await get_team_leader(int(duel.get("team1_id", 0)))
+            team1_leader = await get_team_leader(duel.get("team1_id"))
             if team1_leader:
                 member1 = guild.get_member(team1_leader) if guild else None
                 winner_a_name = member1.display_name if member1 else f"Лидер {team1_leader}"
 
-            team2_leader = await get_team_leader(int(duel.get("team2_id", 0)))
+            team2_leader = await get_team_leader(duel.get("team2_id"))
             if team2_leader:
                 member2 = guild.get_member(team2_leader) if guild else None
                 winner_b_name = member2.display_name if member2 else f"Лидер {team2_leader}"
@@ -2912,7 +3898,7 @@ async def refresh_duel_message(message: discord.Message, duel: dict):
     except Exception as e:
         logger.error(f"Ошибка при определении имён: {e}")
 
-    logger.info(f"Names for duel {duel['id']}: A='{winner_a_name}', B='{winner_b_name}'")
+    render_log.debug("Names for duel %s: A=%r, B=%r", duel["id"], winner_a_name, winner_b_name)
 
     # Цвет и подсказка для отменённого результата
     if duel.get("status") == "result_canceled":
@@ -2923,7 +3909,7 @@ async def refresh_duel_message(message: discord.Message, duel: dict):
     view = discord.ui.View()
     
     if duel["status"] == "waiting" and not duel["is_public"]:
-        invitee_id = duel.get("player2_id") if duel["type"] == "1v1" else await get_team_leader(int(duel.get("team2_id", 0)))
+        invitee_id = duel.get("player2_id") if duel["type"] == "1v1" else await get_team_leader(duel.get("team2_id"))
         if invitee_id:
             view.add_item(discord.ui.Button(label="Присоединиться", style=discord.ButtonStyle.success, custom_id=f"duel_accept:{duel['id']}:{invitee_id}"))
             view.add_item(discord.ui.Button(label="Отклонить", style=discord.ButtonStyle.danger, custom_id=f"duel_decline:{duel['id']}:{invitee_id}"))
@@ -2946,8 +3932,9 @@ async def refresh_duel_message(message: discord.Message, duel: dict):
 
     # ---------- Обновление сообщения ----------
     try:
-        await message.edit(embed=embed, view=view)
-        logger.info(f"Successfully edited duel message {duel['id']}")
+        # Таймстемп не входит в состояние: без видимых изменений сообщение не редактируем
+        if await edit_if_changed(message, (state, screenshot_url, view_state(view)), embed=embed, view=view):
+            render_log.debug("Successfully edited duel message %s", duel["id"])
     except Exception as e:
         logger.error(f"Failed to edit duel message {duel['id']}: {e}")
 
@@ -2974,7 +3961,7 @@ async def create_team_cmd(interaction: discord.Interaction, name: str, public: b
     if not role:
         await interaction.response.send_message("❌ Не удалось создать роль для команды.", ephemeral=True)
         return
-    await interaction.user.add_roles(role)
+    await queue_role_change(interaction.user, add=role)
 
     # Create team in database
     now = int(time.time())
@@ -2985,6 +3972,7 @@ async def create_team_cmd(interaction: discord.Interaction, name: str, public: b
         "status": "pending",
         "is_public": public,
         "guild_id": str(interaction.guild.id),  # Добавляем guild_id
+        "member_count": 1,  # Лидер занимает player1
         "created_at": now
     }).execute()
     team_id = team_response.data[0]["id"]
@@ -3022,6 +4010,7 @@ async def create_team_cmd(interaction: discord.Interaction, name: str, public: b
         msg = await safe_send(channel, embed=embed, view=view)
         if msg:
             supabase.table("teams").update({"announcement_message_id": msg.id}).eq("id", team_id).execute()
+            invalidate_team(team_id)
 
 
 @bot.tree.command(name="invite_member", description="Пригласить игроков в команду")
@@ -3048,63 +4037,75 @@ async def invite_member_cmd(
         await interaction.response.send_message("❌ Укажите хотя бы одного игрока.", ephemeral=True)
         return
 
-    for u in users:
-        # Проверяем SteamID
-        resp = supabase.table("users").select("steam_id").eq("user_id", str(u.id)).execute()
-        steam_id = resp.data[0]["steam_id"] if resp.data and resp.data[0].get("steam_id") else None
-        if not steam_id:
-            await interaction.response.send_message(f"❌ У {u.mention} нет зарегистрированного SteamID.", ephemeral=True)
-            continue
+    # Подтверждаем сразу: проверки и рассылка идут после, итог — одним follow-up
+    await interaction.response.defer(ephemeral=True, thinking=True)
+
+    user_ids = [str(u.id) for u in users]
+    steam_resp, invites_resp, user_teams = await asyncio.gather(
+        asyncio.to_thread(
+            supabase.table("users").select("user_id,steam_id").in_("user_id", user_ids).execute
+        ),
+        asyncio.to_thread(
+            supabase.table("team_invites").select("id,user_id,status").eq("team_id", team["id"]).in_("user_id", user_ids).execute
+        ),
+        asyncio.gather(*(get_user_team(u.id) for u in users)),
+    )
+    steam_ids = {row["user_id"]: row.get("steam_id") for row in steam_resp.data or []}
+    existing = {row["user_id"]: row for row in invites_resp.data or []}
 
-        # Проверяем, что игрок не в другой команде
-        if await get_user_team(u.id):
-            await interaction.response.send_message(f"❌ {u.mention} уже состоит в другой команде.", ephemeral=True)
+    lines = []
+    invite_ids: Dict[int, int] = {}  # {user_id: invite_id}
+    to_insert = []
+    now = int(time.time())
+    for u, other_team in zip(users, user_teams):
+        if not steam_ids.get(str(u.id)):
+            lines.append(f"❌ У {u.mention} нет зарегистрированного SteamID.")
             continue
-
-        # Проверяем существующий invite
-        existing = supabase.table("team_invites") \
-            .select("id,status") \
-            .eq("team_id", team["id"]) \
-            .eq("user_id", str(u.id)) \
-            .execute().data
-
-        invite_id = None
-        if existing:
-            if existing[0]["status"] in ("pending", "accepted"):
-                await interaction.response.send_message(
-                    f"❌ {u.mention} уже приглашён или состоит в этой команде.",
-                    ephemeral=True
-                )
-                continue
-            else:
-                # Обновляем старое приглашение
-                invite_id = int(existing[0]["id"])
-                supabase.table("team_invites").update({
-                    "status": "pending",
-                    "created_at": int(time.time())
-                }).eq("id", invite_id).execute()
+        if other_team:
+            lines.append(f"❌ {u.mention} уже состоит в другой команде.")
+            continue
+        invite = existing.get(str(u.id))
+        if invite and invite["status"] in ("pending", "accepted"):
+            lines.append(f"❌ {u.mention} уже приглашён или состоит в этой команде.")
+            continue
+        if invite:
+            invite_ids[u.id] = int(invite["id"])
         else:
-            # Создаём новое приглашение
-            response = supabase.table("team_invites").insert({
-                "team_id": team["id"],
-                "user_id": str(u.id),
-                "status": "pending",
-                "created_at": int(time.time())
-            }).execute()
-            invite_id = int(response.data[0]["id"])
-
-        # Отправляем ЛС с View
-        view = TeamInviteView(invite_id, u.id)
+            to_insert.append({"team_id": team["id"], "user_id": str(u.id), "status": "pending", "created_at": now})
+
+    # Старые приглашения переоткрываются одним запросом, новые вставляются пачкой
+    writes = []
+    if invite_ids:
+        writes.append(asyncio.to_thread(
+            supabase.table("team_invites").update({"status": "pending", "created_at": now})
+            .in_("id", list(invite_ids.values())).execute
+        ))
+    if to_insert:
+        writes.append(asyncio.to_thread(supabase.table("team_invites").insert(to_insert).execute))
+    write_results = await asyncio.gather(*writes)
+    if to_insert:
+        for row in write_results[-1].data or []:
+            invite_ids[int(row["user_id"])] = int(row["id"])
+
+    invited = [u for u in users if u.id in invite_ids]
+    deliveries = []
+    for u in invited:
         embed = discord.Embed(title="Приглашение в команду!", color=discord.Color.blue())
         embed.add_field(name="Команда", value=team["name"], inline=False)
         embed.add_field(name="Лидер", value=f"<@{interaction.user.id}>", inline=False)
         embed.set_footer(text=f"team:{team['id']}:{u.id}")
+        deliveries.append((u, {"embed": embed, "view": TeamInviteView(invite_ids[u.id], u.id)}))
 
-        try:
-            await safe_send(u, embed=embed, view=view)
-            await interaction.response.send_message(f"✅ Приглашение отправлено {u.mention}.", ephemeral=True)
-        except discord.Forbidden:
-            await interaction.response.send_message(f"❌ Не удалось отправить приглашение {u.mention} (ЛС закрыты).", ephemeral=True)
+    recorded = []
+    for u, result in zip(invited, await fan_out_dms(deliveries)):
+        if result.ok:
+            lines.append(f"✅ Приглашение отправлено {u.mention}.")
+            recorded.append(record_invite_message("team_invites", {"id": invite_ids[u.id]}, result.message))
+        else:
+            lines.append(f"❌ Не удалось отправить приглашение {u.mention} ({result.error}).")
+    await asyncio.gather(*recorded)
+
+    await interaction.followup.send("\n".join(lines), ephemeral=True)
 
 
 @bot.tree.command(name="check_team", description="Показать состав вашей команды")
@@ -3253,19 +4254,11 @@ async def kick_cmd(interaction: discord.Interaction, user: discord.Member):
         await interaction.response.send_message(f"❌ {user.mention} уже не состоит в вашей команде (статус: {invite_status}).", ephemeral=True)
         return
 
-    # Обновляем статус приглашения
-    supabase.table("team_invites").update({"status": "left"}).eq("team_id", team["id"]).eq("user_id", str(user.id)).execute()
-    
-    # Clear player slot
-    team = supabase.table("teams").select("*").eq("id", team["id"]).execute().data[0]
-    updates = {}
-    for i in range(1, 6):
-        if team[f"player{i}_id"] == str(user.id):
-            updates[f"player{i}_id"] = None
-            break
-    if updates:
-        supabase.table("teams").update(updates).eq("id", team["id"]).execute()
-    
+    # Освобождаем слот: счётчик участников уменьшается в той же транзакции
+    if not await release_team_member(int(team["id"]), user.id):
+        # Приглашение ещё не принято — слота нет, просто отзываем его
+        supabase.table("team_invites").update({"status": "left"}).eq("team_id", team["id"]).eq("user_id", str(user.id)).execute()
+
     # Убираем роль
     guild = interaction.guild
     if guild:
@@ -3333,12 +4326,13 @@ async def delete_team_cmd(interaction: discord.Interaction):
             color=discord.Color.red()
         )
         embed.set_footer(text=f"team:{team['id']}")
-        await message.edit(embed=embed, view=discord.ui.View())
+        await outbound.edit(message, embed=embed, view=discord.ui.View())
 
     # Delete team_invites first to avoid foreign key constraint violation
     supabase.table("team_invites").delete().eq("team_id", team["id"]).execute()
     # Now delete the team
     supabase.table("teams").delete().eq("id", team["id"]).execute()
+    invalidate_team(team["id"])
 
     # Remove team roles
     guild = interaction.guild
@@ -3348,6 +4342,410 @@ async def delete_team_cmd(interaction: discord.Interaction):
     await interaction.response.send_message(f"✅ Команда **{team['name']}** была удалена.", ephemeral=True)
 
 
+# ---------------------- DB CLEANUP ----------------------
+
+# Очистка идёт фоновой задачей: строки выбираются окнами по id (не больше
+# CLEANUP_CHUNK_SIZE), каждое окно вместе с дочерними строками сначала
+# дописывается в gzip JSONL в ARCHIVE_DIR и только потом удаляется.
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(BASE_DIR, "archive"))
+CLEANUP_CHUNK_SIZE = int(os.getenv("CLEANUP_CHUNK_SIZE", "500"))
+CLEANUP_PROGRESS_SECONDS = 2.0
+
+
+class PurgeSpec(NamedTuple):
+    table: str
+    where: Callable[[object, int], object]   # (query builder, threshold) -> builder с фильтрами
+    children: Tuple[Tuple[str, str], ...] = ()  # (дочерняя таблица, колонка ссылки)
+
+
+CLEANUP_SPECS: Tuple[PurgeSpec, ...] = (
+    PurgeSpec("matches", lambda q, t: q.lt("created_at", t).in_("status", ["settled", "cancelled"]), (("bets", "match_id"),)),
+    PurgeSpec("duels", lambda q, t: q.lt("created_at", t).in_("status", ["settled", "cancelled"]), (("duel_invites", "duel_id"),)),
+    PurgeSpec("teams", lambda q, t: q.lt("created_at", t).eq("status", "pending"), (("team_invites", "team_id"),)),
+    PurgeSpec("team_invites", lambda q, t: q.lt("created_at", t)),
+    PurgeSpec("duel_invites", lambda q, t: q.lt("created_at", t)),
+)
+
+
+class ChunkArchive:
+    """Appends rows to <ARCHIVE_DIR>/<table>-<tag>.jsonl.gz (one gzip member per chunk)."""
+
+    def __init__(self, tag: str):
+        self.tag = tag
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+
+    def path(self, table: str) -> str:
+        return os.path.join(ARCHIVE_DIR, f"{table}-{self.tag}.jsonl.gz")
+
+    def write(self, table: str, rows: List[dict]):
+        if not rows:
+            return
+        with gzip.open(self.path(table), "at", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False, default=str))
+                f.write("\n")
+
+
+def _purge_chunk(spec: PurgeSpec, threshold: int, after_id: int, archive: ChunkArchive) -> Tuple[int, Optional[int]]:
+    """Archive and delete one id window. Returns (rows deleted, last id) or (0, None) when done."""
+    rows = spec.where(supabase.table(spec.table).select("*"), threshold) \
+        .gt("id", after_id).order("id").limit(CLEANUP_CHUNK_SIZE).execute().data or []
+    if not rows:
+        return 0, None
+    first_id, last_id = rows[0]["id"], rows[-1]["id"]
+    ids = [row["id"] for row in rows]
+
+    # Сначала дочерние строки: иначе удаление упрётся во внешний ключ
+    for child, column in spec.children:
+        child_rows = supabase.table(child).select("*").in_(column, ids).execute().data or []
+        archive.write(child, child_rows)
+        if child_rows:
+            supabase.table(child).delete().in_(column, ids).execute()
+
+    archive.write(spec.table, rows)
+    spec.where(supabase.table(spec.table).delete(), threshold).gte("id", first_id).lte("id", last_id).execute()
+    return len(rows), last_id
+
+
+async def purge_table(spec: PurgeSpec, threshold: int, archive: ChunkArchive,
+                      progress: Optional[Callable[[str, int], Awaitable[None]]] = None) -> int:
+    """Purge every row of spec older than threshold, chunk by chunk; returns the number deleted."""
+    deleted = 0
+    after_id = 0
+    while True:
+        count, last_id = await asyncio.to_thread(_purge_chunk, spec, threshold, after_id, archive)
+        if last_id is None:
+            break
+        deleted += count
+        after_id = last_id
+        if progress:
+            await progress(spec.table, deleted)
+    if spec.table == "teams" and deleted:
+        invalidate_all_teams()
+    return deleted
+
+
+class CleanupJob(NamedTuple):
+    days: int
+    threshold: int
+    interaction: discord.Interaction
+
+
+_cleanup_queue: "asyncio.Queue[CleanupJob]" = asyncio.Queue()
+_cleanup_lock = asyncio.Lock()  # ручная очистка и retention не идут одновременно
+
+
+async def run_cleanup_job(job: CleanupJob):
+    archive = ChunkArchive(time.strftime("%Y%m%d-%H%M%S"))
+    totals: Dict[str, int] = {}
+    last_report = 0.0
+
+    async def report(text: str):
+        try:
+            await job.interaction.edit_original_response(content=text)
+        except discord.HTTPException as e:
+            # Токен interaction живёт 15 минут; дальше прогресс только в логе
+            logger.debug("Cleanup progress edit failed: %s", e)
+
+    def summary() -> str:
+        return ", ".join(f"{table}: {count}" for table, count in totals.items()) or "нет данных"
+
+    async def progress(table: str, deleted: int):
+        nonlocal last_report
+        totals[table] = deleted
+        now = time.monotonic()
+        if now - last_report >= CLEANUP_PROGRESS_SECONDS:
+            last_report = now
+            await report(f"🧹 Очистка (старше {job.days} дн.) идёт… {summary()}")
+
+    async with _cleanup_lock:
+        for spec in CLEANUP_SPECS:
+            totals[spec.table] = await purge_table(spec, job.threshold, archive, progress)
+            logger.info(f"Cleanup purged {totals[spec.table]} rows from {spec.table}")
+    await report(f"✅ Удалены записи старше {job.days} дней ({summary()}). Архив: {ARCHIVE_DIR}")
+
+
+async def cleanup_worker():
+    while True:
+        job = await _cleanup_queue.get()
+        try:
+            await run_cleanup_job(job)
+        except Exception as e:
+            logger.error(f"Error cleaning up database: {e}")
+            try:
+                await job.interaction.edit_original_response(content="Ошибка при очистке базы данных.")
+            except discord.HTTPException:
+                pass
+        finally:
+            _cleanup_queue.task_done()
+
+
+# ---------------------- RETENTION ----------------------
+
+# Фоновая политика хранения: раз в RETENTION_INTERVAL_MINUTES устаревшие строки
+# удаляются тем же окном с архивом, что и /cleanup_db. Срок для каждой таблицы
+# задаётся в днях через RETENTION_<TABLE>_DAYS; 0 отключает таблицу.
+# Команд здесь нет: release_team_member возвращает в pending и сложившуюся
+# команду, так что по created_at/pending их удаляет только ручной /cleanup_db.
+RETENTION_INTERVAL_MINUTES = float(os.getenv("RETENTION_INTERVAL_MINUTES", "60"))
+
+
+def _retention_days(table: str, default: str) -> int:
+    return int(os.getenv(f"RETENTION_{table.upper()}_DAYS", default))
+
+
+def _iso_before(threshold: int) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(threshold))
+
+
+_CLEANUP_BY_TABLE = {spec.table: spec for spec in CLEANUP_SPECS}
+
+# (спецификация, срок в днях)
+RETENTION_POLICIES: Tuple[Tuple[PurgeSpec, int], ...] = (
+    (_CLEANUP_BY_TABLE["matches"], _retention_days("matches", "30")),
+    (_CLEANUP_BY_TABLE["duels"], _retention_days("duels", "30")),
+    # Принятые приглашения — история состава, их не трогаем
+    (PurgeSpec("team_invites", lambda q, t: q.lt("created_at", t).neq("status", "accepted")), _retention_days("team_invites", "14")),
+    (_CLEANUP_BY_TABLE["duel_invites"], _retention_days("duel_invites", "14")),
+    (PurgeSpec("interaction_receipts", lambda q, t: q.lt("claimed_at", _iso_before(t))), _retention_days("interaction_receipts", "7")),
+)
+
+# {table: {"runs", "last_deleted", "deleted_total", "last_run", "last_error"}}
+RETENTION_STATS: Dict[str, dict] = {}
+
+
+async def run_retention_pass() -> Dict[str, int]:
+    """Apply every enabled policy once; returns rows deleted per table."""
+    archive = ChunkArchive(f"retention-{time.strftime('%Y%m%d')}")
+    deleted: Dict[str, int] = {}
+    async with _cleanup_lock:
+        for spec, days in RETENTION_POLICIES:
+            if days <= 0:
+                continue
+            stats = RETENTION_STATS.setdefault(spec.table, {"runs": 0, "last_deleted": 0, "deleted_total": 0, "last_run": 0, "last_error": None})
+            threshold = int(time.time()) - days * 86400
+            try:
+                count = await purge_table(spec, threshold, archive)
+            except Exception as e:
+                logger.error(f"Retention failed for {spec.table}: {e}")
+                stats["last_error"] = str(e)[:200]
+                continue
+            stats["runs"] += 1
+            stats["last_deleted"] = count
+            stats["deleted_total"] += count
+            stats["last_run"] = int(time.time())
+            stats["last_error"] = None
+            deleted[spec.table] = count
+    if any(deleted.values()):
+        logger.info("Retention pass removed: " + ", ".join(f"{t}={n}" for t, n in deleted.items() if n))
+    return deleted
+
+
+@tasks.loop(minutes=RETENTION_INTERVAL_MINUTES)
+async def retention_loop():
+    await run_retention_pass()
+
+
+@app_commands.default_permissions(manage_guild=True)
+@bot.tree.command(name="retention", description="Статистика автоматической очистки (админ)")
+@admin_only
+async def retention_cmd(interaction: discord.Interaction):
+    lines = []
+    for spec, days in RETENTION_POLICIES:
+        stats = RETENTION_STATS.get(spec.table)
+        if days <= 0:
+            lines.append(f"**{spec.table}** — отключено")
+        elif not stats:
+            lines.append(f"**{spec.table}** — {days} дн., ещё не запускалось")
+        else:
+            error = f" ⚠️ {stats['last_error']}" if stats["last_error"] else ""
+            lines.append(
+                f"**{spec.table}** — {days} дн., последний запуск <t:{stats['last_run']}:R>: "
+                f"{stats['last_deleted']} (всего {stats['deleted_total']}){error}"
+            )
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
+
+
+# ---------------------- INVITE EXPIRY ----------------------
+DUEL_INVITE_TTL_MINUTES = int(os.getenv("DUEL_INVITE_TTL_MINUTES", "60"))
+TEAM_INVITE_TTL_HOURS = int(os.getenv("TEAM_INVITE_TTL_HOURS", "48"))
+INVITE_SWEEP_SECONDS = int(os.getenv("INVITE_SWEEP_SECONDS", "60"))
+
+
+async def expire_invites(table: str, ttl_seconds: int) -> List[dict]:
+    """Flip stale pending invites to 'expired' in one UPDATE ... RETURNING (served by the (status, created_at) index)."""
+    cutoff = int(time.time()) - ttl_seconds
+    response = await asyncio.to_thread(
+        supabase.table(table).update({"status": "expired"}).eq("status", "pending").lt("created_at", cutoff).execute
+    )
+    return response.data or []
+
+
+async def disable_invite_buttons(invites: List[dict], view_type: str):
+    """Grey out the buttons of expired invite DMs; edits go through the scheduler at edit priority."""
+    async def disable(invite):
+        channel = bot.get_partial_messageable(int(invite["channel_id"]), type=discord.ChannelType.private)
+        message = channel.get_partial_message(int(invite["message_id"]))
+        try:
+            await outbound.edit(message, content="⌛ Приглашение истекло.", view=create_disabled_view(view_type))
+        except discord.NotFound:
+            pass
+        except Exception as e:
+            logger.warning(f"Failed to disable expired invite {message.id}: {e}")
+
+    await asyncio.gather(*(disable(invite) for invite in invites if invite.get("channel_id") and invite.get("message_id")))
+
+
+async def cancel_expired_duels(duel_ids: List[int]) -> List[dict]:
+    """Cancel the still-waiting duels behind expired invites and release their holds."""
+    if not duel_ids:
+        return []
+    # Условие status=waiting защищает от гонки с одновременным принятием
+    response = await asyncio.to_thread(
+        supabase.table("duels").update({"status": "cancelled"}).in_("id", duel_ids).eq("status", "waiting").execute
+    )
+    cancelled = response.data or []
+    for duel in cancelled:
+        on_duel_status_change(int(duel["id"]), "cancelled", via="invite_expired")
+    released = await release_holds_for_duels([int(duel["id"]) for duel in cancelled])
+    if cancelled:
+        logger.info(f"Expired {len(cancelled)} waiting duels, released {sum(released.values())} points")
+
+    async def refresh(duel):
+        channel = bot.get_channel(int(duel["channel_id"])) if duel.get("channel_id") else None
+        if channel is None or not duel.get("message_id"):
+            return
+        try:
+            await refresh_duel_message(channel.get_partial_message(int(duel["message_id"])), duel)
+        except Exception as e:
+            logger.warning(f"Failed to refresh expired duel {duel['id']}: {e}")
+
+    await asyncio.gather(*(refresh(duel) for duel in cancelled))
+    return cancelled
+
+
+async def sweep_expired_invites() -> Tuple[int, int]:
+    """Expire pending invites past their TTL; returns (duel invites, team invites) expired."""
+    duel_invites, team_invites = await asyncio.gather(
+        expire_invites("duel_invites", DUEL_INVITE_TTL_MINUTES * 60),
+        expire_invites("team_invites", TEAM_INVITE_TTL_HOURS * 3600),
+    )
+    await cancel_expired_duels(sorted({int(invite["duel_id"]) for invite in duel_invites}))
+    await asyncio.gather(
+        disable_invite_buttons(duel_invites, "duel_invite"),
+        disable_invite_buttons(team_invites, "team_invite"),
+    )
+    if duel_invites or team_invites:
+        logger.info(f"Expired invites: duel={len(duel_invites)}, team={len(team_invites)}")
+    return len(duel_invites), len(team_invites)
+
+
+@tasks.loop(seconds=INVITE_SWEEP_SECONDS)
+async def invite_sweeper():
+    try:
+        await sweep_expired_invites()
+    except Exception as e:
+        logger.error(f"Invite sweep failed: {e}")
+
+
+# ---------------------- MEMORY ----------------------
+MEMORY_TRACEMALLOC_FRAMES = int(os.getenv("MEMORY_TRACEMALLOC_FRAMES", "0"))
+allocations = memstats.AllocationTracker()
+if MEMORY_TRACEMALLOC_FRAMES > 0:
+    allocations.start(MEMORY_TRACEMALLOC_FRAMES)
+
+
+@app_commands.default_permissions(manage_guild=True)
+@bot.tree.command(name="memory", description="Память бота: аллокации, view, задачи, кэши (админ)")
+@app_commands.describe(action="report — отчёт, start/stop — включить/выключить tracemalloc")
+@app_commands.choices(action=[app_commands.Choice(name=a, value=a) for a in ("report", "start", "stop")])
+@admin_only
+async def memory_cmd(interaction: discord.Interaction, action: str = "report"):
+    if action == "start":
+        allocations.start(max(MEMORY_TRACEMALLOC_FRAMES, 1))
+        await interaction.response.send_message("tracemalloc включён; повторный report покажет прирост.", ephemeral=True)
+        return
+    if action == "stop":
+        allocations.stop()
+        await interaction.response.send_message("tracemalloc выключен.", ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    rss = memstats.rss_bytes()
+    lines = [f"RSS: {memstats.format_bytes(rss) if rss else 'н/д'}"]
+    if allocations.tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        lines.append(f"tracemalloc: {memstats.format_bytes(current)} (пик {memstats.format_bytes(peak)})")
+        lines += ["", "Топ аллокаций:"] + await asyncio.to_thread(allocations.top, 10)
+    else:
+        lines.append("tracemalloc выключен (/memory action:start)")
+
+    # Обход кучи и глубокие размеры — в потоке; кэши копируются здесь, чтобы цикл не менял их во время обхода
+    views = await asyncio.to_thread(memstats.count_instances, discord.ui.View)
+    lines += ["", f"View: {sum(views.values())}"] + [f"  {name}: {n}" for name, n in views.most_common(10)]
+    pending = memstats.task_counts()
+    lines += ["", f"Задачи asyncio: {sum(pending.values())}"] + [f"  {name}: {n}" for name, n in pending.most_common(10)]
+    lines += ["", "Кэши (записей / байт):"]
+    snapshot = {name: copy.copy(cache) for name, cache in internal_caches().items()}
+    sizes = await asyncio.to_thread(_cache_bytes, snapshot)
+    for name, size in sorted(sizes.items(), key=lambda item: -(item[1] or 0)):
+        lines.append(f"  {name}: {len(snapshot[name])} / {memstats.format_bytes(size) if size is not None else 'н/д'}")
+    lines.append(f"  discord users: {len(bot.users)}, messages: {len(bot.cached_messages)}")
+
+    text = "\n".join(lines)
+    await interaction.followup.send(f"```\n{text[:1900]}\n```", ephemeral=True)
+
+
+# ---------------------- PROFILER ----------------------
+PROFILER_MAX_SECONDS = 600
+PROFILER_COMMAND_TIMEOUT = 14 * 60  # follow-up по токену interaction доступен 15 минут
+
+
+@app_commands.default_permissions(manage_guild=True)
+@bot.tree.command(name="profiler", description="Профилирование бота на время или на N вызовов команды (админ)")
+@app_commands.describe(
+    mode="sampling — сэмплы стека (flamegraph), cprofile — детерминированный профиль",
+    seconds="Длительность окна, если команда не указана",
+    command="Профилировать только эту команду: duel, /settle_bet или button:duel_accept",
+    invocations="Сколько вызовов команды профилировать",
+)
+@app_commands.choices(mode=[app_commands.Choice(name=m, value=m) for m in profiler.MODES])
+@admin_only
+async def profiler_cmd(interaction: discord.Interaction, mode: str = "sampling", seconds: int = 10, command: Optional[str] = None, invocations: int = 5):
+    target = None
+    if command:
+        target = command.strip()
+        if not target.startswith(("/", "button:")):
+            target = "/" + target
+    if not 0 < seconds <= PROFILER_MAX_SECONDS or invocations <= 0:
+        await interaction.response.send_message(f"seconds: 1..{PROFILER_MAX_SECONDS}, invocations > 0.", ephemeral=True)
+        return
+    try:
+        live_profiler.start(mode, target, invocations if target else 0)
+    except (RuntimeError, ValueError) as e:
+        await interaction.response.send_message(f"❌ {e}", ephemeral=True)
+        return
+
+    try:
+        if target:
+            await interaction.response.send_message(f"⏺ {mode}: жду {invocations} вызов(ов) `{target}` (не дольше 14 мин).", ephemeral=True)
+            await live_profiler.wait(PROFILER_COMMAND_TIMEOUT)
+        else:
+            await interaction.response.send_message(f"⏺ {mode}: {seconds} с...", ephemeral=True)
+            await asyncio.sleep(seconds)
+        live_profiler.stop()
+        report = await asyncio.to_thread(live_profiler.report)
+    finally:
+        if live_profiler.busy:
+            # Ответ не ушёл или команду отменили: сессия не должна остаться занятой до перезапуска
+            live_profiler.stop()
+            live_profiler.discard()
+
+    header = f"✅ {report.mode}" + (f", вызовов `{target}`: {report.invocations}" if target else f", {seconds} с")
+    summary = report.summary[:1800]
+    files = [discord.File(path) for path in report.files if os.path.getsize(path) <= 8 * 1024 * 1024]
+    await interaction.followup.send(f"{header}\n```\n{summary}\n```", files=files, ephemeral=True)
+
 
 @app_commands.default_permissions(manage_guild=True)
 @bot.tree.command(name="cleanup_db", description="Очистить старые записи в базе данных")
@@ -3358,21 +4756,120 @@ async def cleanup_db_cmd(interaction: discord.Interaction, days: int = 30):
         await interaction.response.send_message("Количество дней должно быть больше 0.", ephemeral=True)
         return
     threshold = int(time.time()) - days * 86400
-    try:
-        supabase.table("matches").delete().lt("created_at", threshold).in_("status", ["settled", "cancelled"]).execute()
-        supabase.table("duels").delete().lt("created_at", threshold).in_("status", ["settled", "cancelled"]).execute()
-        supabase.table("teams").delete().lt("created_at", threshold).eq("status", "pending").execute()
-        supabase.table("team_invites").delete().lt("created_at", threshold).execute()
-        supabase.table("duel_invites").delete().lt("created_at", threshold).execute()
-        await interaction.response.send_message(f"Удалены записи старше {days} дней.", ephemeral=True)
-    except Exception as e:
-        logger.error(f"Error cleaning up database: {e}")
-        await interaction.response.send_message("Ошибка при очистке базы данных.", ephemeral=True)
+    # Команда только ставит задачу в очередь; прогресс — правками этого ответа
+    position = _cleanup_queue.qsize() + 1
+    await interaction.response.send_message(f"🧹 Очистка записей старше {days} дней поставлена в очередь (позиция {position}).", ephemeral=True)
+    _cleanup_queue.put_nowait(CleanupJob(days, threshold, interaction))
+
+
+# ---------------------- METRICS GAUGES ----------------------
+def internal_caches() -> Dict[str, object]:
+    """Every module-level cache by name (cache gauges and /memory)."""
+    return {
+        "balances": _balance_cache,
+        "holds": _held,
+        "ledger_buffer": _ledger_buffer,
+        "ledger_keys": _ledger_recent_keys,
+        "duel_cooldowns": _last_duel_times,
+        "dirty_duel_times": _dirty_duel_times,
+        "open_duels": _open_duels,
+        "open_duels_by_user": _open_duel_by_user,
+        "open_duels_by_team": _open_duel_by_team,
+        "teams": _team_cache,
+        "team_versions": _team_versions,
+        "moderator_guilds": _moderators,
+        "sent_states": _sent_states,
+        "seen_interactions": _seen_interactions,
+        "action_results": _action_results,
+        "actions_in_flight": _actions_in_flight,
+        "open_traces": _open_traces,
+        "route_stats": ROUTE_STATS,
+    }
+
+
+def _cache_sizes() -> Dict[Tuple[str], int]:
+    sizes = {(name,): len(cache) for name, cache in internal_caches().items()}
+    # Кэши discord.py и lru_cache: только число записей
+    sizes[("render_duel_spec",)] = render_duel_spec.cache_info().currsize
+    sizes[("discord_users",)] = len(bot.users)
+    sizes[("discord_messages",)] = len(bot.cached_messages)
+    return sizes
+
+
+def _cache_bytes(snapshot: Dict[str, object]) -> Dict[str, Optional[int]]:
+    """Deep sizes of cache copies; runs in a worker thread (O(total entries))."""
+    sizes: Dict[str, Optional[int]] = {}
+    for name, cache in snapshot.items():
+        try:
+            sizes[name] = memstats.deep_sizeof(cache)
+        except RuntimeError:  # вложенный объект изменился во время обхода
+            sizes[name] = None
+    return sizes
+
+
+def _pending_timers() -> Dict[Tuple[str], int]:
+    refunds = sum(1 for task in asyncio.all_tasks() if getattr(task.get_coro(), "__qualname__", "") == auto_refund_public_duel.__qualname__)
+    return {
+        ("public_duel_refund",): refunds,
+        ("outbound_delayed",): outbound.delayed,
+        ("outbound_queued",): outbound.queued(),
+        ("outbound_pending_edits",): outbound.pending_edits(),
+        ("cleanup_jobs",): _cleanup_queue.qsize(),
+        ("dirty_duel_times",): len(_dirty_duel_times),
+    }
+
+
+metrics.Gauge("bot_cache_entries", "Entries in in-memory caches", ("cache",), fn=_cache_sizes)
+metrics.Gauge("bot_asyncio_tasks", "Pending asyncio tasks by coroutine", ("coro",), fn=lambda: {(name,): n for name, n in memstats.task_counts().items()})
+metrics.Gauge("bot_process_rss_bytes", "Resident set size of the bot process", fn=lambda: memstats.rss_bytes() or 0)
+metrics.Gauge("bot_tracemalloc_bytes", "Memory traced by tracemalloc (0 when off)", fn=lambda: tracemalloc.get_traced_memory()[0])
+metrics.Gauge("bot_pending_timers", "Scheduled or queued background work", ("kind",), fn=_pending_timers)
+metrics.Gauge(
+    "bot_retention_deleted_rows", "Rows removed by the retention policy since start", ("table",),
+    fn=lambda: {(table,): stats["deleted_total"] for table, stats in RETENTION_STATS.items()},
+)
+metrics.Gauge("bot_guilds", "Guilds the bot is in", fn=lambda: len(bot.guilds))
+
+
+_startup_complete = False
 
 
 @bot.event
 async def on_ready():
+    global _startup_complete
     logger.info(f'{bot.user} has logged in!')
+    # Однократная инициализация (on_ready повторяется при переподключениях)
+    if not _startup_complete:
+        _startup_complete = True
+        try:
+            await load_open_duels()
+        except Exception as e:
+            logger.error(f"Failed to load open duel registry: {e}")
+        try:
+            await load_duel_cooldowns()
+        except Exception as e:
+            logger.error(f"Failed to load duel cooldowns: {e}")
+        try:
+            await load_holds()
+        except Exception as e:
+            logger.error(f"Failed to load balance holds: {e}")
+        try:
+            await load_moderators()
+        except Exception as e:
+            logger.error(f"Failed to load moderators: {e}")
+        flush_duel_times.start()
+        flush_ledger.start()
+        outbound.start()
+        loop_monitor.start()
+        try:
+            await metrics.start_metrics_server(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logger.error(f"Metrics server failed to start on {METRICS_PORT}: {e}")
+        asyncio.create_task(cleanup_worker())
+        retention_loop.start()
+        invite_sweeper.start()
+        if ROLE_RECONCILE_ON_STARTUP:
+            asyncio.create_task(reconcile_all_team_roles())
     # Регистрация persistent views (dummy args)
     bot.add_view(TeamInviteView(0, 0))
     bot.add_view(DuelInviteView(0, 0))
@@ -3390,4 +4887,10 @@ async def on_ready():
 
 
 if __name__ == "__main__":
-    bot.run(DISCORD_BOT_TOKEN)
+    # Логирование уже настроено через очередь: свой обработчик discord.py не ставим
+    bot.run(DISCORD_BOT_TOKEN, log_handler=None)
+    # Дописываем кулдауны, которые не успела сбросить фоновая задача
+    if _dirty_duel_times:
+        _write_duel_times(_dirty_duel_times)
+    if _ledger_buffer:
+        _write_ledger_batch(_ledger_buffer)
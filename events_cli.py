@@ -0,0 +1,133 @@
+"""Offline queries over the bot's JSON event log (events.jsonl and its rotated copies).
+
+    python events_cli.py matches              # totals per match
+    python events_cli.py users                # totals per user
+    python events_cli.py match 42             # one match: totals + timeline
+    python events_cli.py user 1234567890      # one user: totals + timeline
+    python events_cli.py duel 17              # duel timeline
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional
+
+
+def log_files(path: str) -> List[str]:
+    """Rotated files first (events.jsonl.N ... .1), then the live file, so events come out in time order."""
+    rotated = [f for f in glob.glob(f"{path}.*") if f.rsplit(".", 1)[-1].isdigit()]
+    rotated.sort(key=lambda f: int(f.rsplit(".", 1)[-1]), reverse=True)
+    return rotated + ([path] if os.path.exists(path) else [])
+
+
+def read_events(path: str, since: Optional[float] = None) -> Iterator[dict]:
+    for file_name in log_files(path):
+        with open(file_name, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue  # строка оборвана при ротации или падении
+                if since is None or event.get("ts", 0) >= since:
+                    yield event
+
+
+def match_totals(events) -> Dict[str, Dict[str, int]]:
+    totals: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+    for e in events:
+        if "match_id" not in e:
+            continue
+        t = totals[str(e["match_id"])]
+        kind = e["event"]
+        if kind == "bet_placed":
+            t["bets"] += 1
+            t["staked"] += e["amount"]
+        elif kind == "bet_paid":
+            t["paid"] += e["amount"]
+        elif kind == "bet_refunded":
+            t["refunded"] += e["amount"]
+        elif kind == "match_settled":
+            t["burned"] += e["burned"]
+        elif kind == "bet_failed":
+            t["failed"] += 1
+    return totals
+
+
+def user_totals(events) -> Dict[str, Dict[str, int]]:
+    totals: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+    for e in events:
+        kind = e["event"]
+        if kind == "bet_placed":
+            totals[e["user_id"]]["bet_staked"] += e["amount"]
+        elif kind == "bet_paid":
+            totals[e["user_id"]]["bet_paid"] += e["amount"]
+        elif kind == "bet_refunded":
+            totals[e["user_id"]]["bet_refunded"] += e["amount"]
+        elif kind == "duel_settled":
+            totals[e["winner_id"]]["duel_won"] += 1
+            totals[e["winner_id"]]["duel_payout"] += e["payout"]
+            # Ставки списываются только при захвате холдов; снятые холды баланс не трогают
+            if e.get("captured", True):
+                for uid in (e["winner_id"], e.get("loser_id")):
+                    if uid:
+                        totals[uid]["duel_staked"] += e["points"]
+    for t in totals.values():
+        t["net"] = (t["bet_paid"] + t["bet_refunded"] - t["bet_staked"]
+                    + t["duel_payout"] - t["duel_staked"])
+    return totals
+
+
+def print_table(rows: Dict[str, Dict[str, int]], columns: List[str], key_name: str):
+    header = [key_name] + columns
+    lines = [[key] + [str(values.get(c, 0)) for c in columns] for key, values in sorted(rows.items())]
+    widths = [max(len(row[i]) for row in [header] + lines) for i in range(len(header))]
+    for row in [header] + lines:
+        print("  ".join(cell.rjust(w) for cell, w in zip(row, widths)))
+
+
+def print_timeline(events):
+    for e in events:
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(e.get("ts", 0)))
+        fields = " ".join(f"{k}={v}" for k, v in e.items() if k not in ("ts", "event"))
+        print(f"{stamp}  {e['event']:<16} {fields}")
+
+
+MATCH_COLUMNS = ["bets", "staked", "paid", "refunded", "burned", "failed"]
+USER_COLUMNS = ["bet_staked", "bet_paid", "bet_refunded", "duel_won", "duel_staked", "duel_payout", "net"]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Запросы к журналу событий бота")
+    parser.add_argument("--file", default=os.getenv("EVENTS_FILE", "events.jsonl"))
+    parser.add_argument("--since-hours", type=float, default=None, help="только события за последние N часов")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("matches")
+    sub.add_parser("users")
+    for name in ("match", "user", "duel"):
+        sub.add_parser(name).add_argument("id")
+    args = parser.parse_args(argv)
+
+    since = time.time() - args.since_hours * 3600 if args.since_hours else None
+    events = list(read_events(args.file, since))
+    if args.command == "matches":
+        print_table(match_totals(events), MATCH_COLUMNS, "match")
+    elif args.command == "users":
+        print_table(user_totals(events), USER_COLUMNS, "user")
+    elif args.command == "match":
+        selected = [e for e in events if str(e.get("match_id")) == args.id]
+        print_table({args.id: match_totals(selected).get(args.id, {})}, MATCH_COLUMNS, "match")
+        print_timeline(selected)
+    elif args.command == "user":
+        selected = [e for e in events if args.id in (e.get("user_id"), e.get("winner_id"), e.get("loser_id"), e.get("creator_id"), e.get("opponent_id"))]
+        print_table({args.id: user_totals(selected).get(args.id, {})}, USER_COLUMNS, "user")
+        print_timeline(selected)
+    else:
+        print_timeline(e for e in events if str(e.get("duel_id")) == args.id)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""Memory introspection helpers: deep cache sizes, live objects by class,
+pending asyncio tasks by coroutine and tracemalloc top allocators."""
+import asyncio
+import gc
+import os
+import sys
+import tracemalloc
+from collections import Counter
+from typing import List, Optional
+
+
+def deep_sizeof(obj, seen: Optional[set] = None) -> int:
+    """Approximate size of a container and the containers/values inside it (shared objects counted once)."""
+    seen = set() if seen is None else seen
+    total = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+    return total
+
+
+def rss_bytes() -> Optional[int]:
+    """Current resident set size (Linux /proc), None where unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def count_instances(base: type) -> Counter:
+    """Live instances of `base` subclasses, by class name (walks the GC heap — admin use only)."""
+    return Counter(type(obj).__name__ for obj in gc.get_objects() if isinstance(obj, base))
+
+
+def task_counts() -> Counter:
+    """Pending asyncio tasks by coroutine name."""
+    return Counter(getattr(task.get_coro(), "__qualname__", "?") for task in asyncio.all_tasks())
+
+
+class AllocationTracker:
+    """tracemalloc wrapper that reports top allocators and growth since the previous report."""
+
+    def __init__(self):
+        self._previous: Optional[tracemalloc.Snapshot] = None
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 1):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self._previous = None
+
+    def stop(self):
+        tracemalloc.stop()
+        self._previous = None
+
+    def top(self, limit: int = 10) -> List[str]:
+        """Top lines by allocated size; "+N" is growth since the last call."""
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ))
+        if self._previous is not None:
+            stats = snapshot.compare_to(self._previous, "lineno")
+            lines = [
+                f"{_short(s.traceback[0].filename)}:{s.traceback[0].lineno} {format_bytes(s.size)} ({s.size_diff:+,} B) x{s.count}"
+                for s in stats[:limit]
+            ]
+        else:
+            lines = [
+                f"{_short(s.traceback[0].filename)}:{s.traceback[0].lineno} {format_bytes(s.size)} x{s.count}"
+                for s in snapshot.statistics("lineno")[:limit]
+            ]
+        self._previous = snapshot
+        return lines
+
+
+def _short(path: str) -> str:
+    parts = path.replace("\\", "/").split("/")
+    return "/".join(parts[-2:])
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(size) < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
@@ -0,0 +1,306 @@
+"""Prometheus-style metrics shared by both bots.
+
+Counters, histograms and gauges live in one process-wide registry and are
+served in the text exposition format by an aiohttp app running inside the
+bot's own event loop (it also answers "/" for the hosting health check).
+Metric updates take a lock, so they are safe from asyncio.to_thread workers.
+"""
+import asyncio
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import aiohttp
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY: List["Metric"] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        header = f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.kind}\n"
+        return header + "".join(line + "\n" for line in self.samples())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[Tuple[str, ...], list] = {}  # {labels: [counts per bucket + inf, sum]}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        lines = []
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                labels = _format_labels(self.labels, key, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Gauge(Metric):
+    """Set explicitly, or computed at scrape time by `fn` (a number, or {label values: number})."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), fn: Optional[Callable] = None):
+        super().__init__(name, documentation, labels)
+        self.fn = fn
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self) -> List[str]:
+        if self.fn is not None:
+            result = self.fn()
+            items = list(result.items()) if isinstance(result, dict) else [((), result)]
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in items]
+
+
+def render_all() -> str:
+    chunks = []
+    for metric in REGISTRY:
+        try:
+            chunks.append(metric.render())
+        except Exception as e:  # сломанный gauge не должен ронять весь scrape
+            chunks.append(f"# {metric.name} failed: {_escape(e)}\n")
+    return "".join(chunks)
+
+
+# ---------------------- HTTP CLIENT METRICS ----------------------
+HTTP_REQUESTS = Counter("bot_http_requests_total", "Outgoing HTTP requests", ("service", "method", "route", "status"))
+HTTP_SECONDS = Histogram("bot_http_request_seconds", "Outgoing HTTP request latency", ("service", "method", "route"))
+HTTP_RATE_LIMITED = Counter("bot_http_rate_limited_total", "Outgoing HTTP requests answered with 429", ("service", "route"))
+
+_ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+_TOKEN_SEGMENT = re.compile(r"/[A-Za-z0-9_\-.]{40,}(?=/|$)")
+
+
+def route_template(path: str) -> str:
+    """Collapse ids and interaction tokens so every route is one label value."""
+    return _ID_SEGMENT.sub("/:id", _TOKEN_SEGMENT.sub("/:token", path))
+
+
+def record_http(service: str, method: str, route: str, status, elapsed: float):
+    HTTP_REQUESTS.inc(service=service, method=method, route=route, status=status)
+    HTTP_SECONDS.observe(elapsed, service=service, method=method, route=route)
+    if status == 429:
+        HTTP_RATE_LIMITED.inc(service=service, route=route)
+
+
+def http_trace(service: str) -> aiohttp.TraceConfig:
+    """aiohttp TraceConfig for a client session (discord.py accepts it as http_trace=)."""
+    trace = aiohttp.TraceConfig()
+
+    async def on_request_start(session, ctx, params):
+        ctx.started = time.perf_counter()
+
+    async def on_request_end(session, ctx, params):
+        record_http(service, params.method, route_template(params.url.path), params.response.status, time.perf_counter() - ctx.started)
+
+    async def on_request_exception(session, ctx, params):
+        record_http(service, params.method, route_template(params.url.path), "error", time.perf_counter() - ctx.started)
+
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+    trace.on_request_exception.append(on_request_exception)
+    return trace
+
+
+def instrument_httpx(client, service: str, label: Callable[[object], Tuple[str, str]]):
+    """Add timing hooks to a sync httpx.Client; label(request) -> (method, route)."""
+    def on_request(request):
+        request.extensions["metrics_started"] = time.perf_counter()
+
+    def on_response(response):
+        request = response.request
+        started = request.extensions.get("metrics_started")
+        if started is None:
+            return
+        method, route = label(request)
+        record_http(service, method, route, response.status_code, time.perf_counter() - started)
+
+    hooks = client.event_hooks
+    hooks["request"].append(on_request)
+    hooks["response"].append(on_response)
+    client.event_hooks = hooks
+
+
+# ---------------------- LOOP MONITOR ----------------------
+LOOP_LAG = Histogram(
+    "bot_event_loop_lag_seconds", "Extra delay of a fixed-interval heartbeat on the event loop",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+LOOP_LAG_LAST = Gauge("bot_event_loop_lag_last_seconds", "Lag of the most recent heartbeat")
+LOOP_BLOCKED = Counter("bot_event_loop_blocked_total", "Loop stalls over the threshold, by blocking code site", ("site",))
+
+loop_log = logging.getLogger("bot.loop")
+
+
+class LoopMonitor:
+    """Heartbeat task measuring loop lag, plus a watchdog thread that captures the loop thread's
+    stack when a heartbeat is overdue by more than `threshold` seconds."""
+
+    def __init__(self, threshold: float = 0.25, interval: float = 0.1, project_root: Optional[str] = None, stack_depth: int = 12):
+        self.threshold = threshold
+        self.interval = interval
+        self.project_root = os.path.abspath(project_root) if project_root else None
+        self.stack_depth = stack_depth
+        self.recent: deque = deque(maxlen=20)  # (time, stalled_seconds, site, stack text)
+        self._beat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    async def _heartbeat(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - started - self.interval)
+            self._beat = now
+            LOOP_LAG.observe(lag)
+            LOOP_LAG_LAST.set(lag)
+
+    def blocking_site(self, stack: traceback.StackSummary) -> str:
+        """Innermost frame from the project's own files (falls back to the innermost frame)."""
+        for frame in reversed(stack):
+            path = os.path.abspath(frame.filename)
+            if self.project_root and path.startswith(self.project_root) and "site-packages" not in path:
+                return f"{os.path.basename(path)}:{frame.name}:{frame.lineno}"
+        frame = stack[-1]
+        return f"{os.path.basename(frame.filename)}:{frame.name}"
+
+    def _watch(self):
+        reported = None
+        while True:
+            time.sleep(self.interval / 2)
+            beat = self._beat
+            stalled = time.monotonic() - beat
+            if stalled < self.threshold or reported == beat:
+                continue
+            reported = beat  # одна запись на одну остановку цикла
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            del frame
+            site = self.blocking_site(stack)
+            text = "".join(traceback.format_list(stack[-self.stack_depth:]))
+            LOOP_BLOCKED.inc(site=site)
+            self.recent.append((time.time(), stalled, site, text))
+            loop_log.warning("Event loop blocked for %.0f ms at %s\n%s", stalled * 1000, site, text)
+
+
+# ---------------------- SERVER ----------------------
+async def start_metrics_server(host: str, port: int, status_text: str = "Bot is running!") -> web.AppRunner:
+    """Serve "/" and "/metrics" from the running event loop."""
+    async def home(request):
+        return web.Response(text=status_text)
+
+    async def metrics(request):
+        return web.Response(text=render_all(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/", home)
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
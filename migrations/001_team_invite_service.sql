@@ -0,0 +1,129 @@
+-- Счётчик участников команды и атомарное принятие приглашений.
+-- Команда подтверждается, когда member_count достигает 5, без пересчёта team_invites.
+
+alter table teams add column if not exists member_count integer not null default 0;
+
+update teams set member_count =
+      (case when player1_id is not null then 1 else 0 end)
+    + (case when player2_id is not null then 1 else 0 end)
+    + (case when player3_id is not null then 1 else 0 end)
+    + (case when player4_id is not null then 1 else 0 end)
+    + (case when player5_id is not null then 1 else 0 end);
+
+-- Занимает первый свободный слот; вызывающий уже держит блокировку строки teams.
+create or replace function _fill_team_slot(p_team teams, p_user_id text)
+returns teams
+language plpgsql as $$
+declare
+    v_slot integer;
+    v_team teams;
+begin
+    v_slot := case
+        when p_team.player1_id is null then 1
+        when p_team.player2_id is null then 2
+        when p_team.player3_id is null then 3
+        when p_team.player4_id is null then 4
+        when p_team.player5_id is null then 5
+    end;
+    if v_slot is null then
+        return null;
+    end if;
+
+    update teams set
+        player1_id = case when v_slot = 1 then p_user_id else player1_id end,
+        player2_id = case when v_slot = 2 then p_user_id else player2_id end,
+        player3_id = case when v_slot = 3 then p_user_id else player3_id end,
+        player4_id = case when v_slot = 4 then p_user_id else player4_id end,
+        player5_id = case when v_slot = 5 then p_user_id else player5_id end,
+        member_count = member_count + 1,
+        status = case when member_count + 1 >= 5 then 'confirmed' else status end
+    where id = p_team.id
+    returning * into v_team;
+    return v_team;
+end;
+$$;
+
+-- result: 'accepted' | 'stale' (нет pending-приглашения) | 'full'
+create or replace function accept_team_invite(p_invite_id bigint, p_user_id text)
+returns table (result text, id bigint, name text, leader_id text, guild_id text, member_count integer, status text)
+language plpgsql as $$
+declare
+    v_team_id bigint;
+    v_team teams;
+begin
+    select ti.team_id into v_team_id from team_invites ti
+     where ti.id = p_invite_id and ti.user_id = p_user_id and ti.status = 'pending'
+     for update;
+    if not found then
+        return query select 'stale'::text, null::bigint, null::text, null::text, null::text, null::integer, null::text;
+        return;
+    end if;
+
+    select * into v_team from teams t where t.id = v_team_id for update;
+    v_team := _fill_team_slot(v_team, p_user_id);
+    if v_team.id is null then
+        select * into v_team from teams t where t.id = v_team_id;
+        return query select 'full'::text, v_team.id::bigint, v_team.name::text, v_team.leader_id::text, v_team.guild_id::text, v_team.member_count, v_team.status::text;
+        return;
+    end if;
+
+    update team_invites ti set status = 'accepted' where ti.id = p_invite_id;
+    return query select 'accepted'::text, v_team.id::bigint, v_team.name::text, v_team.leader_id::text, v_team.guild_id::text, v_team.member_count, v_team.status::text;
+end;
+$$;
+
+-- Вступление в публичную команду через объявление: приглашение создаётся уже принятым.
+create or replace function join_public_team(p_team_id bigint, p_user_id text)
+returns table (result text, id bigint, name text, leader_id text, guild_id text, member_count integer, status text)
+language plpgsql as $$
+declare
+    v_team teams;
+begin
+    select * into v_team from teams t where t.id = p_team_id and t.is_public for update;
+    if not found then
+        return query select 'stale'::text, null::bigint, null::text, null::text, null::text, null::integer, null::text;
+        return;
+    end if;
+
+    v_team := _fill_team_slot(v_team, p_user_id);
+    if v_team.id is null then
+        select * into v_team from teams t where t.id = p_team_id;
+        return query select 'full'::text, v_team.id::bigint, v_team.name::text, v_team.leader_id::text, v_team.guild_id::text, v_team.member_count, v_team.status::text;
+        return;
+    end if;
+
+    insert into team_invites (team_id, user_id, status, created_at)
+    values (p_team_id, p_user_id, 'accepted', extract(epoch from now())::bigint);
+    return query select 'accepted'::text, v_team.id::bigint, v_team.name::text, v_team.leader_id::text, v_team.guild_id::text, v_team.member_count, v_team.status::text;
+end;
+$$;
+
+-- Выход/кик: освобождает слот, уменьшает счётчик и снимает подтверждение.
+create or replace function release_team_member(p_team_id bigint, p_user_id text)
+returns boolean
+language plpgsql as $$
+declare
+    v_team teams;
+begin
+    select * into v_team from teams t where t.id = p_team_id for update;
+    if not found then
+        return false;
+    end if;
+    if p_user_id not in (coalesce(v_team.player1_id, ''), coalesce(v_team.player2_id, ''), coalesce(v_team.player3_id, ''),
+                         coalesce(v_team.player4_id, ''), coalesce(v_team.player5_id, '')) then
+        return false;
+    end if;
+
+    update teams set
+        player1_id = nullif(player1_id, p_user_id),
+        player2_id = nullif(player2_id, p_user_id),
+        player3_id = nullif(player3_id, p_user_id),
+        player4_id = nullif(player4_id, p_user_id),
+        player5_id = nullif(player5_id, p_user_id),
+        member_count = greatest(member_count - 1, 0),
+        status = 'pending'
+    where id = p_team_id;
+    update team_invites set status = 'left' where team_id = p_team_id and user_id = p_user_id;
+    return true;
+end;
+$$;
@@ -0,0 +1,44 @@
+-- Журнал движений баланса (append-only). users.balance остаётся проекцией журнала:
+-- apply_ledger_batch пишет записи и меняет баланс в одной транзакции.
+-- Повтор записи с тем же idempotency_key игнорируется, поэтому повторные
+-- расчёты и возвраты не начисляют дважды.
+
+create table if not exists balance_ledger (
+    id bigserial primary key,
+    user_id text not null,
+    delta bigint not null,
+    reason text not null,
+    ref_type text,
+    ref_id text,
+    idempotency_key text not null unique,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists balance_ledger_user_idx on balance_ledger (user_id, id desc);
+create index if not exists balance_ledger_ref_idx on balance_ledger (ref_type, ref_id);
+
+-- p_entries: [{user_id, delta, reason, ref_type, ref_id, idempotency_key}, ...]
+-- Возвращает только применённые записи с итоговым балансом пользователя.
+create or replace function apply_ledger_batch(p_entries jsonb)
+returns table (idempotency_key text, user_id text, balance bigint)
+language plpgsql as $$
+begin
+    return query
+    with inserted as (
+        insert into balance_ledger as l (user_id, delta, reason, ref_type, ref_id, idempotency_key)
+        select e->>'user_id', (e->>'delta')::bigint, e->>'reason', e->>'ref_type', e->>'ref_id', e->>'idempotency_key'
+          from jsonb_array_elements(p_entries) e
+        on conflict on constraint balance_ledger_idempotency_key_key do nothing
+        returning l.user_id, l.delta, l.idempotency_key
+    ), totals as (
+        select i.user_id, sum(i.delta) as delta from inserted i group by i.user_id
+    ), updated as (
+        insert into users as u (user_id, balance, last_duel_time)
+        select t.user_id, t.delta, 0 from totals t
+        on conflict (user_id) do update set balance = u.balance + excluded.balance
+        returning u.user_id, u.balance
+    )
+    select i.idempotency_key, i.user_id, upd.balance::bigint
+      from inserted i join updated upd on upd.user_id = i.user_id;
+end;
+$$;
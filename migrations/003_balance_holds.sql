@@ -0,0 +1,84 @@
+-- Холды под ставки дуэлей: ставка резервируется, а не списывается.
+-- Доступный баланс = users.balance − сумма активных холдов.
+-- Отмена снимает холд одним условным UPDATE, расчёт захватывает холды,
+-- пишет записи в balance_ledger и меняет балансы в одной транзакции (capture_duel_holds).
+
+create table if not exists balance_holds (
+    id bigserial primary key,
+    user_id text not null,
+    amount bigint not null check (amount > 0),
+    ref_type text not null,
+    ref_id text not null,
+    status text not null default 'held',  -- held | released | captured
+    created_at timestamptz not null default now(),
+    settled_at timestamptz,
+    unique (ref_type, ref_id, user_id)
+);
+
+create index if not exists balance_holds_active_idx on balance_holds (user_id) where status = 'held';
+
+-- Незавершённые дуэли, созданные до холдов: их ставки уже списаны с баланса.
+-- Возвращаем ставки на баланс (через журнал) и оформляем их как холды.
+-- Сторона A платила при создании — берём все живые статусы; сторона B — везде,
+-- где слот занят, кроме waiting: приглашённый ещё не принял и не платил.
+with stakes as (
+    select d.id as duel_id, coalesce(d.creator_id::text, d.player1_id::text, t1.leader_id::text) as user_id, d.points
+      from duels d left join teams t1 on t1.id::text = d.team1_id::text
+     where d.status in ('waiting', 'public', 'active', 'processing', 'result_pending', 'result_canceled')
+    union all
+    select d.id, coalesce(d.player2_id::text, t2.leader_id::text), d.points
+      from duels d left join teams t2 on t2.id::text = d.team2_id::text
+     where d.status in ('public', 'active', 'processing', 'result_pending', 'result_canceled')
+       and (d.player2_id is not null or d.team2_id is not null)
+), held as (
+    insert into balance_holds (user_id, amount, ref_type, ref_id)
+    select s.user_id, s.points, 'duel', s.duel_id::text from stakes s
+     where s.user_id is not null and s.points > 0
+    on conflict do nothing
+    returning user_id, amount, ref_id
+), logged as (
+    insert into balance_ledger (user_id, delta, reason, ref_type, ref_id, idempotency_key)
+    select h.user_id, h.amount, 'duel_hold_migration', 'duel', h.ref_id, 'duel:' || h.ref_id || ':hold_migration:' || h.user_id
+      from held h
+    on conflict do nothing
+    returning user_id, delta
+)
+update users u set balance = u.balance + t.delta
+  from (select l.user_id, sum(l.delta) as delta from logged l group by l.user_id) t
+ where u.user_id = t.user_id;
+
+-- Захват холдов дуэли: ставки списываются, выигрыш начисляется победителю.
+-- Повторный вызов ничего не делает: холдов в статусе held уже нет.
+create or replace function capture_duel_holds(p_duel_id bigint, p_winner_id text, p_payout bigint)
+returns table (user_id text, held bigint, balance bigint)
+language plpgsql as $$
+begin
+    return query
+    with captured as (
+        update balance_holds h set status = 'captured', settled_at = now()
+         where h.ref_type = 'duel' and h.ref_id = p_duel_id::text and h.status = 'held'
+        returning h.user_id, h.amount
+    ), entries as (
+        select c.user_id, -c.amount as delta, 'duel_stake'::text as reason,
+               'duel:' || p_duel_id || ':capture:' || c.user_id as key
+          from captured c
+        union all
+        select p_winner_id, p_payout, 'duel_payout'::text, 'duel:' || p_duel_id || ':payout'
+         where p_payout > 0 and exists (select 1 from captured)
+    ), inserted as (
+        insert into balance_ledger as l (user_id, delta, reason, ref_type, ref_id, idempotency_key)
+        select e.user_id, e.delta, e.reason, 'duel', p_duel_id::text, e.key from entries e
+        on conflict on constraint balance_ledger_idempotency_key_key do nothing
+        returning l.user_id, l.delta
+    ), updated as (
+        update users u set balance = u.balance + t.delta
+          from (select i.user_id, sum(i.delta) as delta from inserted i group by i.user_id) t
+         where u.user_id = t.user_id
+        returning u.user_id, u.balance
+    ), holders as (
+        select c.user_id, sum(c.amount) as amount from captured c group by c.user_id
+    )
+    select coalesce(hd.user_id, upd.user_id)::text, coalesce(hd.amount, 0)::bigint, upd.balance::bigint
+      from holders hd full join updated upd on upd.user_id = hd.user_id;
+end;
+$$;
@@ -0,0 +1,34 @@
+-- Квитанции для кнопок, двигающих деньги: первое нажатие занимает action_key,
+-- повторы (двойной клик, повторная доставка) получают сохранённый результат.
+-- Незавершённая квитанция старше p_stale_seconds считается брошенной и может быть занята заново.
+
+create table if not exists interaction_receipts (
+    action_key text primary key,
+    interaction_id text not null,
+    result text,
+    claimed_at timestamptz not null default now(),
+    completed_at timestamptz
+);
+
+create index if not exists interaction_receipts_claimed_idx on interaction_receipts (claimed_at);
+
+create or replace function claim_interaction_receipt(p_key text, p_interaction_id text, p_stale_seconds integer)
+returns table (claimed boolean, result text)
+language plpgsql as $$
+declare
+    v_result text;
+begin
+    insert into interaction_receipts as r (action_key, interaction_id)
+    values (p_key, p_interaction_id)
+    on conflict (action_key) do update
+        set interaction_id = excluded.interaction_id, claimed_at = now()
+        where r.completed_at is null and r.claimed_at < now() - make_interval(secs => p_stale_seconds);
+    if found then
+        return query select true, null::text;
+        return;
+    end if;
+
+    select r.result into v_result from interaction_receipts r where r.action_key = p_key;
+    return query select false, v_result;
+end;
+$$;
@@ -0,0 +1,13 @@
+-- Индексы под фоновую политику хранения: выборка устаревших строк идёт по
+-- (status, created_at) и окнами по id, без полного сканирования таблиц.
+
+create index if not exists matches_status_created_idx on matches (status, created_at);
+create index if not exists duels_status_created_idx on duels (status, created_at);
+create index if not exists teams_status_created_idx on teams (status, created_at);
+create index if not exists team_invites_created_idx on team_invites (created_at);
+create index if not exists duel_invites_created_idx on duel_invites (created_at);
+create index if not exists bets_match_idx on bets (match_id);
+
+-- Квитанциям нужен id для удаления окнами, как у остальных таблиц
+alter table interaction_receipts add column if not exists id bigserial;
+create unique index if not exists interaction_receipts_id_idx on interaction_receipts (id);
@@ -0,0 +1,12 @@
+-- Срок жизни приглашений: sweeper переводит pending → expired одним UPDATE
+-- по (status, created_at), без полного сканирования таблиц.
+
+create index if not exists duel_invites_status_created_idx on duel_invites (status, created_at);
+create index if not exists team_invites_status_created_idx on team_invites (status, created_at);
+
+-- Куда ушло ЛС с приглашением: по истечении срока его кнопки отключаются
+alter table duel_invites add column if not exists channel_id text;
+alter table duel_invites add column if not exists message_id text;
+alter table team_invites add column if not exists channel_id text;
+alter table team_invites add column if not exists message_id text;
+
@@ -0,0 +1,21 @@
+-- Расчёт дуэли одной транзакцией: переход в settled разрешён только из
+-- processing/result_pending, холды захватывает только вызов, выигравший переход.
+-- Если захват упадёт, откатится и статус: дуэль не останется settled с живыми холдами.
+
+create or replace function settle_duel_with_holds(p_duel_id bigint, p_winner_side text, p_winner_id text, p_payout bigint)
+returns table (settled boolean, user_id text, held bigint, balance bigint)
+language plpgsql as $$
+begin
+    update duels d set status = 'settled', winner_side = p_winner_side
+     where d.id = p_duel_id and d.status in ('processing', 'result_pending');
+    if not found then
+        -- Дуэль уже рассчитана или отменена параллельным вызовом
+        return query select false, null::text, null::bigint, null::bigint;
+        return;
+    end if;
+    return query select true, c.user_id, c.held, c.balance from capture_duel_holds(p_duel_id, p_winner_id, p_payout) c;
+    if not found then
+        return query select true, null::text, null::bigint, null::bigint;
+    end if;
+end;
+$$;
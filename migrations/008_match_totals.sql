@@ -0,0 +1,18 @@
+-- Суммы ставок матча растут атомарным инкрементом в БД: параллельные ставки
+-- не теряют обновления, как при чтении total_a/total_b и записи суммы из бота.
+
+create or replace function increment_match_total(p_match_id bigint, p_team text, p_amount bigint)
+returns table (total_a bigint, total_b bigint)
+language plpgsql as $$
+begin
+    if p_team not in ('A', 'B') then
+        raise exception 'unknown team %', p_team;
+    end if;
+    return query
+    update matches m
+       set total_a = m.total_a + case when p_team = 'A' then p_amount else 0 end,
+           total_b = m.total_b + case when p_team = 'B' then p_amount else 0 end
+     where m.id = p_match_id
+    returning m.total_a::bigint, m.total_b::bigint;
+end;
+$$;
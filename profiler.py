@@ -0,0 +1,204 @@
+"""On-demand profiling of the running bot.
+
+Two modes, both limited to a time window or to the next N invocations of one
+command:
+  * sampling — a thread samples the event-loop thread's stack every few ms;
+    the result is a collapsed-stack file ("a;b;c count"), ready for
+    flamegraph.pl / speedscope;
+  * cprofile — deterministic cProfile on the loop thread; writes the .prof
+    dump plus caller;callee pairs in the same collapsed format.
+"""
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from typing import List, Optional, Tuple
+
+MODES = ("sampling", "cprofile")
+
+
+def frame_label(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def collapse_stack(frame) -> Tuple[str, ...]:
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    return tuple(reversed(labels))
+
+
+class StackSampler(threading.Thread):
+    """Samples one thread's stack while `active` is set."""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="profiler-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.active = threading.Event()
+        self.stopped = threading.Event()
+        self.stacks: Counter = Counter()
+        self.samples = 0
+
+    def run(self):
+        while not self.stopped.is_set():
+            if self.active.wait(0.1):
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is not None:
+                    self.stacks[collapse_stack(frame)] += 1
+                    self.samples += 1
+                del frame
+                time.sleep(self.interval)
+
+
+class ProfileReport:
+    def __init__(self, mode: str, files: List[str], summary: str, invocations: int):
+        self.mode = mode
+        self.files = files
+        self.summary = summary
+        self.invocations = invocations
+
+
+class Profiler:
+    """One profiling session at a time; enter()/exit() are called around every traced invocation."""
+
+    def __init__(self, out_dir: str, interval: float = 0.005):
+        self.out_dir = out_dir
+        self.interval = interval
+        self.mode: Optional[str] = None
+        self.target: Optional[str] = None
+        self.remaining = 0
+        self.invocations = 0
+        self._depth = 0
+        self._sampler: Optional[StackSampler] = None
+        self._profile: Optional[cProfile.Profile] = None
+        self._done: Optional[asyncio.Event] = None
+
+    @property
+    def busy(self) -> bool:
+        return self.mode is not None
+
+    def start(self, mode: str, target: Optional[str] = None, invocations: int = 0):
+        """Start a session on the loop thread; with a target only its invocations are profiled."""
+        if self.busy:
+            raise RuntimeError("Профилирование уже идёт.")
+        if mode not in MODES:
+            raise ValueError(f"Неизвестный режим: {mode}")
+        self.mode, self.target, self.remaining, self.invocations = mode, target, invocations, 0
+        self._depth = 0
+        self._done = asyncio.Event()
+        if mode == "sampling":
+            self._sampler = StackSampler(threading.get_ident(), self.interval)
+            self._sampler.start()
+        else:
+            self._profile = cProfile.Profile()
+        if target is None:
+            self._activate()
+
+    def _activate(self):
+        if self._sampler is not None:
+            self._sampler.active.set()
+        else:
+            self._profile.enable()
+
+    def _deactivate(self):
+        if self._sampler is not None:
+            self._sampler.active.clear()
+        else:
+            self._profile.disable()
+
+    def enter(self, name: str):
+        if self.target is None or name != self.target or self.remaining <= 0:
+            return
+        self._depth += 1
+        if self._depth == 1:
+            self._activate()
+
+    def exit(self, name: str):
+        if self.target is None or name != self.target or self._depth == 0:
+            return
+        self._depth -= 1
+        self.invocations += 1
+        self.remaining -= 1
+        if self._depth == 0:
+            self._deactivate()
+        if self.remaining <= 0:
+            self._done.set()
+
+    async def wait(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def stop(self):
+        """Stop collecting (must run on the loop thread, where cProfile was enabled)."""
+        if self.target is None or self._depth > 0:
+            self._deactivate()
+        self._depth = 0
+        if self._sampler is not None:
+            self._sampler.stopped.set()
+            self._sampler.join(1)
+
+    def discard(self):
+        """Drop a stopped session without writing a report."""
+        self.mode = self.target = None
+        self._sampler = self._profile = None
+
+    def report(self, top: int = 15) -> ProfileReport:
+        """Write the output files and build the top-functions summary; safe to run in a worker thread."""
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        suffix = f"-{self.target.strip('/').replace(':', '_')}" if self.target else ""
+        base = os.path.join(self.out_dir, f"{stamp}-{self.mode}{suffix}")
+        os.makedirs(self.out_dir, exist_ok=True)
+        try:
+            if self._sampler is not None:
+                files, summary = self._write_sampling(base, top)
+            else:
+                files, summary = self._write_cprofile(base, top)
+            return ProfileReport(self.mode, files, summary, self.invocations)
+        finally:
+            self.discard()
+
+    def _write_sampling(self, base: str, top: int) -> Tuple[List[str], str]:
+        stacks = self._sampler.stacks
+        total = sum(stacks.values())
+        path = base + ".folded"
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+        own: Counter = Counter()
+        inclusive: Counter = Counter()
+        for stack, count in stacks.items():
+            own[stack[-1]] += count
+            for label in set(stack):
+                inclusive[label] += count
+        lines = [f"samples: {total} (every {self.interval * 1000:.0f} ms)", "", "self%   total%  function"]
+        for label, count in own.most_common(top):
+            lines.append(f"{count / total * 100:5.1f}  {inclusive[label] / total * 100:6.1f}  {label}")
+        return [path], "\n".join(lines) if total else "Ни одного сэмпла."
+
+    def _write_cprofile(self, base: str, top: int) -> Tuple[List[str], str]:
+        prof_path = base + ".prof"
+        self._profile.dump_stats(prof_path)
+        out = io.StringIO()
+        stats = pstats.Stats(self._profile, stream=out)
+        folded_path = base + ".folded"
+        with open(folded_path, "w", encoding="utf-8") as f:
+            # stats.stats: {func: (cc, nc, tottime, cumtime, callers{func: (cc, nc, tottime, cumtime)})}
+            for func, (_, _, _, _, callers) in stats.stats.items():
+                callee = f"{os.path.basename(func[0])}:{func[2]}"
+                for caller, (_, _, tottime, _) in callers.items():
+                    micros = int(tottime * 1e6)
+                    if micros:
+                        f.write(f"{os.path.basename(caller[0])}:{caller[2]};{callee} {micros}\n")
+        stats.strip_dirs().sort_stats("tottime").print_stats(top)
+        text = out.getvalue()
+        summary = text[text.find("ncalls"):] if "ncalls" in text else text
+        return [prof_path, folded_path], summary.strip() or "Нет данных."
@@ -0,0 +1,225 @@
+"""Lightweight per-interaction tracing.
+
+A trace is a tree of spans kept in a context variable: the root is opened
+per interaction, child spans wrap Supabase requests, outgoing HTTP calls and
+lock waits. Contexts are copied into asyncio.to_thread workers, so spans
+opened there attach to the right trace. Traces slower than the threshold are
+written as Chrome trace-event JSON (chrome://tracing, ui.perfetto.dev).
+"""
+import asyncio
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+import aiohttp
+
+trace_log = logging.getLogger("bot.trace")
+
+MAX_SPANS_PER_TRACE = 2000
+MAX_TRACE_FILES = 200
+
+
+class Span:
+    __slots__ = ("trace", "name", "attrs", "start", "end", "lane")
+
+    def __init__(self, trace: "Trace", name: str, attrs: dict):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.lane = _lane()
+
+    def finish(self):
+        if self.end is None:
+            self.end = time.perf_counter()
+            self.trace.add(self)
+
+
+class Trace:
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.wall_start = time.time()
+        self.root = Span(self, name, attrs)
+        self.spans: List[Span] = []
+        self.dropped = 0
+
+    def add(self, span: Span):
+        if len(self.spans) < MAX_SPANS_PER_TRACE:
+            self.spans.append(span)  # list.append атомарен — span'ы приходят и из потоков to_thread
+        else:
+            self.dropped += 1
+
+    @property
+    def duration(self) -> float:
+        return (self.root.end or time.perf_counter()) - self.root.start
+
+    def to_chrome(self) -> dict:
+        """Trace-event JSON: one complete ("X") event per span, one row per task/thread."""
+        origin = self.root.start
+        lanes: Dict[str, int] = {}
+        events = []
+        for span in [self.root] + self.spans:
+            tid = lanes.setdefault(span.lane, len(lanes) + 1)
+            events.append({
+                "name": span.name, "ph": "X", "pid": 1, "tid": tid,
+                "ts": round((span.start - origin) * 1e6, 1),
+                "dur": round(((span.end or span.start) - span.start) * 1e6, 1),
+                "args": span.attrs,
+            })
+        events.extend(
+            {"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": lane}}
+            for lane, tid in lanes.items()
+        )
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"trace": self.name, "started": self.wall_start, "dropped_spans": self.dropped},
+        }
+
+
+_current: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def _lane() -> str:
+    """Row in the viewer: the asyncio task on the loop thread, otherwise the thread."""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is not None:
+        return task.get_name()
+    return threading.current_thread().name
+
+
+class Tracer:
+    def __init__(self, trace_dir: str, slow_seconds: float):
+        self.trace_dir = trace_dir
+        self.slow_seconds = slow_seconds
+        self.dumped = 0
+
+    def start(self, name: str, **attrs) -> Trace:
+        """Open a root span and make it current for the calling task."""
+        trace = Trace(name, attrs)
+        _current.set(trace.root)
+        return trace
+
+    def finish(self, trace: Trace, **attrs):
+        trace.root.attrs.update(attrs)
+        if trace.root.end is None:
+            trace.root.end = time.perf_counter()
+        if trace.duration >= self.slow_seconds:
+            payload = trace.to_chrome()
+            file_name = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(trace.wall_start))}-{trace.name.replace('/', '_').replace(':', '_')}-{int(trace.duration * 1000)}ms.json"
+            try:
+                asyncio.get_running_loop().run_in_executor(None, self._write, file_name, payload)
+            except RuntimeError:
+                self._write(file_name, payload)
+
+    @contextmanager
+    def trace(self, name: str, **attrs):
+        """Root span for a block; the previous current span is restored afterwards."""
+        token = _current.set(None)
+        trace = self.start(name, **attrs)
+        try:
+            yield trace
+        finally:
+            self.finish(trace)
+            _current.reset(token)
+
+    def _write(self, file_name: str, payload: dict):
+        try:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            with open(os.path.join(self.trace_dir, file_name), "w", encoding="utf-8") as f:
+                json.dump(payload, f, ensure_ascii=False, default=str)
+            self.dumped += 1
+            files = sorted(glob.glob(os.path.join(self.trace_dir, "*.json")))
+            for old in files[:-MAX_TRACE_FILES]:
+                os.remove(old)
+        except OSError as e:
+            trace_log.warning("Failed to write slow trace %s: %s", file_name, e)
+        else:
+            trace_log.info("Slow trace %s (%s)", payload["otherData"]["trace"], file_name)
+
+
+def begin(name: str, **attrs) -> Optional[Span]:
+    """Leaf span under the current one (None outside a trace); call .finish() when done."""
+    parent = _current.get()
+    if parent is None:
+        return None
+    return Span(parent.trace, name, attrs)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Child span around a block; spans opened inside it nest under it."""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(parent.trace, name, attrs)
+    token = _current.set(child)
+    try:
+        yield child
+    finally:
+        _current.reset(token)
+        child.finish()
+
+
+class TracedLock(asyncio.Lock):
+    """asyncio.Lock that records a span for the time spent waiting to acquire it."""
+
+    def __init__(self, name: str):
+        super().__init__()
+        self.name = name
+
+    async def acquire(self):
+        if not self.locked():
+            return await super().acquire()
+        with span(f"lock.wait:{self.name}"):
+            return await super().acquire()
+
+
+def add_http_spans(trace_config: aiohttp.TraceConfig, service: str) -> aiohttp.TraceConfig:
+    """Add span callbacks to an aiohttp TraceConfig (e.g. the one from metrics.http_trace)."""
+    async def on_request_start(session, ctx, params):
+        ctx.span = begin(f"{service} {params.method}", url=str(params.url.with_query(None)))
+
+    async def on_request_end(session, ctx, params):
+        if getattr(ctx, "span", None) is not None:
+            ctx.span.attrs["status"] = params.response.status
+            ctx.span.finish()
+
+    async def on_request_exception(session, ctx, params):
+        if getattr(ctx, "span", None) is not None:
+            ctx.span.attrs["error"] = type(params.exception).__name__
+            ctx.span.finish()
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+def add_httpx_spans(client, service: str, label):
+    """Span per request on a sync httpx.Client; label(request) -> (operation, target)."""
+    def on_request(request):
+        op, target = label(request)
+        request.extensions["trace_span"] = begin(f"{service} {op} {target}")
+
+    def on_response(response):
+        span_ = response.request.extensions.get("trace_span")
+        if span_ is not None:
+            span_.attrs["status"] = response.status_code
+            span_.finish()
+
+    hooks = client.event_hooks
+    hooks["request"].append(on_request)
+    hooks["response"].append(on_response)
+    client.event_hooks = hooks